@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+import csv
+import time
+import resource
+import multiprocessing
+
+# Project imports
+from src.benchmark.synthetic_field import FieldSettings, generate_field, write_stage1_output, parse_ground_truth_file
+from src.stages.exit_reason import ExitReason
+
+# Order that stages are ran in.
+STAGE_NAMES = ['stage1', 'stage2', 'stage3', 'stage4', 'stage5']
+
+def stage_function(stage_name):
+    '''Return stage function. Imported here so that a stage's dependencies are only needed if it's ran.'''
+    if stage_name == 'stage1':
+        from src.stages.stage1_extract_codes import stage1_extract_codes
+        return stage1_extract_codes
+    if stage_name == 'stage2':
+        from src.stages.stage2_group_codes import stage2_group_codes
+        return stage2_group_codes
+    if stage_name == 'stage3':
+        from src.stages.stage3_extract_plant_parts import stage3_extract_plant_parts
+        return stage3_extract_plant_parts
+    if stage_name == 'stage4':
+        from src.stages.stage4_locate_plants import stage4_locate_plants
+        return stage4_locate_plants
+    if stage_name == 'stage5':
+        from src.stages.stage5_output import stage5_output
+        return stage5_output
+
+def stage_arguments(stage_name, field_directory, settings, stage1_directory):
+    '''Return dictionary of arguments for stage using values that match how the synthetic field was generated.'''
+    stage_directory = os.path.join(field_directory, stage_name)
+    if stage_name == 'stage1':
+        return {'image_directory': os.path.join(field_directory, 'images'),
+                'image_geo_file': os.path.join(field_directory, 'image_geo.csv'),
+                'output_directory': stage_directory,
+                'postfix_id': 'synthetic',
+                'code_min_size': settings.code_size * 0.5,
+                'code_max_size': settings.code_size * 2.0,
+                'resolution': settings.resolution,
+                'camera_height': settings.camera_height,
+                'marked_image': 'false',
+                'debug_start': '__none__',
+                'debug_stop': '__none__'}
+    if stage_name == 'stage2':
+        return {'input_directory': stage1_directory,
+                'field_direction': settings.field_direction,
+                'output_directory': stage_directory,
+                'num_rows_per_pass': settings.rows_per_pass,
+                'code_list_filepath': 'none',
+                'code_modifications_filepath': 'none'}
+    if stage_name == 'stage3':
+        return {'input_filepath': find_stage_output(os.path.join(field_directory, 'stage2'), '.s2'),
+                'output_directory': stage_directory,
+                'pad': 0.2,
+                'special_pad': 0.2,
+                'min_leaf_size': 1,
+                'max_leaf_size': 20,
+                'min_stick_part_size': 0.5,
+                'max_stick_part_size': 8,
+                'min_tag_size': 0.5,
+                'max_tag_size': 6,
+                'disable_sticks': 'false',
+                'disable_tags': 'false',
+                'marked_image': 'false',
+                'debug_start': '__none__',
+                'debug_stop': '__none__'}
+    if stage_name == 'stage4':
+        return {'input_filepath': find_stage_output(os.path.join(field_directory, 'stage3'), '.s3'),
+                'output_directory': stage_directory,
+                'max_plant_size': 30,
+                'max_plant_part_distance': 8,
+                'plant_spacing': settings.plant_spacing * 100,
+                'start_code_spacing': settings.code_spacing * 100,
+                'end_code_spacing': settings.code_spacing * 100,
+                'single_max_dist': 20,
+                'stick_multiplier': 2,
+                'leaf_multiplier': 1.5,
+                'tag_multiplier': 4,
+                'lateral_penalty': 1,
+                'projection_penalty': 1,
+                'closeness_penalty': 1,
+                'spacing_filter_thresh': 1.5,
+                'extract_images': 'false',
+                'num_processes': 1,
+                'split_processes': 1,
+                'fuse_distance': 0,
+                'localization_engine': 'recursive',
+                'marked_image': 'false',
+                'marked_image_scale': 1,
+                'marked_image_quality': 0}
+    if stage_name == 'stage5':
+        return {'input_filepath': find_stage_output(os.path.join(field_directory, 'stage4'), '.s4'),
+                'output_directory': stage_directory,
+                'survey_filepath': 'none',
+                'convert_coords': 'false',
+                'rigid_transform': 'false',
+                'plant_spacing': 0,
+                'field_num_start': 1,
+                'numbering_layout': 'serpentine',
+                'columnar_output': 'false',
+                'db_filepath': 'none',
+                'field_name': 'none',
+                'field_date': 'none'}
+
+def find_stage_output(directory, extension):
+    '''Return path of first file in directory with extension or 'none' if there isn't one.'''
+    if not os.path.exists(directory):
+        return 'none'
+    filenames = sorted([f for f in os.listdir(directory) if os.path.splitext(f)[1] == extension])
+    if len(filenames) == 0:
+        return 'none'
+    return os.path.join(directory, filenames[0])
+
+def run_stage_in_process(stage_name, stage_args, log_filepath, result_queue):
+    '''Run stage and put (exit code, wall time, peak memory MB) on queue. Ran in separate process so memory is per-stage.'''
+    # Keep stage output out of benchmark output.
+    log_file = open(log_filepath, 'w')
+    sys.stdout = log_file
+    try:
+        stage = stage_function(stage_name)
+        start_time = time.time()
+        exit_code = stage(**stage_args)
+        wall_time = time.time() - start_time
+    except Exception as e:
+        print "Exception {}".format(e)
+        exit_code = -1
+        wall_time = 0
+    finally:
+        sys.stdout = sys.__stdout__
+        log_file.close()
+
+    if exit_code is None:
+        exit_code = ExitReason.success # not all stages return a code on success.
+
+    # Linux reports max resident set size in kilobytes.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    result_queue.put((exit_code, wall_time, peak_memory))
+
+def run_stage(stage_name, stage_args, log_filepath):
+    '''Return (exit code, wall time, peak memory MB) of stage ran in a child process.'''
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stage_in_process, args=(stage_name, stage_args, log_filepath, result_queue))
+    process.start()
+    process.join()
+    if result_queue.empty():
+        return -1, 0, 0
+    return result_queue.get()
+
+def benchmark_field(field_directory, settings, stages, use_synthetic_stage1):
+    '''Generate synthetic field and run each stage on it.  Return list of result dictionaries.'''
+
+    print "Generating {} rows with {} plants per row in {}".format(settings.num_rows, settings.plants_per_row, field_directory)
+    start_time = time.time()
+    image_directory, geo_filepath, ground_truth_filepath = generate_field(field_directory, settings)
+    print "Generated field in {:.2f} seconds".format(time.time() - start_time)
+
+    num_images = len(os.listdir(image_directory))
+    num_plants = len([item for item in parse_ground_truth_file(ground_truth_filepath) if item.item_type == 'Plant'])
+
+    stage1_directory = os.path.join(field_directory, 'stage1')
+    if use_synthetic_stage1:
+        # Codes may not be decodable so use known code positions so that later stages are realistic.
+        stage1_directory = os.path.join(field_directory, 'stage1_synthetic')
+        write_stage1_output(stage1_directory, image_directory, geo_filepath, ground_truth_filepath, settings)
+
+    results = []
+    for stage_name in stages:
+        stage_args = stage_arguments(stage_name, field_directory, settings, stage1_directory)
+        log_filepath = os.path.join(field_directory, '{}_log.txt'.format(stage_name))
+
+        exit_code, wall_time, peak_memory = run_stage(stage_name, stage_args, log_filepath)
+
+        result = {'field': os.path.basename(os.path.normpath(field_directory)),
+                  'stage': stage_name,
+                  'num_rows': settings.num_rows,
+                  'plants_per_row': settings.plants_per_row,
+                  'num_images': num_images,
+                  'num_plants': num_plants,
+                  'exit_code': exit_code,
+                  'wall_time': wall_time,
+                  'images_per_second': num_images / wall_time if wall_time > 0 else 0,
+                  'plants_per_second': num_plants / wall_time if wall_time > 0 else 0,
+                  'peak_memory_mb': peak_memory}
+        results.append(result)
+
+        print "{} exit code {} in {:.2f} seconds ({:.1f} images/sec, {:.1f} plants/sec) peak memory {:.1f} MB".format(stage_name, exit_code, wall_time,
+                                                    result['images_per_second'], result['plants_per_second'], peak_memory)
+
+        if exit_code != ExitReason.success:
+            print "Stopping field since {} failed. See {}".format(stage_name, log_filepath)
+            break
+
+    return results
+
+# Columns written to and read from results file.
+RESULT_HEADER = ['field', 'stage', 'num_rows', 'plants_per_row', 'num_images', 'num_plants', 'exit_code',
+                 'wall_time', 'images_per_second', 'plants_per_second', 'peak_memory_mb']
+
+def write_results(results_filepath, results):
+    '''Write list of result dictionaries to CSV file.'''
+    with open(results_filepath, 'wb') as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_HEADER)
+        writer.writeheader()
+        writer.writerows(results)
+
+def read_results(results_filepath):
+    '''Return dictionary of (field, stage) to result dictionary.'''
+    results = {}
+    with open(results_filepath, 'r') as results_file:
+        for result in csv.DictReader(results_file):
+            results[(result['field'], result['stage'])] = result
+    return results
+
+def compare_to_baseline(results, baseline_results, tolerance):
+    '''Print comparison and return list of descriptions of any stages that got slower or used more memory than tolerance allows.'''
+    regressions = []
+    for result in results:
+        baseline = baseline_results.get((result['field'], result['stage']))
+        if baseline is None:
+            continue
+        for key in ['wall_time', 'peak_memory_mb']:
+            baseline_value = float(baseline[key])
+            value = float(result[key])
+            if baseline_value <= 0:
+                continue
+            ratio = value / baseline_value
+            print "{} {} {}: {:.2f} vs baseline {:.2f} ({:+.0f}%)".format(result['field'], result['stage'], key, value, baseline_value, (ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                regressions.append("{} {} {} increased {:.0f}%".format(result['field'], result['stage'], key, (ratio - 1) * 100))
+    return regressions
+
+if __name__ == '__main__':
+    '''Time each stage on synthetic fields to catch performance regressions.'''
+
+    parser = argparse.ArgumentParser(description='''Time each stage on synthetic fields to catch performance regressions.''')
+    parser.add_argument('output_directory', help='where to write synthetic fields and results')
+    parser.add_argument('-fs', dest='field_sizes', default='2x10,4x40', help='Comma separated field sizes as ROWSxPLANTS_PER_ROW. Default 2x10,4x40.')
+    parser.add_argument('-st', dest='stages', default='all', help='Comma separated stages to run (e.g. stage3,stage4). Default all.')
+    parser.add_argument('-s1', dest='synthetic_stage1', default='true', help='If true then later stages use stage 1 output from known code positions instead of from stage1. Default true.')
+    parser.add_argument('-mp', dest='missing_plant_fraction', default=0, help='Fraction of plants to leave out of each field. Default 0.')
+    parser.add_argument('-pj', dest='plant_jitter', default=0, help='Standard deviation (in centimeters) of plant positions along the row from even spacing. Default 0.')
+    parser.add_argument('-sd', dest='seed', default=0, help='Seed for random plant shapes. Default 0.')
+    parser.add_argument('-b', dest='baseline_filepath', default='none', help='Results file from previous run to compare against.')
+    parser.add_argument('-t', dest='tolerance', default=0.2, help='Fraction slower/larger than baseline that counts as a regression. Default 0.2')
+
+    args = parser.parse_args()
+
+    if args.stages == 'all':
+        stages = STAGE_NAMES
+    else:
+        stages = [stage.strip() for stage in args.stages.split(',')]
+        unknown_stages = [stage for stage in stages if stage not in STAGE_NAMES]
+        if len(unknown_stages) > 0:
+            print "Unknown stages {}. Must be in {}".format(unknown_stages, STAGE_NAMES)
+            sys.exit(ExitReason.bad_arguments)
+
+    use_synthetic_stage1 = args.synthetic_stage1.lower() == 'true'
+
+    results = []
+    for field_size in args.field_sizes.split(','):
+        try:
+            num_rows, plants_per_row = [int(n) for n in field_size.lower().split('x')]
+        except ValueError:
+            print "Bad field size {}. Must be ROWSxPLANTS_PER_ROW".format(field_size)
+            sys.exit(ExitReason.bad_arguments)
+
+        settings = FieldSettings(num_rows=num_rows, plants_per_row=plants_per_row, missing_plant_fraction=float(args.missing_plant_fraction),
+                                 plant_jitter=float(args.plant_jitter) / 100.0, seed=int(args.seed))
+        field_directory = os.path.join(args.output_directory, 'field_{}x{}'.format(num_rows, plants_per_row))
+
+        results += benchmark_field(field_directory, settings, stages, use_synthetic_stage1)
+
+    results_filepath = os.path.join(args.output_directory, time.strftime('benchmark-%Y%m%d-%H%M%S.csv'))
+    write_results(results_filepath, results)
+    print "\nWrote results to {}".format(results_filepath)
+
+    failed_results = [result for result in results if result['exit_code'] != ExitReason.success]
+    if len(failed_results) > 0:
+        print "{} stages failed.".format(len(failed_results))
+        sys.exit(1)
+
+    if args.baseline_filepath != 'none':
+        regressions = compare_to_baseline(results, read_results(args.baseline_filepath), float(args.tolerance))
+        if len(regressions) > 0:
+            print "\nFound {} regressions:".format(len(regressions))
+            for regression in regressions:
+                print regression
+            sys.exit(1)
+        print "\nNo regressions."
+
+    sys.exit(ExitReason.success)
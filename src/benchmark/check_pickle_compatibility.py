@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+import sys
+import argparse
+import pickle
+import copy_reg
+
+# non-default import
+import numpy as np
+
+# Project imports
+from src.data.field_item import FieldItem, Plant
+
+class OldPickledObject(object):
+    '''Pickles as an instance of cls with a dictionary state, which is how field items were saved before they used slots.'''
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+    def __reduce_ex__(self, protocol):
+        return (copy_reg._reconstructor, (self.cls, object, None), self.state)
+
+def old_plant_state(name, position, other_items, row=0, range_grid=0, number_within_field=0, number_within_row=0):
+    '''Return dictionary state of plant the way it was saved before references shared fields.'''
+    return {'name': name, '_position': position, 'zone': '14S', '_field_position': (0, 0, 0), '_row': row, '_range': range_grid,
+            '_number_within_field': number_within_field, '_number_within_row': number_within_row, '_other_items': other_items,
+            '_is_gap_item': False, 'image_path': '', 'parent_image_filename': '', 'bounding_rect': None, '_group': None,
+            '_plant_num_in_field': -1, '_plant_num_in_row': -1}
+
+def make_old_plants_pickle():
+    '''Return pickled list of plants (one with a reference that has its own reference) in the format saved before slots.'''
+    nested_ref = OldPickledObject(Plant, old_plant_state('P1', (4.0, 0.0, 0.0), [], row=2, range_grid=5))
+    ref = OldPickledObject(Plant, old_plant_state('P1', (2.0, 0.0, 0.0), [nested_ref], row=2, range_grid=5))
+    # Position of item with references was saved already averaged.
+    plant = OldPickledObject(Plant, old_plant_state('P1', np.array([2.0, 0.0, 0.0]), [ref], row=2, range_grid=5))
+    lone_plant = OldPickledObject(Plant, old_plant_state('P2', (9.0, 1.0, 0.0), [], row=2, range_grid=6))
+    return pickle.dumps([plant, lone_plant], protocol=2)
+
+def check_shared_fields(items):
+    '''Return list of problems found with field items where references don't share fields with the item they belong to.'''
+    problems = []
+    for item in items:
+        for ref in item.all_refs:
+            if ref.shared_item is not item.shared_item:
+                problems.append('Reference of {} is not linked to it.'.format(item.name))
+            elif ref.row != item.row or ref.range != item.range or ref.number_within_field != item.number_within_field:
+                problems.append('Reference of {} has different row/range/number.'.format(item.name))
+    return problems
+
+def check_old_plants():
+    '''Load plants pickled before references shared fields and return list of problems.'''
+    plants = pickle.loads(make_old_plants_pickle())
+    plant, lone_plant = plants
+    problems = []
+
+    if not np.allclose(plant.position, (2.0, 0.0, 0.0)):
+        problems.append('Averaged position changed to {}'.format(plant.position))
+    if plant.measured_position[0] != 2.0 or plant.other_items[0].measured_position[0] != 2.0:
+        problems.append('Measured positions changed.')
+
+    # Set fields the same way stage 5 numbers items and make sure every reference sees them.
+    plant.range = 7
+    plant.number_within_field = 3
+    plant.number_within_row = 1
+    plant.plant_num_in_field = 1
+    plant.plant_num_in_row = 1
+    problems += check_shared_fields(plants)
+    for ref in plant.all_refs + plant.other_items[0].other_items:
+        if ref.plant_num_in_field != 1 or ref.plant_num_in_row != 1 or ref.range != 7:
+            problems.append('Numbers set on {} are not shared with its references.'.format(plant.name))
+            break
+
+    return problems
+
+def field_items_in(obj, found, visited):
+    '''Add every field item (not counting references) inside of nested lists/tuples/dictionaries/objects to found list.'''
+    if id(obj) in visited:
+        return
+    visited.add(id(obj))
+    if isinstance(obj, FieldItem):
+        found.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            field_items_in(value, found, visited)
+    elif isinstance(obj, dict):
+        for value in obj.itervalues():
+            field_items_in(value, found, visited)
+    elif hasattr(obj, '__dict__'):
+        # Rows, groups and segments hold their items as attributes.
+        field_items_in(vars(obj), found, visited)
+
+def check_stage_file(filepath):
+    '''Load every object in stage output file and return list of problems with field items.'''
+    sys.setrecursionlimit(100000)
+    items = []
+    visited = set()
+    with open(filepath, 'rb') as stage_file:
+        while True:
+            try:
+                field_items_in(pickle.load(stage_file), items, visited)
+            except EOFError:
+                break
+    print "Loaded {} field items from {}".format(len(items), filepath)
+    return check_shared_fields(items)
+
+if __name__ == '__main__':
+    '''Check that field items saved before references shared fields still load correctly.'''
+
+    parser = argparse.ArgumentParser(description='Check that field items saved before references shared fields still load correctly.')
+    parser.add_argument('-f', dest='stage_filepath', default='none', help='Optional stage output file (.s2, .s3, .s4) to also check.')
+    args = parser.parse_args()
+
+    problems = check_old_plants()
+    if args.stage_filepath.lower() != 'none':
+        problems += check_stage_file(args.stage_filepath)
+
+    for problem in problems:
+        print problem
+
+    if len(problems) > 0:
+        print "Found {} problems.".format(len(problems))
+        sys.exit(1)
+
+    print "Old field items load correctly."
+    sys.exit(0)
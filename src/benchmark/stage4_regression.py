@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+import csv
+import time
+import math
+
+# non-default import
+import numpy as np
+
+# Project imports
+from src.benchmark.synthetic_field import parse_ground_truth_file
+from src.benchmark.benchmark_stages import run_stage
+from src.util.stage_io import unpickle_stage4_output
+from src.processing.item_processing import all_segments_from_rows
+from src.stages.exit_reason import ExitReason
+
+# Stage 4 arguments that are used for every configuration unless overridden.
+DEFAULT_STAGE4_ARGS = {'max_plant_size': 30,
+                       'max_plant_part_distance': 8,
+                       'plant_spacing': 30,
+                       'start_code_spacing': 30,
+                       'end_code_spacing': 30,
+                       'single_max_dist': 20,
+                       'stick_multiplier': 2,
+                       'leaf_multiplier': 1.5,
+                       'tag_multiplier': 4,
+                       'lateral_penalty': 1,
+                       'projection_penalty': 1,
+                       'closeness_penalty': 1,
+                       'spacing_filter_thresh': 1.5,
+                       'extract_images': 'false',
+                       'num_processes': 1,
+                       'split_processes': 1,
+                       'fuse_distance': 0,
+                       'localization_engine': 'recursive',
+                       'marked_image': 'false',
+                       'marked_image_scale': 1,
+                       'marked_image_quality': 0}
+
+def parse_configuration_file(config_filepath):
+    '''
+    Return list of (name, stage 4 argument dictionary) tuples. First column of file must be 'name' and the rest
+    of the header must be stage 4 argument names.  Empty fields use the default value.
+    '''
+    configurations = []
+    with open(config_filepath, 'r') as config_file:
+        reader = csv.DictReader(config_file)
+        for fields in reader:
+            name = fields.pop('name')
+            stage_args = DEFAULT_STAGE4_ARGS.copy()
+            for key, value in fields.iteritems():
+                if key not in stage_args:
+                    raise ValueError('Unknown stage 4 argument {} in configuration {}'.format(key, name))
+                if value is not None and value.strip():
+                    stage_args[key] = value.strip()
+            configurations.append((name, stage_args))
+    return configurations
+
+def located_plants_from_rows(rows):
+    '''Return list of plants (found and created) in the order they're stored in the row segments.'''
+    plants = []
+    for segment in all_segments_from_rows(rows):
+        for item in segment.items:
+            if 'plant' in item.type.lower():
+                plants.append(item)
+    return plants
+
+def match_plants(plant_positions, truth_positions, max_distance):
+    '''
+    Greedily match closest pairs of located plants and true plants that are within max distance (meters).
+    Return list of (plant index, truth index, distance).
+    '''
+    if len(plant_positions) == 0 or len(truth_positions) == 0:
+        return []
+
+    plant_positions = np.array(plant_positions, dtype=np.float64)[:, :2]
+    truth_positions = np.array(truth_positions, dtype=np.float64)[:, :2]
+
+    # Only compare plants to true plants in the same or neighboring max distance sized grid cells so large fields
+    # don't need a distance for every pair.
+    cell_size = max_distance if max_distance > 0 else 1.0
+    plant_cells = np.floor(plant_positions / cell_size).astype(np.int64)
+    truth_cells = np.floor(truth_positions / cell_size).astype(np.int64)
+    # Shift cells so neighbors of every cell have non-negative coordinates and can be combined into one key.
+    min_cell = np.minimum(plant_cells.min(axis=0), truth_cells.min(axis=0)) - 1
+    plant_cells -= min_cell
+    truth_cells -= min_cell
+    num_y_cells = max(plant_cells[:, 1].max(), truth_cells[:, 1].max()) + 2
+    truth_keys = truth_cells[:, 0] * num_y_cells + truth_cells[:, 1]
+    truth_order = np.argsort(truth_keys, kind='mergesort')
+    sorted_truth_keys = truth_keys[truth_order]
+
+    plant_indices = []
+    truth_indices = []
+    for x_offset in (-1, 0, 1):
+        for y_offset in (-1, 0, 1):
+            keys = (plant_cells[:, 0] + x_offset) * num_y_cells + plant_cells[:, 1] + y_offset
+            firsts = np.searchsorted(sorted_truth_keys, keys, side='left')
+            counts = np.searchsorted(sorted_truth_keys, keys, side='right') - firsts
+            plant_indices.append(np.repeat(np.arange(len(plant_positions)), counts))
+            truth_indices.append(truth_order[np.arange(counts.sum()) + np.repeat(firsts - np.cumsum(counts) + counts, counts)])
+    plant_indices = np.concatenate(plant_indices)
+    truth_indices = np.concatenate(truth_indices)
+
+    deltas = plant_positions[plant_indices] - truth_positions[truth_indices]
+    distances = np.sqrt(np.sum(deltas * deltas, axis=1))
+    close = distances <= max_distance
+    candidate_pairs = np.column_stack((plant_indices[close], truth_indices[close]))
+    candidate_distances = distances[close]
+    # Closest pairs first.  Ties are in plant then true plant order, the same as comparing every pair.
+    order = np.lexsort((candidate_pairs[:, 1], candidate_pairs[:, 0], candidate_distances))
+
+    matches = []
+    matched_plants = set()
+    matched_truths = set()
+    for k in order:
+        plant_index, truth_index = candidate_pairs[k]
+        if plant_index in matched_plants or truth_index in matched_truths:
+            continue
+        matched_plants.add(plant_index)
+        matched_truths.add(truth_index)
+        matches.append((plant_index, truth_index, candidate_distances[k]))
+
+    return matches
+
+def evaluate_plants(plants, truth_items, max_distance):
+    '''Return dictionary of accuracy statistics for located plants compared to ground truth.'''
+    truth_plants = [item for item in truth_items if item.item_type == 'Plant']
+    matches = match_plants([plant.position for plant in plants], [(item.easting, item.northing) for item in truth_plants], max_distance)
+
+    num_created = len([plant for plant in plants if plant.type == 'CreatedPlant'])
+    num_matched_created = len([m for m in matches if plants[m[0]].type == 'CreatedPlant'])
+    errors = [m[2] for m in matches]
+
+    return {'num_plants': len(plants),
+            'num_truth': len(truth_plants),
+            'num_matched': len(matches),
+            'num_created': num_created,
+            'num_matched_created': num_matched_created,
+            'precision': len(matches) / float(len(plants)) if len(plants) > 0 else 0,
+            'recall': len(matches) / float(len(truth_plants)) if len(truth_plants) > 0 else 0,
+            'mean_error_cm': np.mean(errors) * 100 if len(errors) > 0 else 0,
+            'max_error_cm': np.max(errors) * 100 if len(errors) > 0 else 0}
+
+def write_plant_positions(out_filepath, plants):
+    '''Write out position of each located plant so that future runs can be compared to this one.'''
+    with open(out_filepath, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['index', 'type', 'row', 'easting', 'northing'])
+        for k, plant in enumerate(plants):
+            writer.writerow([k, plant.type, plant.row, '{:.6f}'.format(plant.position[0]), '{:.6f}'.format(plant.position[1])])
+
+def read_plant_positions(in_filepath):
+    '''Return list of (type, row, easting, northing) tuples written by write_plant_positions.'''
+    positions = []
+    with open(in_filepath, 'r') as in_file:
+        for fields in csv.DictReader(in_file):
+            positions.append((fields['type'], int(fields['row']), float(fields['easting']), float(fields['northing'])))
+    return positions
+
+def compare_plant_positions(positions, reference_positions, tolerance):
+    '''Return list of descriptions of differences between two runs. Empty if plants are the same within tolerance (meters).'''
+    differences = []
+    if len(positions) != len(reference_positions):
+        differences.append('Located {} plants but reference has {}'.format(len(positions), len(reference_positions)))
+    for k, (position, reference) in enumerate(zip(positions, reference_positions)):
+        if position[0] != reference[0] or position[1] != reference[1]:
+            differences.append('Plant {} is {} in row {} but reference is {} in row {}'.format(k, position[0], position[1], reference[0], reference[1]))
+            continue
+        distance = math.sqrt((position[2] - reference[2])**2 + (position[3] - reference[3])**2)
+        if distance > tolerance:
+            differences.append('Plant {} moved {:.4f} meters from reference'.format(k, distance))
+    return differences
+
+# Columns in results file.
+RESULT_HEADER = ['configuration', 'exit_code', 'wall_time', 'peak_memory_mb', 'num_plants', 'num_truth', 'num_matched',
+                 'num_created', 'num_matched_created', 'precision', 'recall', 'mean_error_cm', 'max_error_cm']
+
+if __name__ == '__main__':
+    '''Run stage 4 with different configurations and report accuracy and speed.'''
+
+    parser = argparse.ArgumentParser(description='''Run stage 4 with different configurations and report accuracy and speed.''')
+    parser.add_argument('input_filepath', help='pickled file from stage 3.')
+    parser.add_argument('ground_truth_filepath', help='CSV file of true item positions in same format as synthetic field ground truth.')
+    parser.add_argument('output_directory', help='where to write output files')
+    parser.add_argument('-c', dest='config_filepath', default='none', help='CSV file with name column followed by stage 4 argument columns. One configuration per line. Default is to only run default arguments.')
+    parser.add_argument('-md', dest='match_distance', default=5, help='Maximum distance (in centimeters) a located plant can be from a true plant to count as a match. Default 5.')
+    parser.add_argument('-r', dest='reference_directory', default='none', help='Output directory of previous run. Plant positions of each configuration are checked against it.')
+    parser.add_argument('-rt', dest='reference_tolerance', default=0.1, help='Distance (in centimeters) a plant can move from reference before it counts as different. Default 0.1')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input_filepath):
+        print "Input file doesn't exist {}".format(args.input_filepath)
+        sys.exit(ExitReason.bad_arguments)
+
+    truth_items = parse_ground_truth_file(args.ground_truth_filepath)
+    match_distance = float(args.match_distance) / 100.0
+    reference_tolerance = float(args.reference_tolerance) / 100.0
+
+    if args.config_filepath == 'none':
+        configurations = [('default', DEFAULT_STAGE4_ARGS.copy())]
+    else:
+        configurations = parse_configuration_file(args.config_filepath)
+
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    results = []
+    all_differences = []
+    for name, stage_args in configurations:
+        config_directory = os.path.join(args.output_directory, name)
+        if not os.path.exists(config_directory):
+            os.makedirs(config_directory)
+
+        stage_args['input_filepath'] = args.input_filepath
+        stage_args['output_directory'] = config_directory
+
+        print "Running configuration {}".format(name)
+        exit_code, wall_time, peak_memory = run_stage('stage4', stage_args, os.path.join(config_directory, 'stage4_log.txt'))
+
+        result = {'configuration': name, 'exit_code': exit_code, 'wall_time': wall_time, 'peak_memory_mb': peak_memory}
+
+        if exit_code == ExitReason.success:
+            rows = unpickle_stage4_output(os.path.join(config_directory, 'stage4_output.s4'))
+            plants = located_plants_from_rows(rows)
+            result.update(evaluate_plants(plants, truth_items, match_distance))
+
+            positions_filepath = os.path.join(config_directory, 'plant_positions.csv')
+            write_plant_positions(positions_filepath, plants)
+
+            if args.reference_directory != 'none':
+                reference_filepath = os.path.join(args.reference_directory, name, 'plant_positions.csv')
+                if not os.path.exists(reference_filepath):
+                    print "No reference for configuration {}".format(name)
+                else:
+                    differences = compare_plant_positions(read_plant_positions(positions_filepath), read_plant_positions(reference_filepath), reference_tolerance)
+                    all_differences += ['{}: {}'.format(name, difference) for difference in differences]
+
+            print "{} precision {:.3f} recall {:.3f} created {} mean error {:.2f} cm in {:.2f} seconds".format(name, result['precision'], result['recall'],
+                                                                                                       result['num_created'], result['mean_error_cm'], wall_time)
+        else:
+            print "{} failed with exit code {}".format(name, exit_code)
+
+        results.append(result)
+
+    results_filepath = os.path.join(args.output_directory, time.strftime('stage4_regression-%Y%m%d-%H%M%S.csv'))
+    with open(results_filepath, 'wb') as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_HEADER)
+        writer.writeheader()
+        writer.writerows(results)
+    print "\nWrote results to {}".format(results_filepath)
+
+    if len([result for result in results if result['exit_code'] != ExitReason.success]) > 0:
+        sys.exit(1)
+
+    if args.reference_directory != 'none':
+        if len(all_differences) > 0:
+            print "\nFound {} differences from reference:".format(len(all_differences))
+            for difference in all_differences:
+                print difference
+            sys.exit(1)
+        print "\nAll plants match reference."
+
+    sys.exit(ExitReason.success)
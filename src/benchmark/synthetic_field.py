@@ -0,0 +1,434 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+import csv
+import math
+import hashlib
+from collections import namedtuple
+
+# OpenCV imports
+import cv2
+import numpy as np
+
+# non-default import
+import utm
+
+# Optional import. Without it codes are drawn with a pseudo QR pattern that can't be decoded.
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# Project imports
+from src.data.geo_image import GeoImage
+from src.data.field_item import RowCode, GroupCode
+from src.extraction.item_extraction import calculate_position_pixels, calculate_item_position
+from src.util.parsing import parse_geo_file
+from src.util.image_utils import list_images, verify_geo_images
+
+# Item placed in field at a known position.  Parts is a list of (part_type, world polygon) for plants.
+SyntheticItem = namedtuple('SyntheticItem', 'item_type name row group easting northing field_x field_y parts')
+
+# Image that should be taken of the field.
+SyntheticImage = namedtuple('SyntheticImage', 'file_name image_time lat lon easting northing heading_degrees row')
+
+# BGR colors that fall inside the HSV thresholds used by the finders.
+SOIL_COLOR = (60, 80, 100)
+LEAF_COLOR = (30, 150, 40)
+STICK_COLOR = (180, 90, 20)
+TAG_COLOR = (20, 210, 230)
+CODE_WHITE = (245, 245, 245)
+CODE_BLACK = (20, 20, 20)
+
+class FieldSettings(object):
+    '''Describes how to lay out a synthetic field.  All distances in meters unless noted.'''
+    def __init__(self, num_rows=4, plants_per_row=20, plants_per_group=8, rows_per_pass=1, row_spacing=0.9, plant_spacing=0.3,
+                 code_spacing=0.3, code_size=10, field_direction=90, origin_lat=39.1836, origin_lon=-96.5717, altitude=300.0,
+                 resolution=0.25, image_width=640, image_height=480, image_overlap=0.5, image_period=0.5, camera_height=150,
+                 missing_plant_fraction=0.0, plant_jitter=0.0, seed=0):
+        self.num_rows = num_rows
+        self.plants_per_row = plants_per_row
+        self.plants_per_group = plants_per_group
+        self.rows_per_pass = rows_per_pass # how many neighboring rows are planted in the same direction.
+        self.row_spacing = row_spacing
+        self.plant_spacing = plant_spacing
+        self.code_spacing = code_spacing # distance between a code and the plant next to it.
+        self.code_size = code_size # side length of codes in centimeters.
+        self.field_direction = field_direction # degrees with 0 being East and increasing CCW.
+        self.origin_lat = origin_lat
+        self.origin_lon = origin_lon
+        self.altitude = altitude # altitude of camera in meters.
+        self.resolution = resolution # centimeters per pixel.
+        self.image_width = image_width # pixels
+        self.image_height = image_height # pixels
+        self.image_overlap = image_overlap # fraction of image shared with next image along the row.
+        self.image_period = image_period # seconds between images.
+        self.camera_height = camera_height # centimeters above ground.
+        self.missing_plant_fraction = missing_plant_fraction # fraction of plants that didn't come up. Space is still left for them.
+        self.plant_jitter = plant_jitter # standard deviation of how far plants are from their spacing along the row.
+        self.seed = seed
+
+def row_direction(row_number, rows_per_pass):
+    '''Return 'up' if row is planted in the field direction or 'back' if opposite.'''
+    pass_index = (row_number - 1) // rows_per_pass
+    return 'up' if pass_index % 2 == 0 else 'back'
+
+def generate_field_layout(settings):
+    '''Return list of SyntheticItems for every code and plant in the field.'''
+
+    random = np.random.RandomState(settings.seed)
+
+    origin_easting, origin_northing, zone_number, zone_letter = utm.from_latlon(settings.origin_lat, settings.origin_lon)
+
+    angle = math.radians(settings.field_direction)
+    along = (math.cos(angle), math.sin(angle)) # unit vector running up the rows
+    across = (math.sin(angle), -math.cos(angle)) # unit vector running across rows
+
+    def field_to_utm(field_x, field_y):
+        easting = origin_easting + field_x * across[0] + field_y * along[0]
+        northing = origin_northing + field_x * across[1] + field_y * along[1]
+        return easting, northing
+
+    items = []
+    for row_number in range(1, settings.num_rows + 1):
+
+        # Distances along planting direction of every item in row.
+        planted = [('RowCode', '{}St'.format(row_number), None, 0.0)]
+        distance = 0.0
+        group_number = 0
+        for plant_index in range(settings.plants_per_row):
+            if plant_index % settings.plants_per_group == 0:
+                group_number += 1
+                group_name = 'G{:03d}{:02d}'.format(row_number, group_number)
+                distance += settings.code_spacing
+                planted.append(('GroupCode', group_name, group_name, distance))
+                distance += settings.code_spacing
+            else:
+                distance += settings.plant_spacing
+            if random.rand() < settings.missing_plant_fraction:
+                continue
+            # Seeds aren't planted exactly plant spacing apart.  Only draw when enabled so other fields stay the same.
+            jitter = random.normal(0, settings.plant_jitter) if settings.plant_jitter > 0 else 0.0
+            planted.append(('Plant', 'plant', group_name, distance + jitter))
+        distance += settings.code_spacing
+        planted.append(('RowCode', '{}En'.format(row_number), None, distance))
+        row_length = distance
+
+        field_x = (row_number - 1) * settings.row_spacing
+        up = row_direction(row_number, settings.rows_per_pass) == 'up'
+        for item_type, name, group, planted_distance in planted:
+            field_y = planted_distance if up else row_length - planted_distance
+            easting, northing = field_to_utm(field_x, field_y)
+            parts = []
+            if item_type == 'Plant':
+                parts = generate_plant_parts(easting, northing, random)
+            items.append(SyntheticItem(item_type, name, row_number, group, easting, northing, field_x, field_y, parts))
+
+    return items
+
+def generate_plant_parts(easting, northing, random):
+    '''Return list of (part_type, world polygon) for a plant centered on easting/northing.'''
+    parts = []
+
+    num_leaves = random.randint(2, 5)
+    for _ in range(num_leaves):
+        leaf_angle = random.uniform(0, 2 * math.pi)
+        leaf_length = random.uniform(0.05, 0.09)
+        leaf_width = random.uniform(0.02, 0.035)
+        # Leaf grows out from stem so shift its center out along its angle.
+        cx = easting + math.cos(leaf_angle) * leaf_length * 0.6
+        cy = northing + math.sin(leaf_angle) * leaf_length * 0.6
+        parts.append(('leaf', ellipse_polygon(cx, cy, leaf_length / 2.0, leaf_width / 2.0, leaf_angle)))
+
+    stick_angle = random.uniform(0, math.pi)
+    parts.append(('stick_part', rectangle_polygon(easting, northing, 0.045, 0.015, stick_angle)))
+
+    tag_angle = stick_angle + math.pi / 2
+    tx = easting + math.cos(tag_angle) * 0.03
+    ty = northing + math.sin(tag_angle) * 0.03
+    parts.append(('tag', rectangle_polygon(tx, ty, 0.035, 0.02, stick_angle)))
+
+    return parts
+
+def ellipse_polygon(cx, cy, semi_major, semi_minor, angle, num_points=16):
+    '''Return Nx2 array of world points around an ellipse.'''
+    t = np.linspace(0, 2 * math.pi, num_points, endpoint=False)
+    x = semi_major * np.cos(t)
+    y = semi_minor * np.sin(t)
+    return np.column_stack([cx + x * math.cos(angle) - y * math.sin(angle),
+                            cy + x * math.sin(angle) + y * math.cos(angle)])
+
+def rectangle_polygon(cx, cy, length, width, angle):
+    '''Return 4x2 array of world corners of a rotated rectangle.'''
+    x = np.array([-length, length, length, -length]) / 2.0
+    y = np.array([-width, -width, width, width]) / 2.0
+    return np.column_stack([cx + x * math.cos(angle) - y * math.sin(angle),
+                            cy + x * math.sin(angle) + y * math.cos(angle)])
+
+def generate_image_path(items, settings):
+    '''Return list of SyntheticImages following each row in the direction it was planted.'''
+
+    angle = math.radians(settings.field_direction)
+    along = (math.cos(angle), math.sin(angle))
+
+    image_spacing = settings.image_height * settings.resolution / 100.0 * (1.0 - settings.image_overlap)
+
+    _, _, zone_number, zone_letter = utm.from_latlon(settings.origin_lat, settings.origin_lon)
+
+    images = []
+    image_time = 1000000000.0
+    for row_number in range(1, settings.num_rows + 1):
+        row_items = [item for item in items if item.row == row_number]
+        start_code = [item for item in row_items if item.name.endswith('St')][0]
+        end_code = [item for item in row_items if item.name.endswith('En')][0]
+        row_length = math.sqrt((end_code.easting - start_code.easting)**2 + (end_code.northing - start_code.northing)**2)
+
+        # Drive along planting direction so the start code is imaged first.
+        up = row_direction(row_number, settings.rows_per_pass) == 'up'
+        heading = settings.field_direction if up else settings.field_direction + 180
+        heading = heading % 360
+        direction = 1.0 if up else -1.0
+
+        distance = -image_spacing
+        while distance <= row_length + image_spacing:
+            easting = start_code.easting + direction * distance * along[0]
+            northing = start_code.northing + direction * distance * along[1]
+            # Conversion to lat/lon and back isn't exact so use the same position that will be parsed from geo file.
+            lat, lon = utm.to_latlon(easting, northing, zone_number, zone_letter)
+            easting, northing, _, _ = utm.from_latlon(lat, lon)
+            file_name = 'IMG_{:06d}'.format(len(images) + 1)
+            images.append(SyntheticImage(file_name, image_time, lat, lon, easting, northing, heading, row_number))
+            image_time += settings.image_period
+            distance += image_spacing
+
+        # Time to turn around at end of row.
+        image_time += 10.0
+
+    return images
+
+def code_pattern(name):
+    '''Return 2D boolean array of code modules (True is black) without a quiet zone.'''
+    if qrcode is not None:
+        code = qrcode.QRCode(border=0)
+        code.add_data(name)
+        code.make(fit=True)
+        return np.array(code.get_matrix(), dtype=bool)
+
+    # Pseudo QR code with finder patterns and modules seeded from the name so it's repeatable.
+    size = 21
+    seed = int(hashlib.md5(name).hexdigest()[:8], 16)
+    modules = np.random.RandomState(seed).rand(size, size) > 0.5
+    finder = np.ones((7, 7), dtype=bool)
+    finder[1:6, 1:6] = False
+    finder[2:5, 2:5] = True
+    for r, c in [(0, 0), (0, size - 7), (size - 7, 0)]:
+        modules[r:r+7, c:c+7] = finder
+    return modules
+
+def render_image(synthetic_image, items, settings, code_patterns):
+    '''Return BGR image of the field as seen by the synthetic image.'''
+
+    geo_image = GeoImage(synthetic_image.file_name, position=(synthetic_image.easting, synthetic_image.northing, settings.altitude),
+                         heading_degrees=synthetic_image.heading_degrees, resolution=settings.resolution,
+                         size=(settings.image_width, settings.image_height))
+
+    random = np.random.RandomState(int(synthetic_image.image_time * 10) % 4294967295)
+    image = np.empty((settings.image_height, settings.image_width, 3), np.uint8)
+    image[:] = SOIL_COLOR
+    noise = random.randint(-6, 7, image.shape)
+    image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    # Only draw items that could show up in the image.
+    reach = math.sqrt(settings.image_width**2 + settings.image_height**2) * settings.resolution / 100.0
+    nearby_items = [item for item in items if abs(item.easting - synthetic_image.easting) < reach
+                                           and abs(item.northing - synthetic_image.northing) < reach]
+
+    for item in nearby_items:
+        if item.item_type == 'Plant':
+            # Draw leaves first so sticks and tags show up on top of them.
+            for part_type in ['leaf', 'stick_part', 'tag']:
+                color = {'leaf': LEAF_COLOR, 'stick_part': STICK_COLOR, 'tag': TAG_COLOR}[part_type]
+                for _, polygon in [p for p in item.parts if p[0] == part_type]:
+                    px, py = calculate_position_pixels(polygon[:,0], polygon[:,1], geo_image)
+                    points = np.round(np.column_stack([px, py])).astype(np.int32)
+                    cv2.fillConvexPoly(image, points, color)
+        else:
+            draw_code(image, item, geo_image, settings, code_patterns[item.name])
+
+    return image
+
+def draw_code(image, item, geo_image, settings, pattern):
+    '''Draw code with a white quiet zone centered on the item position.  Codes are drawn aligned with the image.'''
+
+    cx, cy = calculate_position_pixels([item.easting], [item.northing], geo_image)
+    cx = int(round(cx[0]))
+    cy = int(round(cy[0]))
+
+    side = int(round(settings.code_size / settings.resolution))
+    module_size = max(1, side // (pattern.shape[0] + 2))
+    quiet_side = module_size * (pattern.shape[0] + 2)
+
+    code_image = np.empty((quiet_side, quiet_side, 3), np.uint8)
+    code_image[:] = CODE_WHITE
+    modules = np.kron(pattern, np.ones((module_size, module_size), dtype=bool))
+    code_image[module_size:module_size+modules.shape[0], module_size:module_size+modules.shape[1]][modules] = CODE_BLACK
+
+    # Paste code clipped to the image borders.
+    top = cy - quiet_side // 2
+    left = cx - quiet_side // 2
+    image_h, image_w = image.shape[:2]
+    y1 = max(0, top)
+    x1 = max(0, left)
+    y2 = min(image_h, top + quiet_side)
+    x2 = min(image_w, left + quiet_side)
+    if y1 >= y2 or x1 >= x2:
+        return
+    image[y1:y2, x1:x2] = code_image[y1-top:y2-top, x1-left:x2-left]
+
+def write_geo_file(geo_filepath, synthetic_images, settings):
+    '''Write images out in the format read by parse_geo_file.'''
+    with open(geo_filepath, 'w') as geo_file:
+        for synthetic_image in synthetic_images:
+            geo_file.write('{:.4f},{!r},{!r},{:.3f},{:.4f},{:.4f},{:.4f},{}.jpg\n'.format(synthetic_image.image_time, synthetic_image.lat, synthetic_image.lon, settings.altitude,
+                                                                                            0, 0, synthetic_image.heading_degrees, synthetic_image.file_name))
+
+def write_ground_truth_file(ground_truth_filepath, items):
+    '''Write known position of every code and plant to CSV file.'''
+    with open(ground_truth_filepath, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['item_type', 'name', 'row', 'group', 'easting', 'northing', 'field_x', 'field_y'])
+        for item in items:
+            writer.writerow([item.item_type, item.name, item.row, item.group or '', '{:.4f}'.format(item.easting),
+                             '{:.4f}'.format(item.northing), '{:.4f}'.format(item.field_x), '{:.4f}'.format(item.field_y)])
+
+def parse_ground_truth_file(ground_truth_filepath):
+    '''Return list of SyntheticItems (without parts) read in from ground truth file.'''
+    items = []
+    with open(ground_truth_filepath, 'r') as in_file:
+        reader = csv.reader(in_file)
+        for fields in reader:
+            if len(fields) == 0 or fields[0] == 'item_type':
+                continue
+            try:
+                items.append(SyntheticItem(fields[0], fields[1], int(fields[2]), fields[3] or None, float(fields[4]),
+                                           float(fields[5]), float(fields[6]), float(fields[7]), []))
+            except (IndexError, ValueError) as e:
+                print 'Bad line: {}. Exception {}'.format(fields, e)
+                continue
+    return items
+
+def generate_field(out_directory, settings):
+    '''
+    Render images and write geo/ground truth files for a synthetic field.
+    Return tuple of (image directory, geo filepath, ground truth filepath).
+    '''
+    image_directory = os.path.join(out_directory, 'images')
+    if not os.path.exists(image_directory):
+        os.makedirs(image_directory)
+
+    items = generate_field_layout(settings)
+    synthetic_images = generate_image_path(items, settings)
+
+    code_patterns = {item.name: code_pattern(item.name) for item in items if item.item_type != 'Plant'}
+
+    for synthetic_image in synthetic_images:
+        image = render_image(synthetic_image, items, settings, code_patterns)
+        cv2.imwrite(os.path.join(image_directory, synthetic_image.file_name + '.jpg'), image)
+
+    geo_filepath = os.path.join(out_directory, 'image_geo.csv')
+    write_geo_file(geo_filepath, synthetic_images, settings)
+
+    ground_truth_filepath = os.path.join(out_directory, 'ground_truth.csv')
+    write_ground_truth_file(ground_truth_filepath, items)
+
+    return image_directory, geo_filepath, ground_truth_filepath
+
+def write_stage1_output(out_directory, image_directory, geo_filepath, ground_truth_filepath, settings):
+    '''
+    Write out stage 1 output using known code positions instead of scanning images.  This way later stages can
+    be run even if codes can't be decoded.  Return output filepath.
+    '''
+    # Only needed when running the pipeline.
+    from src.processing.item_processing import calculate_geo_images_corners
+    from src.util.stage_io import pickle_results
+
+    geo_images = parse_geo_file(geo_filepath, settings.resolution, settings.camera_height)
+    geo_images = sorted(geo_images, key=lambda image: image.image_time)
+    geo_images, _ = verify_geo_images(geo_images, list_images(image_directory, ['jpg']))
+
+    code_items = [item for item in parse_ground_truth_file(ground_truth_filepath) if item.item_type != 'Plant']
+
+    side = settings.code_size / settings.resolution
+    for geo_image in geo_images:
+        geo_image.file_path = os.path.join(image_directory, geo_image.file_name)
+        geo_image.width = settings.image_width
+        geo_image.height = settings.image_height
+    calculate_geo_images_corners(geo_images)
+
+    codes = []
+    for geo_image in geo_images:
+        px, py = calculate_position_pixels([c.easting for c in code_items], [c.northing for c in code_items], geo_image)
+        image_codes = []
+        for code_item, x, y in zip(code_items, px, py):
+            # Same as stage 1, skip codes that touch image border.
+            if x - side / 2 <= 1 or y - side / 2 <= 1 or x + side / 2 >= geo_image.width - 1 or y + side / 2 >= geo_image.height - 1:
+                continue
+            if code_item.item_type == 'RowCode':
+                code = RowCode(name=code_item.name)
+                code.row = int(code_item.name[:-2])
+            else:
+                code = GroupCode(name=code_item.name)
+            code.bounding_rect = ((x, y), (side, side), -90.0)
+            code.parent_image_filename = geo_image.file_name
+            code.position = calculate_item_position(code, geo_image)
+            code.zone = geo_image.zone
+            image_codes.append(code)
+
+        geo_image.items['codes'] = image_codes
+        codes += image_codes
+
+    if not os.path.exists(out_directory):
+        os.makedirs(out_directory)
+
+    dump_filename = "stage1_output_synthetic_{}_{}.s1".format(int(geo_images[0].image_time), int(geo_images[-1].image_time))
+    pickle_results(dump_filename, out_directory, geo_images, codes)
+
+    return os.path.join(out_directory, dump_filename)
+
+if __name__ == '__main__':
+    '''Generate images, geo file and ground truth for a synthetic field.'''
+
+    parser = argparse.ArgumentParser(description='''Generate images, geo file and ground truth for a synthetic field.''')
+    parser.add_argument('output_directory', help='where to write images and files')
+    parser.add_argument('num_rows', help='how many rows are in the field.')
+    parser.add_argument('plants_per_row', help='how many plants are in each row.')
+    parser.add_argument('-pg', dest='plants_per_group', default=8, help='How many plants are between group codes. Default 8.')
+    parser.add_argument('-rp', dest='rows_per_pass', default=1, help='How many rows are planted in each field pass. Default 1.')
+    parser.add_argument('-ps', dest='plant_spacing', default=30, help='Distance (in centimeters) between plants. Default 30.')
+    parser.add_argument('-rs', dest='resolution', default=0.25, help='Image resolution in centimeter/pixel. Default 0.25.')
+    parser.add_argument('-mp', dest='missing_plant_fraction', default=0, help='Fraction of plants to leave out. Default 0.')
+    parser.add_argument('-pj', dest='plant_jitter', default=0, help='Standard deviation (in centimeters) of plant positions along the row from even spacing. Default 0.')
+    parser.add_argument('-sd', dest='seed', default=0, help='Seed for random plant shapes. Default 0.')
+    parser.add_argument('-s1', dest='stage1_output', default='false', help='If true then also write stage 1 output using known code positions. Default false.')
+
+    args = parser.parse_args()
+
+    settings = FieldSettings(num_rows=int(args.num_rows), plants_per_row=int(args.plants_per_row), plants_per_group=int(args.plants_per_group),
+                             rows_per_pass=int(args.rows_per_pass), plant_spacing=float(args.plant_spacing) / 100.0,
+                             resolution=float(args.resolution), missing_plant_fraction=float(args.missing_plant_fraction),
+                             plant_jitter=float(args.plant_jitter) / 100.0, seed=int(args.seed))
+
+    if qrcode is None:
+        print "qrcode module not found so codes will not be readable by stage 1."
+
+    image_directory, geo_filepath, ground_truth_filepath = generate_field(args.output_directory, settings)
+
+    print "Wrote images to {}".format(image_directory)
+    print "Wrote geo file to {}".format(geo_filepath)
+    print "Wrote ground truth to {}".format(ground_truth_filepath)
+
+    if args.stage1_output.lower() == 'true':
+        stage1_filepath = write_stage1_output(os.path.join(args.output_directory, 'stage1'), image_directory, geo_filepath, ground_truth_filepath, settings)
+        print "Wrote stage 1 output to {}".format(stage1_filepath)
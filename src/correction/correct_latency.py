@@ -141,17 +141,17 @@ def analyze_set(image_set, time_offset):
     # calculate least squares error sum 
     for item in merged_codes:
         item_references = [item] + item.other_items
-        avg_x = np.mean([it.position[0] for it in item_references])
-        avg_y = np.mean([it.position[1] for it in item_references])
-        avg_z = np.mean([it.position[2] for it in item_references])
+        avg_x = np.mean([it.measured_position[0] for it in item_references])
+        avg_y = np.mean([it.measured_position[1] for it in item_references])
+        avg_z = np.mean([it.measured_position[2] for it in item_references])
     
         if len(item.other_items) > 0:
     
-            distances = [position_difference(item_ref.position, (avg_x, avg_y)) for item_ref in item_references]
+            distances = [position_difference(item_ref.measured_position, (avg_x, avg_y)) for item_ref in item_references]
             
             item_combos = itertools.combinations(item_references, 2)
             for (item1, item2) in item_combos:
-                separation = position_difference(item1.position, item2.position)
+                separation = position_difference(item1.measured_position, item2.measured_position)
                 if separation > max_sep:
                     max_sep = separation
             
@@ -2,8 +2,15 @@
 
 import numpy as np
 
-class FieldItem(object):
+# Project imports
+from src.data.slotted_object import SlottedObject
+
+class FieldItem(SlottedObject):
     '''Item found within image'''
+    __slots__ = ('name', '_position', 'zone', '_field_position', '_row', '_range', '_number_within_field', '_number_within_row',
+                 '_other_items', '_is_gap_item', 'image_path', 'parent_image_filename', 'bounding_rect',
+                 '_owner', '_position_summary', '_field_position_summary')
+    
     def __init__(self, name, position=(0,0,0), field_position=(0,0,0), zone='N/A', size=(0,0), area=0, row=0, range_grid=0,
                   image_path='', parent_image_filename='', bounding_rect=None, number_within_field=0, number_within_row=0):
         '''Constructor.'''
@@ -17,72 +24,127 @@ class FieldItem(object):
         self._number_within_row = number_within_row # Number of item within current row.  Measured from range = 0 side of field.
         self._other_items = [] # same field item from different images.
         self._is_gap_item = False # if true then any group starting with this item (e.g. a code) shouldn't contain any plants.
+        self._owner = None # item that this is a reference of.  Fields like row and range are stored on the owner and shared.
+        
+        # (sum, number of other items in sum, mean) of this item's position and its references. None if it needs to be recalculated.
+        self._position_summary = None
+        self._field_position_summary = None
         
         # Image properties.  May be empty/None if item wasn't found in image.
         self.image_path = image_path # Full path where cropped out image of field item is found.
         self.parent_image_filename = parent_image_filename  # Filename of image where field item was found. Don't store ref since we'll run out of memory.
         self.bounding_rect = bounding_rect # OpenCV minimum rotated bounding rectangle containing item. Units in pixels. No pad added in.
         
+    def __setstate__(self, state):
+        super(FieldItem, self).__setstate__(state)
+        if not hasattr(self, '_position_summary'):
+            # Saved before references shared fields.  Fields were copied to every reference and the position of
+            # an item with references was already averaged so keep it as is.
+            if not hasattr(self, '_owner'):
+                self._owner = None # might have already been set when its owner was loaded.
+            self._position_summary = self._existing_summary(self._position)
+            self._field_position_summary = self._existing_summary(self._field_position)
+            # Link references so fields set on this item are shared with them like they used to be copied.
+            for ref in self._other_items:
+                ref._owner = self
+            
+    def _existing_summary(self, mean):
+        '''Return summary where mean already includes all other items.'''
+        if len(self._other_items) == 0:
+            return None
+        mean = np.array(mean, dtype=np.float64)
+        return mean * (len(self._other_items) + 1), len(self._other_items), mean
+        
     @property
     def other_items(self):
         return self._other_items
     
+    @other_items.setter
+    def other_items(self, new_value):
+        for item in self._other_items:
+            item._owner = None
+        self._other_items = new_value
+        for item in self._other_items:
+            item._owner = self
+        self.refresh_fields()
+    
     @property
     def all_refs(self):
         return [self] + self._other_items
         
+    @property
+    def shared_item(self):
+        '''Return item that stores fields (row, range, etc) shared between all references.'''
+        item = self
+        while item._owner is not None:
+            item = item._owner
+        return item
+        
     def add_other_item(self, other_item):
         if other_item is self:
             raise ValueError("Can't add self as reference.")
         if other_item.type != self.type:
             raise ValueError("Can't add reference to different type.")
-        self.other_items.append(other_item)
-        self.refresh_fields()
+        self._other_items.append(other_item)
+        other_item._owner = self
+        # Don't need to refresh since new references are added to position sums the next time position is read.
         
     def refresh_fields(self):
-        '''Update fields that need to change when a new reference is added or changed'''
-        self.position = np.mean([self._position] + [ref.position for ref in self.other_items], axis=0)
-        self.field_position = np.mean([self._field_position] + [ref.field_position for ref in self.other_items], axis=0)   
+        '''Recalculate averaged fields next time they're read.  Only needed if a reference is changed without using its setters.'''
+        item = self
+        while item is not None:
+            item._position_summary = None
+            item._field_position_summary = None
+            item = item._owner
+            
+    def _updated_summary(self, own_value, summary, attribute):
+        '''
+        Return (sum, number of other items in sum, mean) of own value and the attribute of every other item.
+        Only other items added since the summary was made need to be summed.
+        '''
+        if summary is None:
+            total = np.array(own_value, dtype=np.float64)
+            num_summed = 0
+        else:
+            total, num_summed, mean = summary
+            if num_summed == len(self._other_items):
+                return summary
+        for item in self._other_items[num_summed:]:
+            total = total + getattr(item, attribute)
+        num_summed = len(self._other_items)
+        return total, num_summed, total / (num_summed + 1)
     
     @property
     def row(self):
-        return self._row
+        return self.shared_item._row
     
     @row.setter
     def row(self, new_value):
-        self._row = new_value
-        for item in self.other_items:
-            item.row = new_value
+        self.shared_item._row = new_value
             
     @property
     def range(self):
-        return self._range
+        return self.shared_item._range
     
     @range.setter
     def range(self, new_value):
-        self._range = new_value
-        for item in self.other_items:
-            item.range = new_value
+        self.shared_item._range = new_value
             
     @property
     def number_within_field(self):
-        return self._number_within_field
+        return self.shared_item._number_within_field
     
     @number_within_field.setter
     def number_within_field(self, new_value):
-        self._number_within_field = new_value
-        for item in self.other_items:
-            item.number_within_field = new_value
+        self.shared_item._number_within_field = new_value
             
     @property
     def number_within_row(self):
-        return self._number_within_row
+        return self.shared_item._number_within_row
     
     @number_within_row.setter
     def number_within_row(self, new_value):
-        self._number_within_row = new_value
-        for item in self.other_items:
-            item.number_within_row = new_value
+        self.shared_item._number_within_row = new_value
 
     @property
     def type(self):
@@ -91,36 +153,49 @@ class FieldItem(object):
         
     @property
     def is_gap_item(self):
-        return self._is_gap_item
+        return self.shared_item._is_gap_item
     
     @is_gap_item.setter
     def is_gap_item(self, new_value):
-        self._is_gap_item = new_value
-        for item in self.other_items:
-            item.is_gap_item = new_value
+        self.shared_item._is_gap_item = new_value
         
     @property
     def position(self):
-        '''For legacy purposes, need to remove.'''
-        return self._position
+        '''Return average position of item and all its references.'''
+        if len(self._other_items) == 0:
+            return self._position
+        self._position_summary = self._updated_summary(self._position, self._position_summary, 'position')
+        return self._position_summary[2]
         
     @position.setter
     def position(self, new_value):
-        '''For legacy purposes, need to remove.'''
-        self._position = new_value    
+        '''Set position of just this item.'''
+        self._position = new_value
+        self.refresh_fields()
+        
+    @property
+    def measured_position(self):
+        '''Return position of just this item without averaging in references.'''
+        return self._position
     
     @property
     def field_position(self):
-        '''For legacy purposes, need to remove.'''
-        return self._field_position
+        '''Return average field position of item and all its references.'''
+        if len(self._other_items) == 0:
+            return self._field_position
+        self._field_position_summary = self._updated_summary(self._field_position, self._field_position_summary, 'field_position')
+        return self._field_position_summary[2]
         
     @field_position.setter
     def field_position(self, new_value):
-        '''For legacy purposes, need to remove.'''
-        self._field_position = new_value 
+        '''Set field position of just this item.'''
+        self._field_position = new_value
+        self.refresh_fields()
         
 class GroupItem(FieldItem):
     '''Field item that belongs to grouping.'''
+    __slots__ = ('_group',)
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         super(GroupItem, self).__init__(*args, **kwargs)
@@ -128,13 +203,11 @@ class GroupItem(FieldItem):
         
     @property
     def group(self):
-        return self._group
+        return self.shared_item._group
     
     @group.setter
     def group(self, new_value):
-        self._group = new_value
-        for item in self.other_items:
-            item.group = new_value
+        self.shared_item._group = new_value
         
     @property
     def number_within_segment(self):
@@ -146,6 +219,9 @@ class GroupItem(FieldItem):
     
 class Plant(GroupItem):
     '''Unique plant found in field'''
+    # Projection and penalty are set by plant filters when the plant is selected.
+    __slots__ = ('_plant_num_in_field', '_plant_num_in_row', 'projection', 'penalty')
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         self._plant_num_in_field = -1 # Ordering number for just plant, not codes
@@ -154,32 +230,33 @@ class Plant(GroupItem):
         
     @property
     def plant_num_in_field(self):
-        return self._plant_num_in_field
+        return self.shared_item._plant_num_in_field
     
     @plant_num_in_field.setter
     def plant_num_in_field(self, new_value):
-        self._plant_num_in_field = new_value
-        for item in self.other_items:
-            item.plant_num_in_field = new_value
+        self.shared_item._plant_num_in_field = new_value
             
     @property
     def plant_num_in_row(self):
-        return self._plant_num_in_row
+        return self.shared_item._plant_num_in_row
     
     @plant_num_in_row.setter
     def plant_num_in_row(self, new_value):
-        self._plant_num_in_row = new_value
-        for item in self.other_items:
-            item.plant_num_in_row = new_value
+        self.shared_item._plant_num_in_row = new_value
 
 class CreatedPlant(Plant):
     '''Plant not found in field but created where one should be.'''
+    __slots__ = ()
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         super(CreatedPlant, self).__init__(*args, **kwargs)
 
 class GroupCode(GroupItem):
     '''Code found within image corresponding to plant grouping.'''
+    # Entry and rep are set from the field layout when grouping.
+    __slots__ = ('_alternate_id', 'entry', 'rep')
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         super(GroupCode, self).__init__(*args, **kwargs)
@@ -194,16 +271,17 @@ class GroupCode(GroupItem):
         
     @property
     def alternate_id(self):
-        return self._alternate_id
+        return self.shared_item._alternate_id
     
     @alternate_id.setter
     def alternate_id(self, new_value):
-        self._alternate_id = new_value
-        for item in self.other_items:
-            item.alternate_id = new_value
+        self.shared_item._alternate_id = new_value
     
 class SingleCode(FieldItem):
     '''Code found within image corresponding to a single plant.'''
+    # Group is set when code starts a segment.
+    __slots__ = ('group',)
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         super(SingleCode, self).__init__(*args, **kwargs)
@@ -214,6 +292,9 @@ class SingleCode(FieldItem):
 
 class RowCode(FieldItem):
     '''Code found within image corresponding to a row start/end.'''
+    # Group is set when code starts a segment.
+    __slots__ = ('assigned_row', 'group')
+    
     def __init__(self, *args, **kwargs):
         '''Constructor.'''
         super(RowCode, self).__init__(*args, **kwargs)
@@ -222,4 +303,5 @@ class RowCode(FieldItem):
 
     @FieldItem.row.getter
     def row(self):
-        return self.assigned_row if self.assigned_row >= 0 else self._row
+        shared_item = self.shared_item
+        return shared_item.assigned_row if shared_item.assigned_row >= 0 else shared_item._row
@@ -2,8 +2,20 @@
 
 from collections import defaultdict
 
-class GeoImage(object):
+# non-default import
+import numpy as np
+
+# Project imports
+from src.data.slotted_object import SlottedObject
+
+class GeoImage(SlottedObject):
     '''Image properties with X,Y,Z position and heading. All distances in centimeters.'''
+    __slots__ = ('file_name', 'file_path', 'image_time', 'position', 'zone', 'field_position', 'roll_degrees', 'pitch_degrees',
+                 'heading_degrees', 'resolution', 'camera_height', 'width', 'height',
+                 'top_left_position', 'top_right_position', 'bottom_right_position', 'bottom_left_position',
+                 'top_left_field_position', 'top_right_field_position', 'bottom_right_field_position', 'bottom_left_field_position',
+                 'items', 'debug_filepath')
+    
     def __init__(self, file_name, image_time=0, position=(0,0,0), zone='N/A', field_position=(0,0,0),
                  roll_degrees=0, pitch_degrees=0, heading_degrees=0, resolution=0, cam_height=0, size=(0,0)):
         '''Constructor.'''
@@ -40,4 +52,72 @@ class GeoImage(object):
     def size(self):
         '''Return image size in pixels.'''
         return (self.width, self.height)
-        
\ No newline at end of file
+        
+
+class GeoImageTable(object):
+    '''
+    Columns of geo image properties (one array per property) read from a geo file.  GeoImage instances are only created when
+    they're accessed so stages that just need positions and headings can use the arrays directly.
+    '''
+    def __init__(self, file_names, image_times, eastings, northings, altitudes, zones, rolls, pitches, headings, resolution=0, cam_height=0):
+        '''Constructor.'''
+        self.file_names = list(file_names) # name of each image file (not full path).
+        self.image_times = np.asarray(image_times, dtype=np.float64) # UTC time when each image was taken.
+        self.eastings = np.asarray(eastings, dtype=np.float64) # UTM position of camera when each image was taken.
+        self.northings = np.asarray(northings, dtype=np.float64)
+        self.altitudes = np.asarray(altitudes, dtype=np.float64)
+        self.zones = list(zones) # UTM zone (e.g. 14S) of each image.
+        self.rolls = np.asarray(rolls, dtype=np.float64) # roll, pitch and heading of each image in degrees. Same as GeoImage.
+        self.pitches = np.asarray(pitches, dtype=np.float64)
+        self.headings = np.asarray(headings, dtype=np.float64)
+        self.resolution = resolution # resolution (cm/pix) that user specified.
+        self.camera_height = cam_height # average height that camera is above ground in centimeters.
+
+        # GeoImage of each row once it's been created so changes to it aren't lost.
+        self._geo_images = [None] * len(self.file_names)
+        
+        # Columns converted to lists the first time a GeoImage is created since indexing arrays one value at a time is slow.
+        self._column_lists = None
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getitem__(self, index):
+        '''Return GeoImage at index (creating it if needed) or a new table if index is a slice.'''
+        if isinstance(index, slice):
+            return self.subset(range(len(self))[index])
+        geo_image = self._geo_images[index]
+        if geo_image is None:
+            if self._column_lists is None:
+                self._column_lists = [column.tolist() for column in [self.image_times, self.eastings, self.northings, self.altitudes,
+                                                                     self.rolls, self.pitches, self.headings]]
+            image_times, eastings, northings, altitudes, rolls, pitches, headings = self._column_lists
+            geo_image = GeoImage(file_name=self.file_names[index], image_time=image_times[index],
+                                 position=(eastings[index], northings[index], altitudes[index]), zone=self.zones[index],
+                                 roll_degrees=rolls[index], pitch_degrees=pitches[index], heading_degrees=headings[index],
+                                 resolution=self.resolution, cam_height=self.camera_height)
+            self._geo_images[index] = geo_image
+        return geo_image
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def subset(self, indices, file_names=None):
+        '''Return new table with just the rows at indices (in that order). File names of the new rows can optionally be replaced.'''
+        indices = np.asarray(indices, dtype=np.int64)
+        if file_names is None:
+            file_names = [self.file_names[k] for k in indices]
+        table = GeoImageTable(file_names, self.image_times[indices], self.eastings[indices], self.northings[indices],
+                              self.altitudes[indices], [self.zones[k] for k in indices], self.rolls[indices], self.pitches[indices],
+                              self.headings[indices], self.resolution, self.camera_height)
+        for new_index, k in enumerate(indices):
+            geo_image = self._geo_images[k]
+            if geo_image is not None:
+                geo_image.file_name = table.file_names[new_index]
+                table._geo_images[new_index] = geo_image
+        return table
+
+    def sorted_by_time(self):
+        '''Return new table sorted by image time. Images with the same time stay in the same order.'''
+        return self.subset(np.argsort(self.image_times, kind='mergesort'))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Slot names of each class (including base classes) so they only have to be looked up once.
+_class_slot_names = {}
+
+def slot_names(cls):
+    '''Return tuple of all slot names defined by class and its base classes.'''
+    try:
+        return _class_slot_names[cls]
+    except KeyError:
+        names = []
+        for base in reversed(cls.__mro__):
+            for name in base.__dict__.get('__slots__', ()):
+                if name not in names and name != '__weakref__':
+                    names.append(name)
+        _class_slot_names[cls] = tuple(names)
+        return _class_slot_names[cls]
+
+class SlottedObject(object):
+    '''
+    Base class for data objects that use __slots__ instead of a dictionary per instance to save memory.
+    State is pickled as a dictionary so files written before slots were added can still be loaded.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for name in slot_names(self.__class__):
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass # slot was never set
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # Default (dict state, slot state) format.
+            dict_state, slot_state = state
+            state = {}
+            state.update(dict_state or {})
+            state.update(slot_state or {})
+        names = slot_names(self.__class__)
+        for name, value in state.iteritems():
+            if name in names:
+                setattr(self, name, value)
+            # Otherwise it's an attribute from an old version that isn't used anymore.
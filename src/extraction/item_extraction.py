@@ -2,13 +2,14 @@
 
 import os
 import math
+from collections import OrderedDict
 
 # OpenCV imports
 import cv2
 import numpy as np
 
 # Project imports
-from src.util.image_writer import ImageWriter
+from src.util.image_writer import ImageWriter, BackgroundImageWriter
 from src.util.image_utils import *
 from src.data.field_item import Plant
 
@@ -250,21 +251,124 @@ def calculate_position_pixel(x, y, geo_image):
 
     return (x, y)
 
+def calculate_position_pixels(xs, ys, geo_image):
+    '''Return (x,y) pixel arrays of the specified (x,y) position arrays within geo image. Same math as calculate_position_pixel.'''
+
+    east_offsets = (np.asarray(xs, dtype=np.float64) - geo_image.position[0]) / (geo_image.resolution / 100)
+    north_offsets = (np.asarray(ys, dtype=np.float64) - geo_image.position[1]) / (geo_image.resolution / 100)
+
+    theta = math.radians(geo_image.heading_degrees - 90)
+    x = math.cos(theta) * east_offsets + math.sin(theta) * north_offsets
+    y = -math.sin(theta) * east_offsets + math.cos(theta) * north_offsets
+
+    x = x + geo_image.size[0] / 2
+    y = -y + geo_image.size[1] / 2
+
+    return x, y
+
 def calculate_item_position(item, geo_image):
     '''Return (x,y,z) position of item within geo image.'''
     x, y = rectangle_center(item.bounding_rect)
     return calculate_pixel_position_3d(x, y, geo_image)
     
-def extract_global_plants_from_images(plants, geo_images, out_directory):
-    
-    for plant in plants:
-        global_bounding_rect = plant.bounding_rect
-        if global_bounding_rect is None:
-            continue
-        found_in_image = False 
-        for k, geo_image in enumerate(geo_images):
-            from src.util.clustering import rect_to_image
-            image_rect = rect_to_image(global_bounding_rect, geo_image)
+def calculate_position_pixels_in_images(xs, ys, geo_images):
+    '''
+    Return (x,y) pixel arrays of the specified (x,y) position arrays with one row for each geo image.
+    Same math as calculate_position_pixel so results are identical.
+    '''
+    xs = np.asarray(xs, dtype=np.float64)[np.newaxis, :]
+    ys = np.asarray(ys, dtype=np.float64)[np.newaxis, :]
+    
+    thetas = [math.radians(geo_image.heading_degrees - 90) for geo_image in geo_images]
+    cos_thetas = np.array([[math.cos(theta)] for theta in thetas])
+    sin_thetas = np.array([[math.sin(theta)] for theta in thetas])
+    image_eastings = np.array([[geo_image.position[0]] for geo_image in geo_images])
+    image_northings = np.array([[geo_image.position[1]] for geo_image in geo_images])
+    meters_per_pixel = np.array([[geo_image.resolution / 100] for geo_image in geo_images])
+    half_widths = np.array([[geo_image.size[0] / 2] for geo_image in geo_images])
+    half_heights = np.array([[geo_image.size[1] / 2] for geo_image in geo_images])
+    
+    east_offsets = (xs - image_eastings) / meters_per_pixel
+    north_offsets = (ys - image_northings) / meters_per_pixel
+    
+    x = cos_thetas * east_offsets + sin_thetas * north_offsets
+    y = -sin_thetas * east_offsets + cos_thetas * north_offsets
+    
+    x = x + half_widths
+    y = -y + half_heights
+    
+    return x, y
+
+def calculate_pixel_positions_in_images(pixel_xs, pixel_ys, geo_images):
+    '''
+    Return (x,y,z) position arrays of the specified pixel arrays which have one row for each geo image.
+    Same math as calculate_pixel_position so results are identical.
+    '''
+    pixel_xs = np.asarray(pixel_xs, dtype=np.float64)
+    pixel_ys = np.asarray(pixel_ys, dtype=np.float64)
+    
+    # Gather everything needed from each image in one pass so the per image overhead stays low.
+    image_params = np.array([(math.radians(-geo_image.heading_degrees + 90), geo_image.position[0], geo_image.position[1],
+                              geo_image.position[2], geo_image.resolution / 100, geo_image.width / 2, geo_image.height / 2)
+                             for geo_image in geo_images], dtype=np.float64)
+    thetas = image_params[:, 0:1]
+    cos_thetas = np.cos(thetas)
+    sin_thetas = np.sin(thetas)
+    image_positions = image_params[:, 1:4]
+    meters_per_pixel = image_params[:, 4:5]
+    half_widths = image_params[:, 5:6]
+    half_heights = image_params[:, 6:7]
+    
+    x = pixel_xs - half_widths
+    y = -pixel_ys + half_heights
+    
+    east_offsets = (cos_thetas * x + sin_thetas * y) * meters_per_pixel
+    north_offsets = (-sin_thetas * x + cos_thetas * y) * meters_per_pixel
+    
+    eastings = image_positions[:, 0:1] + east_offsets
+    northings = image_positions[:, 1:2] + north_offsets
+    altitudes = np.repeat(image_positions[:, 2:3], pixel_xs.shape[1], axis=1)
+    
+    return eastings, northings, altitudes
+
+def map_global_plants_to_images(plants, geo_images):
+    '''
+    Convert global bounding rectangle of each plant to a rotated image rectangle of the first geo image the plant is in,
+    and add a copy of the plant to it for every other image it's in.  Plants that aren't in any image have their bounding
+    rectangle removed.  Return list of (plant, geo image, image rectangle) for every image each plant is in.
+    '''
+    plants = [plant for plant in plants if plant.bounding_rect is not None]
+    if len(plants) == 0:
+        return []
+    
+    # Transform every plant corner into every image at once.
+    corners = [corner for plant in plants for corner in plant.bounding_rect]
+    corner_starts = np.cumsum([0] + [len(plant.bounding_rect) for plant in plants[:-1]])
+    if len(geo_images) > 0:
+        pixel_xs, pixel_ys = calculate_position_pixels_in_images([c[0] for c in corners], [c[1] for c in corners], geo_images)
+        # Truncate towards zero like int()
+        pixel_xs = pixel_xs.astype(np.int64)
+        pixel_ys = pixel_ys.astype(np.int64)
+    
+        # Center of the rotated rectangle is always between the smallest and largest corners so only plants whose
+        # corners straddle the image can actually be in it.
+        widths = np.array([[geo_image.width] for geo_image in geo_images])
+        heights = np.array([[geo_image.height] for geo_image in geo_images])
+        possibly_in_image = ((np.maximum.reduceat(pixel_xs, corner_starts, axis=1) > 0) &
+                             (np.minimum.reduceat(pixel_xs, corner_starts, axis=1) < widths) &
+                             (np.maximum.reduceat(pixel_ys, corner_starts, axis=1) > 0) &
+                             (np.minimum.reduceat(pixel_ys, corner_starts, axis=1) < heights))
+    
+    plant_images = []
+    for plant_index, plant in enumerate(plants):
+        found_in_image = False
+        first_corner = corner_starts[plant_index]
+        last_corner = first_corner + len(plant.bounding_rect)
+        for image_index, geo_image in enumerate(geo_images):
+            if not possibly_in_image[image_index, plant_index]:
+                continue
+            pixel_points = np.column_stack((pixel_xs[image_index, first_corner:last_corner], pixel_ys[image_index, first_corner:last_corner]))
+            image_rect = cv2.minAreaRect(pixel_points)
             x, y = image_rect[0]
             if x > 0 and x < geo_image.width and y > 0 and y < geo_image.height:
                 found_in_image = True
@@ -276,19 +380,52 @@ def extract_global_plants_from_images(plants, geo_images, out_directory):
                     plant_copy.bounding_rect = image_rect
                     plant_copy.parent_image_filename = geo_image.file_name
                     plant.add_other_item(plant_copy)
-                
-                if out_directory is None:
-                    continue
-                
-                image_out_directory = os.path.join(out_directory, os.path.splitext(geo_image.file_name)[0])
-                ImageWriter.output_directory = image_out_directory
-                
-                img = cv2.imread(geo_image.file_path, cv2.CV_LOAD_IMAGE_COLOR)
-                if img is not None:
-                    plant_img = extract_square_image(img, image_rect, 200)
-                    
-                    plant_image_fname = postfix_filename(geo_image.file_name, "_{}".format(plant.type))
-                    plant.image_path = ImageWriter.save_normal(plant_image_fname, plant_img)
+                plant_images.append((plant, geo_image, image_rect))
         if not found_in_image:
             # Can't convert global rect to a rotated image rect so remove it to be consistent.
-            plant.bounding_rect = None
\ No newline at end of file
+            plant.bounding_rect = None
+            
+    return plant_images
+
+def extract_plant_images(plant_images, out_directory, image_writer=None):
+    '''
+    Save image of each (plant, geo image, image rectangle) to a directory named after the geo image and update
+    plant image path.  Each geo image is only read once and images are written in the background.
+    '''
+    close_writer = image_writer is None
+    if image_writer is None:
+        image_writer = BackgroundImageWriter()
+    
+    # Reserve file names in the same order as saving one plant at a time so that names don't depend on read order.
+    filepaths = []
+    crops_by_image = OrderedDict()
+    for k, (plant, geo_image, image_rect) in enumerate(plant_images):
+        image_out_directory = os.path.join(out_directory, os.path.splitext(geo_image.file_name)[0])
+        plant_image_fname = postfix_filename(geo_image.file_name, "_{}".format(plant.type))
+        filepaths.append(image_writer.reserve_filepath(image_out_directory, plant_image_fname))
+        crops_by_image.setdefault(geo_image.file_path, []).append((k, image_rect))
+        
+    saved = [False] * len(plant_images)
+    for image_filepath, crops in crops_by_image.iteritems():
+        img = cv2.imread(image_filepath, cv2.CV_LOAD_IMAGE_COLOR)
+        if img is None:
+            continue
+        for k, image_rect in crops:
+            image_writer.write(filepaths[k], extract_square_image(img, image_rect, 200))
+            saved[k] = True
+            
+    # Plants in multiple images keep the path of the last one.
+    for (plant, _, _), filepath, was_saved in zip(plant_images, filepaths, saved):
+        if was_saved:
+            plant.image_path = filepath
+            
+    if close_writer:
+        num_failed = image_writer.close()
+        if num_failed > 0:
+            print "Warning: failed to write {} plant images.".format(num_failed)
+    
+def extract_global_plants_from_images(plants, geo_images, out_directory):
+    '''Convert plant bounding rectangles to image rectangles and save image of each plant if out directory isn't None.'''
+    plant_images = map_global_plants_to_images(plants, geo_images)
+    if out_directory is not None:
+        extract_plant_images(plant_images, out_directory)
@@ -4,7 +4,65 @@ import sys
 import os
 import argparse
 import time
-import itertools
+import bisect
+from collections import defaultdict
+
+# Project imports
+from src.util.file_listing import list_files
+
+def parse_filesystem_image_name(filename):
+    '''Return (epoch seconds, filename, camera name, image number) of renamed image file name.'''
+    just_filename = os.path.splitext(filename)[0]
+    filename_parts = just_filename.split('_')
+    serial_number = filename_parts[1]
+    datetime_original = '-'.join(filename_parts[2:4])
+    datetime_original = time.strptime(datetime_original, "%Y%m%d-%H%M%S")
+    epoch_seconds = time.mktime(datetime_original)
+    camera_name = filename_parts[-2]
+    image_number = int(filename_parts[-1])
+    return (epoch_seconds, filename, camera_name, image_number)
+
+def index_filesystem_images(filesystem_images):
+    '''Return dictionary of (camera name, image number) -> sorted list of indices into filesystem images with that name and number.'''
+    image_index = defaultdict(list)
+    for k, filesystem_image in enumerate(filesystem_images):
+        image_index[(filesystem_image[2], filesystem_image[3])].append(k)
+    return image_index
+
+def match_log_contents(log_contents, filesystem_images):
+    '''
+    Return (list of (time string, new file name), list of (line number, log line) that couldn't be matched).
+    Both lists must already be sorted by time. Each log line is matched to the first file system image with the same camera
+    name and image number that isn't before the last matched image.
+    '''
+    image_index = index_filesystem_images(filesystem_images)
+    
+    last_matched_index = 0
+    matched_log_contents = []
+    unmatched_log_lines = []
+    for line_num, log_line in enumerate(log_contents):
+        
+        utc_time = log_line[0]
+        original_filename = log_line[1]
+        just_filename, extension = os.path.splitext(original_filename)
+        
+        filename_parts = just_filename.split('_')
+        camera_name = filename_parts[0]
+        image_number = int(filename_parts[1])
+
+        matching_indices = image_index.get((camera_name, image_number), [])
+        k = bisect.bisect_left(matching_indices, last_matched_index)
+        if k == len(matching_indices):
+            unmatched_log_lines.append((line_num, log_line))
+            continue
+        
+        last_matched_index = matching_indices[k]
+        filesystem_imagename = filesystem_images[last_matched_index][1]
+        just_filesystem_imagename = os.path.splitext(filesystem_imagename)[0]
+        new_log_filename = just_filesystem_imagename + extension
+        matched_log_contents.append(("{0:.4f}".format(utc_time), new_log_filename))
+        
+    return matched_log_contents, unmatched_log_lines
 
 if __name__ == '__main__':
     '''Create new image log file that contains the renamed image file names.'''
@@ -15,6 +73,7 @@ if __name__ == '__main__':
     parser.add_argument('image_log', help='File path containing time-stamped file names to match to actual images.')
     parser.add_argument('extensions', help='List of file extensions to match separated by commas. Example "jpg, CR2". Case sensitive.')
     parser.add_argument('-r', dest='recursive', default=default_recursive, help='If true then will recursively search through input directory for images. Default {}'.format(default_recursive))
+    parser.add_argument('-w', dest='walk_threads', default=1, help='Number of threads used to search through top level subdirectories (for example one per camera) at the same time. Default 1.')
     args = parser.parse_args()
     
     # Convert command line arguments
@@ -22,6 +81,7 @@ if __name__ == '__main__':
     image_log_path = args.image_log
     extensions = args.extensions.split(',')
     recursive = args.recursive.lower() == 'true'
+    walk_threads = int(args.walk_threads)
     
     if not os.path.exists(image_directory):
         print "Directory does not exist: {}".format(image_directory)
@@ -34,21 +94,11 @@ if __name__ == '__main__':
         os.makedirs(original_output_directory)
         
     filesystem_images = []
-    for (dirpath, dirnames, filenames) in os.walk(image_directory):
-        for filename in filenames:
-            # Make sure file has correct extension before adding it.
-            just_filename, extension = os.path.splitext(filename)
-            if extension[1:] in extensions:
-                filename_parts = just_filename.split('_')
-                serial_number = filename_parts[1]
-                datetime_original = '-'.join(filename_parts[2:4])
-                datetime_original = time.strptime(datetime_original, "%Y%m%d-%H%M%S")
-                epoch_seconds = time.mktime(datetime_original)
-                camera_name = filename_parts[-2]
-                image_number = int(filename_parts[-1])
-                filesystem_images.append((epoch_seconds, filename, camera_name, image_number))
-        if not recursive:
-            break # only walk top level directory
+    for (dirpath, filename) in list_files(image_directory, recursive, walk_threads):
+        # Make sure file has correct extension before adding it.
+        extension = os.path.splitext(filename)[1]
+        if extension[1:] in extensions:
+            filesystem_images.append(parse_filesystem_image_name(filename))
         
     if len(filesystem_images) == 0:
         print "No images with extensions {} from directory {} could be read in.".format(extensions, image_directory)
@@ -77,40 +127,7 @@ if __name__ == '__main__':
     print 'Sorting log contents by time stamp.'
     log_contents = sorted(log_contents, key=lambda c: c[0])
             
-    last_matched_index = 0
-    matched_log_contents = []
-    for line_num, log_line in enumerate(log_contents):
-        
-        utc_time = log_line[0]
-        original_filename = log_line[1]
-        just_filename, extension = os.path.splitext(original_filename)
-        
-        filename_parts = just_filename.split('_')
-        camera_name = filename_parts[0]
-        image_number = int(filename_parts[1])
-
-        found_match = False
-        current_index = last_matched_index
-        for filesystem_image in itertools.islice(filesystem_images, last_matched_index, None):
-            filesystem_cam_name = filesystem_image[2]
-            filesystem_image_number = filesystem_image[3]
-            cam_names_match = camera_name == filesystem_cam_name
-            image_numbers_match = image_number == filesystem_image_number
-            if cam_names_match and image_numbers_match:
-                last_matched_index = current_index
-                found_match = True
-                
-                filesystem_imagename = filesystem_image[1]
-                just_filesystem_imagename = os.path.splitext(filesystem_imagename)[0]
-                new_log_filename = just_filesystem_imagename + extension
-                matched_log_contents.append(("{0:.4f}".format(utc_time), new_log_filename))
-                
-                break
-            
-            current_index += 1
-                
-        if not found_match:
-            print "Couldn't find image on file system corresponding to log file line {} time {} filename {}".format(line_num, utc_time, original_filename)
+    matched_log_contents, unmatched_log_lines = match_log_contents(log_contents, filesystem_images)
             
     print "Matched {} out of {} log file names to actual image names.".format(len(matched_log_contents), len(log_contents))
         
@@ -119,11 +136,18 @@ if __name__ == '__main__':
     output_filepath = os.path.join(image_log_directory, output_filename)
     print "Writing results to {}".format(output_filepath)
     with open(output_filepath, 'w') as out_file:
-        for line in matched_log_contents:
-            out_file.write("{},{}\n".format(line[0], line[1]))
+        out_file.writelines(["{},{}\n".format(line[0], line[1]) for line in matched_log_contents])
+        
+    if len(unmatched_log_lines) > 0:
+        unmatched_filename = "{}_unmatched{}".format(log_just_filename, log_extension)
+        unmatched_filepath = os.path.join(image_log_directory, unmatched_filename)
+        print "Couldn't find images on file system for {} log file lines. Writing them to {}".format(len(unmatched_log_lines), unmatched_filepath)
+        with open(unmatched_filepath, 'w') as unmatched_file:
+            unmatched_file.write("# log file line, time, filename\n")
+            unmatched_file.writelines(["{},{},{}\n".format(line_num, utc_time, filename) for line_num, (utc_time, filename) in unmatched_log_lines])
     
     print "Moving original files to {}".format(original_output_directory)
     try:
         os.rename(image_log_path, os.path.join(original_output_directory, image_log_filename))
-    except WindowsError, e:
+    except OSError, e:
         print "Failed to move file: " + str(e)
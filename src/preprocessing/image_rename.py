@@ -4,8 +4,20 @@ import sys
 import os
 import argparse
 import time
+import csv
+import _strptime # imported up front since the lazy import in time.strptime isn't thread safe
+from multiprocessing.pool import ThreadPool
 import exifread
 
+# Project imports
+from src.util.file_listing import list_files
+
+# Name of file (in the directory images are renamed into) that lists every planned rename so an interrupted run can be resumed.
+JOURNAL_FILENAME = 'image_rename_journal.csv'
+
+# EXIF tags are stored in order of their ID so once the serial number (0xA431) is read the capture time (0x9003) has been read too.
+EXIF_STOP_TAG = 'BodySerialNumber'
+
 def is_number(s):
     '''Return true if s is a number.'''
     try:
@@ -14,6 +26,95 @@ def is_number(s):
     except ValueError:
         return False
 
+def read_capture_info(filepath):
+    '''Return (camera serial number, capture date/time as struct_time) from EXIF metadata of image. Only reads until those tags are found.'''
+    with open(filepath, 'rb') as f:
+        exif_tags = exifread.process_file(f, stop_tag=EXIF_STOP_TAG, details=False)
+    cam_serial_number = str(exif_tags['EXIF BodySerialNumber']).strip()
+    datetime_original = str(exif_tags['EXIF DateTimeOriginal']).strip()
+    return cam_serial_number, time.strptime(datetime_original, "%Y:%m:%d %H:%M:%S")
+
+def try_read_capture_info(filepath):
+    '''Return (capture info, None) or (None, error message) if EXIF metadata can't be read.  Used so worker threads don't raise.'''
+    try:
+        return read_capture_info(filepath), None
+    except (IOError, KeyError, ValueError) as e:
+        return None, "{} {}".format(type(e).__name__, e)
+
+def renamed_filename(original_filename, cam_serial_number, datetime_original):
+    '''Return new image file name that includes camera serial number and capture time.'''
+    return "CAM_{}_{}_{}".format(cam_serial_number, time.strftime("%Y%m%d_%H%M%S", datetime_original), original_filename)
+
+def plan_renames(image_filepaths, output_directory, num_threads=1):
+    '''
+    Return (list of (filepath, new filepath), list of (filepath, error message)) for every image.  If output directory is None then
+    images are renamed in the directory they're already in. EXIF metadata is read by multiple threads since it's mostly waiting on disk.
+    '''
+    pool = ThreadPool(max(1, num_threads))
+    try:
+        results = pool.map(try_read_capture_info, image_filepaths, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+    renames = []
+    failures = []
+    for filepath, (capture_info, error) in zip(image_filepaths, results):
+        if capture_info is None:
+            failures.append((filepath, error))
+            continue
+        original_directory, original_filename = os.path.split(filepath)
+        new_directory = original_directory if output_directory is None else output_directory
+        new_filename = renamed_filename(original_filename, *capture_info)
+        renames.append((filepath, os.path.join(new_directory, new_filename)))
+
+    return renames, failures
+
+def find_collisions(renames):
+    '''Return list of new filepaths that are used more than once or that already exist.'''
+    collisions = []
+    new_filepaths = set()
+    for filepath, new_filepath in renames:
+        if new_filepath in new_filepaths or os.path.exists(new_filepath):
+            collisions.append(new_filepath)
+        new_filepaths.add(new_filepath)
+    return collisions
+
+def write_journal(journal_filepath, renames):
+    '''Write list of (filepath, new filepath) to journal.  Written to temporary file first so journal is never partially written.'''
+    temp_filepath = journal_filepath + '.tmp'
+    with open(temp_filepath, 'wb') as journal_file:
+        writer = csv.writer(journal_file)
+        writer.writerow(['filepath', 'new_filepath'])
+        writer.writerows(renames)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.rename(temp_filepath, journal_filepath)
+
+def read_journal(journal_filepath):
+    '''Return list of (filepath, new filepath) stored in journal.'''
+    with open(journal_filepath, 'rb') as journal_file:
+        reader = csv.reader(journal_file)
+        next(reader) # skip header
+        return [(row[0], row[1]) for row in reader if len(row) == 2]
+
+def apply_renames(renames):
+    '''Rename each (filepath, new filepath) that hasn't already been renamed. Return (number renamed, number already renamed, number failed).'''
+    number_renamed = 0
+    number_skipped = 0
+    number_failed = 0
+    for filepath, new_filepath in renames:
+        if not os.path.exists(filepath) and os.path.exists(new_filepath):
+            number_skipped += 1 # renamed before run was interrupted
+            continue
+        try:
+            os.rename(filepath, new_filepath)
+            number_renamed += 1
+        except OSError as e:
+            print "Failed to rename\n{} to\n{}\n{}".format(filepath, new_filepath, e)
+            number_failed += 1
+    return number_renamed, number_skipped, number_failed
+
 if __name__ == '__main__':
     '''Rename images to include serial number / timestamp and optionally move images.'''
 
@@ -24,6 +125,7 @@ if __name__ == '__main__':
     parser.add_argument('extensions', help='List of file extensions to rename separated by commas. Example "jpg, CR2". Case sensitive.')
     parser.add_argument('-r', dest='recursive', default=default_recursive, help='If true then will recursively search through input directory for images. Default {}'.format(default_recursive))
     parser.add_argument('-d', dest='test_run', default='false', help='If true then will show one renamed image path without actually renaming or moving anything. Default false.')
+    parser.add_argument('-t', dest='num_threads', default=8, help='Number of images to read EXIF metadata from at the same time. Default 8.')
     args = parser.parse_args()
     
     # Convert command line arguments
@@ -32,62 +134,71 @@ if __name__ == '__main__':
     extensions = args.extensions.split(',')
     recursive = args.recursive.lower() == 'true'
     test_run = args.test_run.lower() == 'true'
+    num_threads = int(args.num_threads)
     
     if not os.path.exists(input_directory):
         print "Directory does not exist: {0}".format(input_directory)
         sys.exit(1)
         
     move_files = (output_directory.lower() != 'none')
-    if move_files:
-        # Make sure output directory exists
-        if not os.path.exists(output_directory):
-            print "Creating output directory {}".format(output_directory)
-            os.makedirs(output_directory)
-        
-    # Get list of image file paths to rename.
-    image_filepaths = []
-    for (dirpath, dirnames, filenames) in os.walk(input_directory):
-        for filename in filenames:
+    
+    # Journal goes wherever the images are renamed to so it's on the same file system.
+    journal_directory = output_directory if move_files else input_directory
+    journal_filepath = os.path.join(journal_directory, JOURNAL_FILENAME)
+    
+    if os.path.exists(journal_filepath):
+        # Finish previous run rather than looking up images again since some have already been renamed.
+        renames = read_journal(journal_filepath)
+        print "Resuming {} renames listed in {}".format(len(renames), journal_filepath)
+        if test_run:
+            sys.exit(0)
+    else:
+        if move_files:
+            # Make sure output directory exists
+            if not os.path.exists(output_directory):
+                print "Creating output directory {}".format(output_directory)
+                os.makedirs(output_directory)
+            
+        # Get list of image file paths to rename.
+        image_filepaths = []
+        for (dirpath, filename) in list_files(input_directory, recursive, num_threads):
             # Make sure file has correct extension before adding it.
             extension = os.path.splitext(filename)[1][1:]
             if extension in extensions:
                 image_filepaths.append(os.path.join(dirpath, filename))
-        if not recursive:
-            break # only walk top level directory
-    
-    number_renamed = 0 # How many images are successfully renamed
-    
-    for filepath_idx, filepath in enumerate(image_filepaths):
         
-        original_directory, original_filename = os.path.split(filepath)
+        print "Reading EXIF metadata from {} images.".format(len(image_filepaths))
         
-        print "Processing {} [{}/{}]".format(original_filename, filepath_idx + 1, len(image_filepaths))
+        # Figure out every new file name before renaming anything.
+        renames, failures = plan_renames(image_filepaths, output_directory if move_files else None, num_threads)
         
-        # Extract camera serial number and capture date/time from EXIF metadata so we can use it for renaming image.
-        with open(filepath, 'rb') as f:
-
-            exif_tags = exifread.process_file(f)
-            cam_serial_number = str(exif_tags['EXIF BodySerialNumber']).strip()
-            datetime_original = str(exif_tags['EXIF DateTimeOriginal']).strip()
-            datetime_original = time.strptime(datetime_original, "%Y:%m:%d %H:%M:%S")
-
-        new_filename = "CAM_{}_{}_{}".format(cam_serial_number, time.strftime("%Y%m%d_%H%M%S", datetime_original), original_filename) 
+        for filepath, error in failures:
+            print "Failed to read EXIF metadata from {}\n{}".format(filepath, error)
+        
+        collisions = find_collisions(renames)
+        for new_filepath in collisions:
+            print "More than one image would be renamed to {} or it already exists.".format(new_filepath)
+        
+        if len(failures) > 0 or len(collisions) > 0:
+            print "Not renaming anything."
+            sys.exit(1)
         
-        if move_files:
-            # Rename and move file.
-            new_filepath = os.path.join(output_directory, new_filename)
-        else: 
-            # Just rename file.
-            new_filepath = os.path.join(original_directory, new_filename)
-            
         if test_run:
-            print 'Would rename {} to {}'.format(filepath, new_filepath)
+            if len(renames) > 0:
+                print 'Would rename {} to {}'.format(*renames[0])
+            print 'Would rename {} files.'.format(len(renames))
             sys.exit(0)
-            
-        try:
-            os.rename(filepath, new_filepath)
-            number_renamed += 1
-        except WindowsError as e:
-            print "Failed to rename\n{} to\n{}\n{}".format(filepath, new_filepath, e)
+        
+        write_journal(journal_filepath, renames)
+    
+    number_renamed, number_skipped, number_failed = apply_renames(renames)
+    
+    if number_failed == 0:
+        # Everything is renamed so nothing to resume.
+        os.remove(journal_filepath)
+    else:
+        print "Run again to retry failed renames listed in {}".format(journal_filepath)
 
-    print 'Renamed {} files.'.format(number_renamed)
\ No newline at end of file
+    if number_skipped > 0:
+        print 'Skipped {} files that were already renamed.'.format(number_skipped)
+    print 'Renamed {} files.'.format(number_renamed)
@@ -3,8 +3,59 @@
 import sys
 import os
 import argparse
-import time
-import itertools
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Project imports
+from src.util.file_listing import list_files
+
+def read_logged_image_names(image_logs):
+    '''Return (set of logged image names without extension, number of log lines) of all log files. Files are read one line at a time.'''
+    logged_names = set()
+    num_lines = 0
+    for image_log in image_logs:
+        with open(image_log, 'r') as input_file:
+            for line in input_file:
+                if line.strip().startswith('#') or line.isspace():
+                    continue # comment or empty line
+                items = [i.strip() for i in line.split(',')]
+                utc_time = float(items[0])
+                image_filename = items[1]
+                logged_names.add(os.path.splitext(image_filename)[0])
+                num_lines += 1
+    return logged_names, num_lines
+
+def plan_moves(filesystem_image_names, logged_names, output_directory):
+    '''
+    Return (ordered dictionary of source directory -> list of (filepath, new filepath), list of skipped filepaths) of every image
+    that isn't in the logged names.  Images are skipped if another image with the same name is already going to the output directory
+    or is already in it (from an earlier run) so nothing is overwritten.
+    '''
+    moves_by_directory = OrderedDict()
+    skipped = []
+    new_filepaths = set()
+    for filesystem_dir, filesystem_image_name in filesystem_image_names:
+        if os.path.splitext(filesystem_image_name)[0] in logged_names:
+            continue
+        new_filepath = os.path.join(output_directory, filesystem_image_name)
+        filepath = os.path.join(filesystem_dir, filesystem_image_name)
+        if new_filepath in new_filepaths or os.path.exists(new_filepath):
+            skipped.append(filepath)
+            continue
+        new_filepaths.add(new_filepath)
+        moves_by_directory.setdefault(filesystem_dir, []).append((filepath, new_filepath))
+    return moves_by_directory, skipped
+
+def move_files(moves):
+    '''Rename each (filepath, new filepath) and return number that were moved.'''
+    number_moved = 0
+    for filepath, new_filepath in moves:
+        try:
+            os.rename(filepath, new_filepath)
+            number_moved += 1
+        except OSError as e:
+            print "Failed to rename\n{} to\n{}\n{}".format(filepath, new_filepath, e)
+    return number_moved
 
 if __name__ == '__main__':
     '''Match move any images that don't have a log entry to a an 'unmatched directory.'''
@@ -15,6 +66,8 @@ if __name__ == '__main__':
     parser.add_argument('image_logs', help='Comma separated list of log filepaths containing file names to match to actual images.')
     parser.add_argument('extensions', help='List of file extensions to rename separated by commas. Example "jpg, CR2". Case sensitive.')
     parser.add_argument('-r', dest='recursive', default=default_recursive, help='If true then will recursively search through input directory for images. Default {}'.format(default_recursive))
+    parser.add_argument('-t', dest='move_threads', default=1, help='Number of directories to move images out of at the same time. Default 1.')
+    parser.add_argument('-d', dest='test_run', default='false', help='If true then will report which images would be moved without actually moving anything. Default false.')
     args = parser.parse_args()
     
     # Convert command line arguments
@@ -22,20 +75,24 @@ if __name__ == '__main__':
     image_logs = [log_path.strip() for log_path in args.image_logs.split(',')]
     extensions = args.extensions.split(',')
     recursive = args.recursive.lower() == 'true'
+    move_threads = int(args.move_threads)
+    test_run = args.test_run.lower() == 'true'
     
     if not os.path.exists(image_directory):
         print "Directory does not exist: {}".format(image_directory)
         sys.exit(1)
         
+    output_directory = os.path.join(image_directory, 'unmatched_images')
+        
     filesystem_image_names = []
-    for (dirpath, dirnames, filenames) in os.walk(image_directory):
-        for filename in filenames:
-            # Make sure file has correct extension before adding it.
-            just_filename, extension = os.path.splitext(filename)
-            if extension[1:] in extensions:
-                filesystem_image_names.append((dirpath, filename))
-        if not recursive:
-            break # only walk top level directory
+    for (dirpath, filename) in list_files(image_directory, recursive, move_threads):
+        # Don't list images that were already moved by an earlier run.
+        if dirpath == output_directory or dirpath.startswith(output_directory + os.sep):
+            continue
+        # Make sure file has correct extension before adding it.
+        extension = os.path.splitext(filename)[1]
+        if extension[1:] in extensions:
+            filesystem_image_names.append((dirpath, filename))
         
     if len(filesystem_image_names) == 0:
         print "No images with extensions {} from directory {} could be read in.".format(extensions, image_directory)
@@ -43,49 +100,31 @@ if __name__ == '__main__':
         
     print "Read in {} images from image directory.".format(len(filesystem_image_names))
 
-    # Read in input file.
-    log_contents = []
-    for image_log in image_logs:
-        with open(image_log, 'r') as input_file:
-            for line in input_file.readlines():
-                if line.strip().startswith('#'):
-                    continue # comment line
-                items = [i.strip() for i in line.split(',')]
-                utc_time = float(items[0])
-                image_filename = items[1]
-                log_contents.append((utc_time, image_filename))
+    # Read in input files.
+    logged_names, num_log_lines = read_logged_image_names(image_logs)
             
-    print "Read in {} time stamped image names from image log.".format(len(log_contents))
+    print "Read in {} time stamped image names from image log.".format(num_log_lines)
 
-    output_directory = os.path.join(image_directory, 'unmatched_images')
+    moves_by_directory, skipped = plan_moves(filesystem_image_names, logged_names, output_directory)
+    num_to_move = sum([len(moves) for moves in moves_by_directory.itervalues()])
+    
+    for filepath in skipped:
+        print "Not moving {} since an image with the same name is already being moved or is in {}.".format(filepath, output_directory)
+    
+    if test_run:
+        print "Test run. Would move {} images to {}".format(num_to_move, output_directory)
+        for filesystem_dir, moves in moves_by_directory.iteritems():
+            print "{} images from {}".format(len(moves), filesystem_dir)
+        sys.exit(0)
     
     if not os.path.exists(output_directory):
         os.mkdir(output_directory)
 
-    number_moved = 0
-    for filesystem_dir, filesystem_image_name in filesystem_image_names:
-
-            filesystem_image_just_filename, filesystem_image_extension = os.path.splitext(filesystem_image_name)
-
-            found_match = False
-            for log_line in log_contents:
-
-                utc_time = log_line[0]
-                original_filename = log_line[1]
-                just_filename, extension = os.path.splitext(original_filename)
-                
-                if just_filename == filesystem_image_just_filename:
-                    found_match = True
-                    break
-                
-            if not found_match:
-                # Move file to new directory since it's unmatched
-                new_filepath = os.path.join(output_directory, filesystem_image_name)
-                try:
-                    filepath = os.path.join(filesystem_dir, filesystem_image_name)
-                    os.rename(filepath, new_filepath)
-                    number_moved += 1
-                except WindowsError as e:
-                    print "Failed to rename\n{} to\n{}\n{}".format(filepath, new_filepath, e)
+    pool = ThreadPool(max(1, move_threads))
+    try:
+        number_moved = sum(pool.map(move_files, moves_by_directory.values()))
+    finally:
+        pool.close()
+        pool.join()
           
     print "Moved {} images to new directory.".format(number_moved)
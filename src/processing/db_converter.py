@@ -4,9 +4,21 @@ import sys
 import os
 import argparse
 import math
-import datetime
 import csv
 import bisect
+import itertools
+
+# non-default import
+import numpy as np
+
+# Project imports
+from src.util.parsing import WHITESPACE_CHARACTERS, SEPARATOR_CHARACTERS
+
+# How many lines are read, converted and written at a time.
+CHUNK_SIZE = 100000
+
+# Vehicle state is only saved if this many seconds have passed since the last saved state to limit how much data is saved.
+MIN_STATE_PERIOD = 0.175
 
 def find_less_than_or_equal(a, x):
     '''
@@ -17,6 +29,228 @@ def find_less_than_or_equal(a, x):
     i = bisect.bisect_right(a, x)
     return i - 1
 
+def format_utc_timestamps(timestamps):
+    '''
+    Return (dates, times, milliseconds) lists of UTC timestamps (seconds since epoch) formatted as YYYY/MM/DD, HH:MM:SS and
+    integer milliseconds.  Rounds to the nearest microsecond the same way as datetime.utcfromtimestamp.
+    '''
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    seconds = np.trunc(timestamps)
+    microseconds = np.floor((timestamps - seconds) * 1e6 + 0.5)
+    # Timestamps before 1970 have a negative fraction.
+    seconds[microseconds < 0] -= 1
+    microseconds[microseconds < 0] += 1000000
+    rounded_up = microseconds >= 1000000
+    seconds[rounded_up] += 1
+    microseconds[rounded_up] -= 1000000
+
+    # YYYY-MM-DDTHH:MM:SS as a grid of characters so the date and time can be sliced out of every timestamp at once.
+    iso_strings = np.datetime_as_string(seconds.astype(np.int64).astype('datetime64[s]')).astype('S19')
+    characters = iso_strings.view('S1').reshape(-1, 19)
+    dates = np.where(characters[:, :10] == '-', '/', characters[:, :10]).view('S10').ravel()
+    times = np.ascontiguousarray(characters[:, 11:]).view('S8').ravel()
+    milliseconds = (microseconds.astype(np.int64) // 1000)
+
+    return dates.tolist(), times.tolist(), milliseconds.tolist()
+
+def parse_numeric_lines(lines, first_line_num, num_fields):
+    '''
+    Return (Nx(num fields) array of values, indices of the lines they came from) of every line that isn't a comment and has the
+    correct number of comma or space separated fields.  Every line is checked at once using the characters of all the lines.
+    Line numbers used for reporting lines with the wrong number of fields start at first line num.
+    '''
+    text = ''.join(lines)
+    if not text.endswith('\n'):
+        text += '\n'
+    chars = np.frombuffer(text, dtype=np.uint8)
+    line_starts = np.concatenate(([0], np.flatnonzero(chars == ord('\n'))[:-1] + 1))
+
+    separators = SEPARATOR_CHARACTERS[chars]
+
+    # A field starts at every character that isn't a separator and comes after one.
+    field_starts = ~separators
+    field_starts[1:] &= separators[:-1]
+    num_line_fields = np.add.reduceat(field_starts, line_starts, dtype=np.int64)
+
+    # Comments are lines where the first character that isn't whitespace is a #
+    comments = chars[line_starts] == ord('#')
+    for k in np.flatnonzero(WHITESPACE_CHARACTERS[chars[line_starts]]):
+        comments[k] = lines[k].strip().startswith('#')
+
+    for k in np.flatnonzero(~comments & (num_line_fields != num_fields)):
+        print 'Incorrect number of fields on line ' + str(first_line_num + k)
+
+    valid_indices = np.flatnonzero(~comments & (num_line_fields == num_fields))
+    if len(valid_indices) < len(lines):
+        text = ''.join([lines[k].rstrip('\n') + '\n' for k in valid_indices])
+
+    values = np.fromstring(text.replace(',', ' '), dtype=np.float64, sep=' ')
+    if values.size != len(valid_indices) * num_fields:
+        raise ValueError('Could not convert every field to a number on lines {} to {}'.format(first_line_num, first_line_num + len(lines) - 1))
+
+    return values.reshape(-1, num_fields), valid_indices
+
+def read_chunks(input_file, chunk_size=CHUNK_SIZE):
+    '''Yield (lines, line number of first line) for each chunk of lines in file. Line numbers start at 1.'''
+    first_line_num = 1
+    while True:
+        lines = list(itertools.islice(input_file, chunk_size))
+        if len(lines) == 0:
+            break
+        yield lines, first_line_num
+        first_line_num += len(lines)
+
+def read_orientations(orientation_filepath):
+    '''Return (timestamps, orientations) arrays of orientation file.  Orientations is Nx3 array of angles in radians.'''
+    timestamp_chunks = []
+    orientation_chunks = []
+    with open(orientation_filepath, 'r') as orientation_file:
+        for lines, first_line_num in read_chunks(orientation_file):
+            values, _ = parse_numeric_lines(lines, first_line_num, 4)
+            timestamp_chunks.append(values[:, 0])
+            orientation_chunks.append(values[:, 1:])
+
+    if len(timestamp_chunks) == 0:
+        return np.zeros(0), np.zeros((0, 3))
+
+    timestamps = np.concatenate(timestamp_chunks)
+    orientations = np.concatenate(orientation_chunks)
+
+    # Matching needs orientations in time order. Sort is stable so the first of any duplicate timestamps is still used.
+    if np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamps = timestamps[order]
+        orientations = orientations[order]
+
+    return timestamps, orientations
+
+def decimate(timestamps, last_timestamp, min_period=MIN_STATE_PERIOD):
+    '''
+    Return (indices, last saved timestamp) of timestamps that are at least min period after the previous saved timestamp, starting
+    with the last saved timestamp.
+    '''
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    in_order = len(timestamps) == 0 or (timestamps[0] >= last_timestamp and np.all(np.diff(timestamps) >= 0))
+    timestamps = timestamps.tolist()
+    indices = []
+    if not in_order:
+        # Have to check each one.
+        for k, timestamp in enumerate(timestamps):
+            if abs(timestamp - last_timestamp) >= min_period:
+                indices.append(k)
+                last_timestamp = timestamp
+        return indices, last_timestamp
+
+    k = 0
+    while k < len(timestamps):
+        # Jump to first timestamp that's far enough ahead and then check the exact difference since the addition can round.
+        start = k
+        k = bisect.bisect_left(timestamps, last_timestamp + min_period, start)
+        while k > start and timestamps[k-1] - last_timestamp >= min_period:
+            k -= 1
+        while k < len(timestamps) and timestamps[k] - last_timestamp < min_period:
+            k += 1
+        if k >= len(timestamps):
+            break
+        indices.append(k)
+        last_timestamp = timestamps[k]
+        k += 1
+
+    return indices, last_timestamp
+
+def match_orientations(timestamps, orientation_timestamps, orientations, interpolate=False):
+    '''
+    Return Nx3 array of orientations at each timestamp.  If there isn't an orientation with the exact same timestamp then it's NaN,
+    unless interpolate is true in which case angles are linearly interpolated between surrounding orientations (taking wrap around
+    into account, result is between -pi and pi) and are only NaN outside of the orientation times.  Orientation timestamps must be sorted.
+    '''
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    matched = np.empty((len(timestamps), 3))
+    matched.fill(float('nan'))
+    if len(orientation_timestamps) == 0:
+        return matched
+
+    # Merge join on timestamp. First orientation that has the same timestamp is used.
+    indices = np.searchsorted(orientation_timestamps, timestamps, side='left')
+    valid_indices = np.minimum(indices, len(orientation_timestamps) - 1)
+    exact = (indices < len(orientation_timestamps)) & (orientation_timestamps[valid_indices] == timestamps)
+    matched[exact] = orientations[indices[exact]]
+
+    if interpolate:
+        to_interpolate = ~exact & (timestamps > orientation_timestamps[0]) & (timestamps < orientation_timestamps[-1])
+        after = indices[to_interpolate]
+        before = after - 1
+        ratios = (timestamps[to_interpolate] - orientation_timestamps[before]) / (orientation_timestamps[after] - orientation_timestamps[before])
+        # Shortest way around from before angle to after angle.
+        deltas = orientations[after] - orientations[before]
+        deltas = (deltas + math.pi) % (2 * math.pi) - math.pi
+        interpolated = orientations[before] + deltas * ratios[:, np.newaxis]
+        matched[to_interpolate] = (interpolated + math.pi) % (2 * math.pi) - math.pi
+
+    return matched
+
+def convert_image_log(image_log_filepath, new_log_filepath):
+    '''Write image log in database format. Comment lines are copied as is.'''
+    with open(image_log_filepath, 'r') as log_file:
+        lines = log_file.readlines()
+
+    data_lines = []
+    all_fields = []
+    for i, line in enumerate(lines):
+        if line.startswith('#'):
+            continue
+        fields = line.replace(',',' ').split()
+        if len(fields) != 9:
+            print 'Incorrect number of fields on line ' + str(i+1)
+        data_lines.append(i)
+        all_fields.append(fields)
+
+    utc_dates, utc_times, utc_milliseconds = format_utc_timestamps([float(fields[0]) for fields in all_fields])
+    converted_rows = {}
+    for i, fields, utc_date, utc_time, utc_ms in zip(data_lines, all_fields, utc_dates, utc_times, utc_milliseconds):
+        orientation_fields_in_degrees = [math.degrees(float(f)) for f in fields[6:]]
+        converted_rows[i] = [fields[1], utc_date, utc_time, utc_ms] + fields[2:6] + orientation_fields_in_degrees
+
+    with open(new_log_filepath, 'wb') as new_log_file:
+        new_log_writer = csv.writer(new_log_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        for i, line in enumerate(lines):
+            if i in converted_rows:
+                new_log_writer.writerow(converted_rows[i])
+            else:
+                new_log_file.write(line)
+
+def convert_vehicle_state(position_filepath, orientation_filepath, output_filepath, interpolate=False):
+    '''
+    Write positions combined with orientations (in degrees) to output file in database format.  Positions are read, converted and
+    written a chunk at a time and only saved if enough time has passed since the last saved one.  Return number of states written.
+    '''
+    orientation_timestamps, orientations = read_orientations(orientation_filepath)
+
+    num_written = 0
+    last_position_timestamp = 0
+    with open(position_filepath, 'r') as position_file, open(output_filepath, 'wb') as new_file:
+        new_file_writer = csv.writer(new_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        for lines, first_line_num in read_chunks(position_file):
+            values, line_indices = parse_numeric_lines(lines, first_line_num, 5)
+            timestamps = values[:, 0]
+
+            saved_indices, last_position_timestamp = decimate(timestamps, last_position_timestamp)
+            if len(saved_indices) == 0:
+                continue
+            timestamps = timestamps[saved_indices]
+            # Position fields are written exactly as they are in the file.
+            position_fields = [lines[line_indices[k]].replace(',',' ').split()[1:] for k in saved_indices]
+
+            orientations_in_degrees = np.degrees(match_orientations(timestamps, orientation_timestamps, orientations, interpolate)).tolist()
+            utc_dates, utc_times, utc_milliseconds = format_utc_timestamps(timestamps)
+
+            new_file_writer.writerows([utc_date, utc_time, utc_ms] + fields + orientation
+                                      for fields, utc_date, utc_time, utc_ms, orientation
+                                      in zip(position_fields, utc_dates, utc_times, utc_milliseconds, orientations_in_degrees))
+            num_written += len(saved_indices)
+
+    return num_written
+
 if __name__ == '__main__':
     '''Convert file(s) to correct format for database.'''
 
@@ -24,44 +258,20 @@ if __name__ == '__main__':
     parser.add_argument('-p', dest='position_filepath', default='none', help='File path for vehicle position file.')
     parser.add_argument('-o', dest='orientation_filepath', default='none', help='File path for vehicle orientation file.')
     parser.add_argument('-i', dest='image_log_filepath', default='none', help='File path for image log file.')
+    parser.add_argument('-n', dest='interpolate', default='false', help='If true then orientations are interpolated to position times. Otherwise only orientations with the exact same timestamp are used. Default false.')
     args = parser.parse_args()
     
     # Convert command line arguments
     position_filepath = args.position_filepath
     orientation_filepath = args.orientation_filepath
     image_log_filepath = args.image_log_filepath
+    interpolate = args.interpolate.lower() == 'true'
     
     if os.path.exists(image_log_filepath):
         log_file_name, log_file_ext = os.path.splitext(image_log_filepath)
         new_log_filepath = '{}_db{}'.format(log_file_name, log_file_ext)
-        new_log_file = open(new_log_filepath, 'wb')
-        new_log_writer = csv.writer(new_log_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        with open(image_log_filepath, 'r') as log_file:
-            for i, line in enumerate(log_file):
-                if line.startswith('#'):
-                    new_log_file.writeline(line)
-                else:
-                    fields = line.replace(',',' ').split()
-                    if len(fields) != 9:
-                        print 'Incorrect number of fields on line ' + str(i+1)
-                    
-                    utc_timestamp = float(fields[0])
-                    image_name = fields[1]
-                    position_fields = fields[2:6]
-                    orientation_fields = fields[6:]
-                    
-                    utc_datetime = datetime.datetime.utcfromtimestamp(utc_timestamp)
-                    
-                    utc_date = "{:04d}/{:02d}/{:02d}".format(utc_datetime.year, utc_datetime.month, utc_datetime.day)
-                    utc_time = "{:02d}:{:02d}:{:02d}".format(utc_datetime.hour, utc_datetime.minute, utc_datetime.second)
-                    utc_milliseconds = int(utc_datetime.microsecond / 1000)
-                    
-                    orientation_fields_in_degrees = [math.degrees(float(f)) for f in orientation_fields]
-
-                    new_log_writer.writerow([image_name, utc_date, utc_time, utc_milliseconds] + position_fields + orientation_fields_in_degrees)
-                    
+        convert_image_log(image_log_filepath, new_log_filepath)
         print "\nFinished writing updated file {}".format(new_log_filepath)
-        new_log_file.close()
         
     elif image_log_filepath.lower() != 'none':
         print "Image log doesn't exist: {}".format(image_log_filepath)
@@ -70,74 +280,6 @@ if __name__ == '__main__':
     if os.path.exists(position_filepath) and os.path.exists(orientation_filepath):
         position_filepath_directory = os.path.split(position_filepath)[0]
         output_filepath = os.path.join(position_filepath_directory, 'vehicle_state_db.csv')
-        new_file = open(output_filepath, 'wb')
-        new_file_writer = csv.writer(new_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        
-        position_file = open(position_filepath, 'r')
-        orientation_file = open(orientation_filepath, 'r')
-        
-        orientations = []
-        for i, line in enumerate(orientation_file.readlines()):
-            if line.strip().startswith('#'):
-                continue
-            fields = line.replace(',',' ').split()
-            if len(fields) != 4:
-                print 'Incorrect number of fields on line ' + str(i+1)
-                continue
-
-            timestamp = float(fields[0])
-            orientation_info = [float(f) for f in fields[1:]]
-        
-            orientations.append({'timestamp': timestamp, 'info': orientation_info })
-        
-        orientation_line_num = 0
-        last_position_timestamp = 0
-        for i, line in enumerate(position_file):
-            if line.strip().startswith('#'):
-                continue
-            fields = line.replace(',',' ').split()
-            if len(fields) != 5:
-                print 'Incorrect number of fields on line ' + str(i+1)
-                continue
-                
-            timestamp = float(fields[0])
-            position_info = fields[1:]
-            
-            while True:
-                if orientation_line_num > len(orientations):
-                    orientation_info = [float('nan')] * 3
-                    break
-                else:
-                    orientation = orientations[orientation_line_num]
-                    if orientation['timestamp'] > timestamp:
-                        orientation_info = [float('nan')] * 3
-                        break
-                    elif orientation['timestamp'] == timestamp:
-                        orientation_info = orientation['info']
-                        break
-                    
-                    orientation_line_num += 1
-                        
-            # Limit how much data is saved
-            if abs(timestamp - last_position_timestamp) < 0.175:
-                continue
-            
-            # Convert orientation data to degrees
-            for i in range(len(orientation_info)):
-                orientation_info[i] = math.degrees(orientation_info[i])
-            
-            last_position_timestamp = timestamp
-            
-            utc_datetime = datetime.datetime.utcfromtimestamp(timestamp)
-            utc_date = "{:04d}/{:02d}/{:02d}".format(utc_datetime.year, utc_datetime.month, utc_datetime.day)
-            utc_time = "{:02d}:{:02d}:{:02d}".format(utc_datetime.hour, utc_datetime.minute, utc_datetime.second)
-            utc_milliseconds = int(utc_datetime.microsecond / 1000)
-            
-            new_file_writer.writerow([utc_date, utc_time, utc_milliseconds] + position_info + orientation_info)
+        convert_vehicle_state(position_filepath, orientation_filepath, output_filepath, interpolate)
             
         print "\nFinished writing updated file {}".format(output_filepath)
-            
-        position_file.close()
-        orientation_file.close()
-        new_file.close()
-        
\ No newline at end of file
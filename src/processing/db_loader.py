@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+
+import sqlite3
+import time
+
+# Project imports
+from src.processing.export_results import RESULT_COLUMNS, SEGMENT_COLUMNS, item_result_values, segment_result_values
+
+# How many rows are sent to the database with each executemany call.
+BATCH_SIZE = 5000
+
+# SQL type of each column kind.
+SQL_TYPES = {'float': 'REAL', 'int': 'INTEGER', 'string': 'TEXT', 'category': 'TEXT'}
+
+# Columns of plant groups table.
+GROUP_COLUMNS = [('group_id', 'string'),
+                 ('alternate_id', 'string'),
+                 ('expected_num_plants', 'int'),
+                 ('num_segments', 'int'),
+                 ('num_items', 'int'),
+                 ('length', 'float')
+                 ]
+
+# Every row of every table is tagged with the field and day it came from so that results can be reloaded one field/day at a time.
+KEY_COLUMNS = [('field_name', 'string'), ('field_date', 'string')]
+
+# Table name -> columns (not counting key columns).
+TABLES = [('items', [('item_index', 'int')] + RESULT_COLUMNS),
+          ('item_references', [('item_index', 'int')] + RESULT_COLUMNS),
+          ('segments', [('segment_index', 'int')] + SEGMENT_COLUMNS),
+          ('plant_groups', [('group_index', 'int')] + GROUP_COLUMNS)]
+
+# Table name -> list of (index name, columns).
+INDEXES = {'items': [('items_row_range', ['field_name', 'field_date', 'row', 'range']),
+                     ('items_field_num', ['field_name', 'field_date', 'field_num']),
+                     ('items_id', ['id'])],
+           'item_references': [('item_references_item', ['field_name', 'field_date', 'item_index']),
+                               ('item_references_id', ['id'])],
+           'segments': [('segments_group_id', ['field_name', 'field_date', 'group_id'])],
+           'plant_groups': [('plant_groups_group_id', ['field_name', 'field_date', 'group_id'])]}
+
+def create_tables(connection):
+    '''Create results tables, their indexes and the loads table if they don't already exist.'''
+    for table_name, columns in TABLES:
+        column_definitions = ['{} {}'.format(name, SQL_TYPES[kind]) for name, kind in KEY_COLUMNS + columns]
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table_name, ', '.join(column_definitions)))
+        for index_name, index_columns in INDEXES[table_name]:
+            connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(index_name, table_name, ', '.join(index_columns)))
+
+    connection.execute('CREATE TABLE IF NOT EXISTS loads (field_name TEXT, field_date TEXT, load_time TEXT, num_items INTEGER, '
+                       'num_item_references INTEGER, num_segments INTEGER, num_groups INTEGER, PRIMARY KEY (field_name, field_date))')
+
+def sql_value(value, kind):
+    '''Return value converted to what should be stored in a column of the specified kind.'''
+    if kind == 'int':
+        if value is None or not str(value).strip():
+            return None # missing, like plant numbers of codes.
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    return str(value)
+
+def insert_rows(connection, table_name, columns, key, value_rows):
+    '''Insert value rows (not counting key columns) into table in batches using a single prepared statement.'''
+    names = [name for name, _ in KEY_COLUMNS + columns]
+    kinds = [kind for _, kind in columns]
+    statement = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, ', '.join(names), ', '.join(['?'] * len(names)))
+    for start in range(0, len(value_rows), BATCH_SIZE):
+        batch = [key + tuple(sql_value(value, kind) for value, kind in zip(values, kinds)) for values in value_rows[start:start+BATCH_SIZE]]
+        connection.executemany(statement, batch)
+
+def group_result_values(segments):
+    '''Return list of group table values for every group that the segments belong to (in order they're first found).'''
+    groups = []
+    group_segments = {}
+    for segment in segments:
+        if segment.group is None:
+            continue
+        if id(segment.group) not in group_segments:
+            group_segments[id(segment.group)] = []
+            groups.append(segment.group)
+        group_segments[id(segment.group)].append(segment)
+
+    result_rows = []
+    for group in groups:
+        segments_in_group = group_segments[id(group)]
+        result_rows.append([group.id,
+                            group.alternate_id,
+                            group.expected_num_plants,
+                            len(group.segments),
+                            sum([len(segment.items) for segment in segments_in_group]),
+                            group.length])
+    return result_rows
+
+def load_results(db_filepath, field_name, field_date, items, rows, segments):
+    '''
+    Load averaged items, every reference of each item, segments and groups into SQLite database for the field/day.
+    Any results already loaded for the same field/day are replaced, but results of other fields/days are left alone.
+    Everything is done in one transaction so the database never has partial results.  Return number of rows loaded.
+    '''
+    key = (field_name, field_date)
+
+    # Each reference (including the item itself) is only converted once.
+    references = []
+    reference_item_indices = []
+    for item_index, item in enumerate(items):
+        for ref in item.all_refs:
+            references.append(ref)
+            reference_item_indices.append(item_index)
+    reference_values = item_result_values(references, rows)
+
+    # First reference of each item is the item itself.
+    item_values = []
+    reference_rows = []
+    for item_index, values in zip(reference_item_indices, reference_values):
+        if len(item_values) == item_index:
+            item_values.append([item_index] + values)
+        reference_rows.append([item_index] + values)
+
+    segment_rows = [[k] + values for k, values in enumerate(segment_result_values(segments))]
+    group_rows = [[k] + values for k, values in enumerate(group_result_values(segments))]
+    table_rows = {'items': item_values, 'item_references': reference_rows, 'segments': segment_rows, 'plant_groups': group_rows}
+
+    connection = sqlite3.connect(db_filepath)
+    try:
+        with connection:
+            create_tables(connection)
+            for table_name, columns in TABLES:
+                connection.execute('DELETE FROM {} WHERE field_name = ? AND field_date = ?'.format(table_name), key)
+                insert_rows(connection, table_name, columns, key, table_rows[table_name])
+            connection.execute('INSERT OR REPLACE INTO loads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               key + (time.strftime('%Y-%m-%d %H:%M:%S'), len(item_values), len(reference_rows), len(segment_rows), len(group_rows)))
+    finally:
+        connection.close()
+
+    return sum([len(table_rows[table_name]) for table_name, _ in TABLES])
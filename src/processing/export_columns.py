@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+
+import os
+import json
+
+# non-default import
+import numpy as np
+
+# Version of schema file so readers can tell if the format changes.
+SCHEMA_VERSION = 1
+
+# Value stored in integer columns when the value is missing (for example plant numbers of codes).
+MISSING_INT = -1
+
+def column_array(values, kind):
+    '''
+    Return (array, categories) for list of column values.  Categories is None unless kind is 'category' in which case
+    the array holds the index of each value in the categories list.
+    '''
+    if kind == 'float':
+        return np.array(values, dtype=np.float64), None
+    if kind == 'int':
+        return np.array([int(v) if str(v).strip() else MISSING_INT for v in values], dtype=np.int64), None
+    if kind == 'string':
+        # Fixed width so the column can be memory mapped.
+        values = [str(v) for v in values]
+        width = max([len(v) for v in values] + [1])
+        return np.array(values, dtype='S{}'.format(width)), None
+    if kind == 'category':
+        categories = []
+        category_indices = {}
+        indices = np.empty(len(values), dtype=np.int32)
+        for k, value in enumerate(values):
+            value = str(value)
+            try:
+                indices[k] = category_indices[value]
+            except KeyError:
+                category_indices[value] = len(categories)
+                indices[k] = len(categories)
+                categories.append(value)
+        return indices, categories
+    raise ValueError('Unknown column kind {}'.format(kind))
+
+def write_columns(out_directory, columns, value_rows):
+    '''
+    Write each column of value rows to its own .npy file in out directory along with a schema.json describing them.
+    Columns is a list of (name, kind) in the same order as the values in each row.  Kind is 'float', 'int', 'string' or
+    'category'.  Category columns are dictionary encoded and their values are listed in the schema.
+    '''
+    if not os.path.exists(out_directory):
+        os.makedirs(out_directory)
+
+    schema = {'version': SCHEMA_VERSION, 'num_rows': len(value_rows), 'columns': []}
+    for k, (name, kind) in enumerate(columns):
+        array, categories = column_array([values[k] for values in value_rows], kind)
+        filename = name + '.npy'
+        np.save(os.path.join(out_directory, filename), array)
+        column_info = {'name': name, 'kind': kind, 'dtype': array.dtype.str, 'file': filename}
+        if categories is not None:
+            column_info['categories'] = categories
+        schema['columns'].append(column_info)
+
+    with open(os.path.join(out_directory, 'schema.json'), 'w') as schema_file:
+        json.dump(schema, schema_file, indent=2)
+
+    return out_directory
+
+def read_columns(in_directory, mmap=True):
+    '''
+    Return (dictionary of column name -> array, schema) of columns written by write_columns.  Arrays are memory mapped
+    unless mmap is false.  Category columns hold indices into the 'categories' list of the column in the schema.
+    '''
+    with open(os.path.join(in_directory, 'schema.json'), 'r') as schema_file:
+        schema = json.load(schema_file)
+
+    columns = {}
+    for column_info in schema['columns']:
+        columns[column_info['name']] = np.load(os.path.join(in_directory, column_info['file']), mmap_mode='r' if mmap else None)
+
+    return columns, schema
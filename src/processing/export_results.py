@@ -2,83 +2,122 @@
 
 import os
 import csv
-import utm
+import itertools
+
+# Project imports
+from src.util.utm_conversion import positions_to_latlon
+from src.processing.export_columns import write_columns
  
-def export_results(items, rows, out_filepath):
-    '''Write all items to results file.'''
-    with open(out_filepath, 'wb') as out_file:
-        writer = csv.writer(out_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+# Columns of results file.
+RESULTS_HEADER = ['item_type',
+                  'id',
+                  'alternate_id',
+                  'planting_direction',
+                  'row',
+                  'range',
+                  'field_num',
+                  'row_num',
+                  'plant_field_num',
+                  'plant_row_num',
+                  'latitude',
+                  'longitude',
+                  'easting',
+                  'northing',
+                  'altitude',
+                  'zone',
+                  'field_x',
+                  'field_y',
+                  'field_z',
+                  'cropped_image_file_name',
+                  'parent_image_file_name',
+                  'bound_x_pix',
+                  'bound_y_pix',
+                  'bound_width_pix',
+                  'bound_height_pix',
+                  'bound_rotation,'
+                  ]
+
+# Name and kind of each results file column when written in columnar format. Same order as header.
+RESULT_COLUMNS = [('item_type', 'category'),
+                  ('id', 'string'),
+                  ('alternate_id', 'string'),
+                  ('planting_direction', 'category'),
+                  ('row', 'int'),
+                  ('range', 'int'),
+                  ('field_num', 'int'),
+                  ('row_num', 'int'),
+                  ('plant_field_num', 'int'),
+                  ('plant_row_num', 'int'),
+                  ('latitude', 'float'),
+                  ('longitude', 'float'),
+                  ('easting', 'float'),
+                  ('northing', 'float'),
+                  ('altitude', 'float'),
+                  ('zone', 'category'),
+                  ('field_x', 'float'),
+                  ('field_y', 'float'),
+                  ('field_z', 'float'),
+                  ('cropped_image_file_name', 'string'),
+                  ('parent_image_file_name', 'category'),
+                  ('bound_x_pix', 'int'),
+                  ('bound_y_pix', 'int'),
+                  ('bound_width_pix', 'int'),
+                  ('bound_height_pix', 'int'),
+                  ('bound_rotation', 'int')
+                  ]
+
+# Results file column index and format of columns that are rounded when written out as text.
+CSV_FLOAT_FORMATS = [(10, '{:.10f}'), (11, '{:.10f}'), (12, '{:.3f}'), (13, '{:.3f}'), (14, '{:.3f}'),
+                     (16, '{:.3f}'), (17, '{:.3f}'), (18, '{:.3f}')]
 
-        # Write out header
-        writer.writerow([
-                        'item_type',
-                        'id',
-                        'alternate_id',
-                        'planting_direction',
-                        'row',
-                        'range',
-                        'field_num',
-                        'row_num',
-                        'plant_field_num',
-                        'plant_row_num',
-                        'latitude',
-                        'longitude',
-                        'easting',
-                        'northing',
-                        'altitude',
-                        'zone',
-                        'field_x',
-                        'field_y',
-                        'field_z',
-                        'cropped_image_file_name',
-                        'parent_image_file_name',
-                        'bound_x_pix',
-                        'bound_y_pix',
-                        'bound_width_pix',
-                        'bound_height_pix',
-                        'bound_rotation,'
-                        ])
-
-        for item in items:
+def item_result_values(items, rows):
+    '''
+    Return list of unformatted results file values (one list for each item) in the same order as the header.
+    Positions of all items are converted to lat/long at once.
+    '''
+    # Use first row with each number like searching the list would.
+    row_directions = {}
+    for row in rows:
+        row_directions.setdefault(row.number, row.direction)
+        
+    # Convert easting/northing back to lat/long
+    positions = [item.position for item in items]
+    field_positions = [item.field_position for item in items]
+    latitudes, longitudes = positions_to_latlon(positions, [item.zone for item in items])
+    
+    result_rows = []
+    for item, position, field_position, lat, long in zip(items, positions, field_positions, latitudes.tolist(), longitudes.tolist()):
+        
+        has_group = hasattr(item, 'group') and item.group is not None
+        
+        if has_group and item.type != 'RowCode':
+            item_id = item.group.id
+            alternate_id = item.group.alternate_id
+        else:
+            item_id = item.name 
+            alternate_id = ''
+
+        # Row properties
+        row_direction = row_directions.get(item.row, 'N/A')
+            
+        plant_num_in_field = ' '
+        plant_num_in_row = ' '
+        if 'plant' in item.type.lower(): 
+            plant_num_in_field = item.plant_num_in_field
+            plant_num_in_row = item.plant_num_in_row
             
-            has_group = hasattr(item, 'group') and item.group is not None
+        bound_x_pix = -1
+        bound_y_pix = -1
+        bound_width_pix = -1
+        bound_height_pix = -1
+        bound_rotation = -1
+        if item.bounding_rect:
+            center, dim, theta = item.bounding_rect
+            bound_x_pix, bound_y_pix = center
+            bound_width_pix, bound_height_pix = dim
+            bound_rotation = theta
             
-            if has_group and item.type != 'RowCode':
-                item_id = item.group.id
-                alternate_id = item.group.alternate_id
-            else:
-                item_id = item.name 
-                alternate_id = ''
-
-            # Row properties
-            row_direction = 'N/A'
-            row = [row for row in rows if row.number == item.row]
-            if len(row) > 0:
-                row_direction = row[0].direction
-                
-            plant_num_in_field = ' '
-            plant_num_in_row = ' '
-            if 'plant' in item.type.lower(): 
-                plant_num_in_field = item.plant_num_in_field
-                plant_num_in_row = item.plant_num_in_row
-                
-            bound_x_pix = -1
-            bound_y_pix = -1
-            bound_width_pix = -1
-            bound_height_pix = -1
-            bound_rotation = -1
-            if item.bounding_rect:
-                center, dim, theta = item.bounding_rect
-                bound_x_pix, bound_y_pix = center
-                bound_width_pix, bound_height_pix = dim
-                bound_rotation = theta
-                
-            # Convert easting/northing back to lat/long
-            zone_letter = item.zone[-1]
-            zone_number = int(item.zone[:-1])
-            lat, long = utm.to_latlon(item.position[0], item.position[1], zone_number, zone_letter)
-                
-            writer.writerow([
+        result_rows.append([
                            item.type,
                            item_id,
                            alternate_id,
@@ -89,15 +128,15 @@ def export_results(items, rows, out_filepath):
                            item.number_within_row,
                            plant_num_in_field,
                            plant_num_in_row,
-                           '{:.10f}'.format(lat),
-                           '{:.10f}'.format(long),
-                           '{:.3f}'.format(item.position[0]),
-                           '{:.3f}'.format(item.position[1]),
-                           '{:.3f}'.format(item.position[2]),
+                           lat,
+                           long,
+                           position[0],
+                           position[1],
+                           position[2],
                            item.zone,
-                           '{:.3f}'.format(item.field_position[0]),
-                           '{:.3f}'.format(item.field_position[1]),
-                           '{:.3f}'.format(item.field_position[2]),
+                           field_position[0],
+                           field_position[1],
+                           field_position[2],
                            os.path.splitext(os.path.split(item.image_path)[1])[0],
                            os.path.splitext(item.parent_image_filename)[0],
                            int(bound_x_pix),
@@ -106,41 +145,107 @@ def export_results(items, rows, out_filepath):
                            int(bound_height_pix),
                            int(bound_rotation)
                            ])
+        
+    return result_rows
+
+def format_result_values(values):
+    '''Return copy of results file values with positions rounded the same way as the results file.'''
+    row = list(values)
+    for index, float_format in CSV_FLOAT_FORMATS:
+        row[index] = float_format.format(row[index])
+    return row
 
+def item_result_rows(items, rows):
+    '''Return list of formatted results file rows (one for each item).'''
+    return [format_result_values(values) for values in item_result_values(items, rows)]
+
+def write_result_rows(result_rows, out_filepath):
+    '''Write header and already formatted result rows to results file.'''
+    with open(out_filepath, 'wb') as out_file:
+        writer = csv.writer(out_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(RESULTS_HEADER)
+        writer.writerows(result_rows)
+
+def export_results(items, rows, out_filepath):
+    '''Write all items to results file.'''
+    write_result_rows(item_result_rows(items, rows), out_filepath)
     return out_filepath
 
+def export_all_results(items, codes, rows, segments, all_filepath, averaged_filepath, codes_filepath, segments_filepath, columns_directory=None):
+    '''
+    Write every reference of items, the averaged items, just the codes and the segments to their own results files.
+    Each item is only converted and formatted once even though it can show up in more than one file.
+    If columns directory is provided then the same results are also written there in columnar binary format.
+    '''
+    all_output_items = [ref for item in items for ref in item.all_refs]
+    
+    unique_items = []
+    row_indices = {}
+    for item in itertools.chain(all_output_items, items, codes):
+        if id(item) not in row_indices:
+            row_indices[id(item)] = len(unique_items)
+            unique_items.append(item)
+    result_values = item_result_values(unique_items, rows)
+    result_rows = [format_result_values(values) for values in result_values]
+    
+    write_result_rows([result_rows[row_indices[id(item)]] for item in all_output_items], all_filepath)
+    write_result_rows([result_rows[row_indices[id(item)]] for item in items], averaged_filepath)
+    write_result_rows([result_rows[row_indices[id(item)]] for item in codes], codes_filepath)
+    export_group_segments(segments, segments_filepath)
+    
+    if columns_directory is not None:
+        for name, table_items in [('all', all_output_items), ('averaged', items), ('just_codes', codes)]:
+            table_values = [result_values[row_indices[id(item)]] for item in table_items]
+            write_columns(os.path.join(columns_directory, name), RESULT_COLUMNS, table_values)
+        write_columns(os.path.join(columns_directory, 'segments'), SEGMENT_COLUMNS, segment_result_values(segments))
+
+# Columns of segments file.
+SEGMENTS_HEADER = ['group_id',
+                   'start_code_data',
+                   'end_code_data',
+                   'expected_num_items',
+                   'actual_num_items',
+                   'segment_length',
+                   'next_segment_start_code_data'
+                   ]
+
+# Name and kind of each segments file column when written in columnar format.
+SEGMENT_COLUMNS = [('group_id', 'string'),
+                   ('start_code_data', 'string'),
+                   ('end_code_data', 'string'),
+                   ('expected_num_items', 'int'),
+                   ('actual_num_items', 'int'),
+                   ('segment_length', 'float'),
+                   ('next_segment_start_code_data', 'string')
+                   ]
+
+def segment_result_values(segments):
+    '''Return list of segments file values (one list for each segment) in the same order as the header.'''
+    result_rows = []
+    for seg in segments:
+        
+        group_id = seg.group.id if seg.group else -1
+        
+        next_segment_code_data = ''
+        if seg.next_segment:
+            next_segment_code_data = seg.next_segment.start_code.name
+        
+        result_rows.append([
+                            group_id,
+                            seg.start_code.name,
+                            seg.end_code.name,
+                            seg.expected_num_plants,
+                            len(seg.items),
+                            seg.length,
+                            next_segment_code_data
+                           ])
+    return result_rows
+
 def export_group_segments(segments, out_filepath):
     '''Write all groups to results file.'''
     with open(out_filepath, 'wb') as out_file:
         writer = csv.writer(out_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(SEGMENTS_HEADER)
+        writer.writerows(segment_result_values(segments))
 
-        # Write out header
-        writer.writerow([
-                        'group_id',
-                        'start_code_data',
-                        'end_code_data',
-                        'expected_num_items',
-                        'actual_num_items',
-                        'segment_length',
-                        'next_segment_start_code_data'
-                        ])
-
-        for seg in segments:
-            
-            group_id = seg.group.id if seg.group else -1
-            
-            next_segment_code_data = ''
-            if seg.next_segment:
-                next_segment_code_data = seg.next_segment.start_code.name
-            
-            writer.writerow([
-                             group_id,
-                             seg.start_code.name,
-                             seg.end_code.name,
-                             seg.expected_num_plants,
-                             len(seg.items),
-                             seg.length,
-                             next_segment_code_data
-                            ])
-
-    return out_filepath
\ No newline at end of file
+    return out_filepath
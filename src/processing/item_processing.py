@@ -1,10 +1,12 @@
 #! /usr/bin/env python
 
 import os
+import itertools
 from math import sqrt
 
 # OpenCV imports
 import cv2
+import numpy as np
 
 # Project imports
 from src.extraction.item_extraction import *
@@ -126,31 +128,48 @@ def order_items(items, camera_rotation):
     
 def merge_items(items, max_distance):
     '''Return new list of items with all duplicates removed and instead can be referenced through surviving items.'''
+    return link_duplicate_items(find_duplicate_items(items, max_distance))
+
+def find_duplicate_items(items, max_distance):
+    '''Return list of (unique item, list of duplicates of that item) without adding duplicates as references yet.'''
     unique_items = []
+    duplicates = []
     for item in items:
-        matching_item = None
-        for comparision_item in unique_items:
+        matching_index = None
+        for k, comparision_item in enumerate(unique_items):
             if is_same_item(item, comparision_item, max_distance):
-                matching_item = comparision_item
+                matching_index = k
                 break
-        if matching_item is None:
+        if matching_index is None:
             #print 'No matching item for {} adding to list'.format(item.name)
             unique_items.append(item)
+            duplicates.append([])
         else:
-            # We've already stored this same item so just have the one we stored reference this one.
-            matching_item.other_items.append(item)
+            duplicates[matching_index].append(item)
             
+    return zip(unique_items, duplicates)
+
+def link_duplicate_items(unique_items_and_duplicates):
+    '''Have each unique item reference its duplicates (which averages their positions) and return list of unique items.'''
+    unique_items = []
+    for item, duplicates in unique_items_and_duplicates:
+        for duplicate in duplicates:
+            item.add_other_item(duplicate)
+        unique_items.append(item)
     return unique_items
 
 def get_subset_of_geo_images(geo_images, debug_start, debug_stop):
     '''Return start and stop indices in geo_images corresponding to the substrings in debug start/stop'''
-    geo_image_filenames = [g.file_name for g in geo_images]
+    return get_subset_of_file_names([g.file_name for g in geo_images], debug_start, debug_stop)
+
+def get_subset_of_file_names(geo_image_filenames, debug_start, debug_stop):
+    '''Return start and stop indices in geo image file names corresponding to the substrings in debug start/stop'''
     start_geo_index = index_containing_substring(geo_image_filenames, debug_start)
     if start_geo_index < 0:
         start_geo_index = 0
     stop_geo_index = index_containing_substring(geo_image_filenames, debug_stop)
     if stop_geo_index < 0:
-        stop_geo_index = len(geo_images) - 1
+        stop_geo_index = len(geo_image_filenames) - 1
         
     return start_geo_index, stop_geo_index
 
@@ -179,6 +198,23 @@ def calculate_geo_image_corners(geo_image):
     geo_image.bottom_right_position = calculate_pixel_position(geo_image.width, geo_image.height, geo_image)
     geo_image.bottom_left_position = calculate_pixel_position(0, geo_image.height, geo_image)
         
+def calculate_geo_images_corners(geo_images):
+    '''Update corner positions of every geo image at once. Same result as calling calculate_geo_image_corners on each.'''
+    if len(geo_images) == 0:
+        return
+    
+    # Top left, top right, bottom right, bottom left pixels of each image.
+    pixel_xs = [[0, geo_image.width, geo_image.width, 0] for geo_image in geo_images]
+    pixel_ys = [[0, 0, geo_image.height, geo_image.height] for geo_image in geo_images]
+    eastings, northings, altitudes = calculate_pixel_positions_in_images(pixel_xs, pixel_ys, geo_images)
+    
+    corners = np.dstack((eastings, northings, altitudes)).tolist()
+    for geo_image, image_corners in zip(geo_images, corners):
+        geo_image.top_left_position = tuple(image_corners[0])
+        geo_image.top_right_position = tuple(image_corners[1])
+        geo_image.bottom_right_position = tuple(image_corners[2])
+        geo_image.bottom_left_position = tuple(image_corners[3])
+        
 def position_difference(position1, position2):
     '''Return difference in XY positions between both items.'''
     delta_x = position1[0] - position2[0]
@@ -283,6 +319,34 @@ def lateral_and_projection_distance_2d(p, a, b):
     
     return lateral_error, a_to_b_traveled_mag
 
+def lateral_and_projection_distances_2d(xs, ys, a, b):
+    '''
+    Return arrays of (lateral errors, projections) from positions (xs, ys) to vector from points (a) to (b).
+    Same math (in same order) as lateral_and_projection_distance_2d so results are identical.
+    '''
+    a_to_b = (b[0] - a[0], b[1] - a[1])
+    a_to_b_mag = sqrt(a_to_b[0]*a_to_b[0] + a_to_b[1]*a_to_b[1])
+    
+    if a_to_b_mag == 0.0:
+        print "Warning: Vector from point a to b has zero magnitude. Returning NaN."
+        return np.full(len(xs), np.nan), np.full(len(xs), np.nan)
+    
+    a_to_p_x = xs - a[0]
+    a_to_p_y = ys - a[1]
+    
+    a_to_b_traveled_mag = (a_to_p_x*a_to_b[0] + a_to_p_y*a_to_b[1]) / a_to_b_mag
+    a_to_b_traveled_x = a_to_b[0] * a_to_b_traveled_mag / a_to_b_mag
+    a_to_b_traveled_y = a_to_b[1] * a_to_b_traveled_mag / a_to_b_mag
+    
+    dx = a_to_p_x - a_to_b_traveled_x
+    dy = a_to_p_y - a_to_b_traveled_y
+    lateral_error_magnitudes = np.sqrt(dx * dx + dy * dy)
+    
+    path_cross_position_z = a_to_b[0]*a_to_p_y - a_to_b[1]*a_to_p_x
+    lateral_error_signs = np.where(path_cross_position_z < 0.0, -1.0, 1.0)
+    
+    return lateral_error_signs * lateral_error_magnitudes, a_to_b_traveled_mag
+
 def projection_to_position_2d(projection, a, b):
     '''Return position associated with projecting along vector from points (a) to (b).'''
     a_to_b = (b[0] - a[0], b[1] - a[1])
@@ -391,8 +455,11 @@ def apply_code_modifications(modifications, geo_images, all_codes, output_direct
                     
     return geo_images, all_codes
 
-def calculate_field_positions_and_range(rows, base_items, items_to_calculate, geo_images=None):
-    
+def calculate_field_frame(rows, base_items):
+    '''
+    Return (shift, angle) that transform easting-northing positions into the field frame where 'y' runs along rows
+    and the smallest base item position is at the origin.
+    '''
     # use field angle to calculate range for each item.
     field_angle = np.mean([row.angle for row in rows])
     
@@ -400,38 +467,57 @@ def calculate_field_positions_and_range(rows, base_items, items_to_calculate, ge
     correction_angle = math.radians(90) - field_angle 
     
     # Find min/max of rotated coordinate so that after rotating the shift will be correct.
-    rotated_x = []
-    rotated_y = []
-    base_z = []
-    for item in base_items:
-        x, y, z = rotate2d(item.position, correction_angle)
-        rotated_x.append(x)
-        rotated_y.append(y)
-        base_z.append(z)
-    min_x = min(rotated_x)
-    min_y = min(rotated_y)
-    min_z = min(base_z)
+    rotated = rotate_positions([item.position for item in base_items], correction_angle)
     
     # How much to shift regular positions after they've been rotated.
-    field_shift = (min_x, min_y, min_z)
+    field_shift = tuple(rotated.min(axis=0).tolist())
+    
+    return field_shift, correction_angle
+
+def calculate_field_positions_and_range(rows, base_items, items_to_calculate, geo_images=None):
+    '''Assign field position to each item (and its references) and geo image, and range to each item.'''
+    field_shift, correction_angle = calculate_field_frame(rows, base_items)
 
-    # Now go through and assign field positions to each item.
+    # Now go through and assign field positions to each item and its references using where each one was measured.
+    refs = []
+    calculated_ids = set()
     for item in items_to_calculate:
-        item.field_position = rotate_and_shift(item.position, field_shift, correction_angle)
+        for ref in item.all_refs:
+            if id(ref) in calculated_ids:
+                continue
+            calculated_ids.add(id(ref))
+            refs.append(ref)
+    
+    if len(refs) > 0:
+        field_positions = rotate_and_shift_positions([ref.measured_position for ref in refs], field_shift, correction_angle)
+        for ref, field_position in zip(refs, position_tuples(field_positions)):
+            ref.field_position = field_position
         
+    if len(items_to_calculate) > 0:
         # scale range so that there are around 5 plants in each unit.
         # TODO use actual plant spacing here instead of hardcoding scale.
         # Add one to reference off 1 like row number.
         range_units_per_meter = 0.25;
-        item.range = int(item.field_position[1] * range_units_per_meter) + 1
+        field_ys = np.array([item.field_position[1] for item in items_to_calculate], dtype=np.float64)
+        # Truncate towards zero like int()
+        ranges = (field_ys * range_units_per_meter).astype(np.int64) + 1
+        for item, item_range in zip(items_to_calculate, ranges.tolist()):
+            item.range = item_range
         
-    if geo_images is not None:
+    if geo_images is not None and len(geo_images) > 0:
+        # Center followed by the 4 corners for each image.
+        positions = []
         for geo_image in geo_images:
-            geo_image.field_position = rotate_and_shift(geo_image.position, field_shift, correction_angle)
-            geo_image.top_left_field_position = rotate_and_shift(geo_image.top_left_position, field_shift, correction_angle)
-            geo_image.top_right_field_position = rotate_and_shift(geo_image.top_right_position, field_shift, correction_angle)
-            geo_image.bottom_right_field_position = rotate_and_shift(geo_image.bottom_right_position, field_shift, correction_angle)
-            geo_image.bottom_left_field_position = rotate_and_shift(geo_image.bottom_left_position, field_shift, correction_angle)
+            positions += [geo_image.position, geo_image.top_left_position, geo_image.top_right_position,
+                          geo_image.bottom_right_position, geo_image.bottom_left_position]
+        field_positions = position_tuples(rotate_and_shift_positions(positions, field_shift, correction_angle))
+        for k, geo_image in enumerate(geo_images):
+            image_positions = field_positions[k*5:k*5+5]
+            geo_image.field_position = image_positions[0]
+            geo_image.top_left_field_position = image_positions[1]
+            geo_image.top_right_field_position = image_positions[2]
+            geo_image.bottom_right_field_position = image_positions[3]
+            geo_image.bottom_left_field_position = image_positions[4]
             
 def rotate2d(position, angle_rad):
     
@@ -446,5 +532,30 @@ def rotate_and_shift(position, shift, angle_rad):
     y -= shift[1]
     z -= shift[2]
     return (x, y, z)
-            
-        
\ No newline at end of file
+
+def rotate_positions(positions, angle_rad):
+    '''Return Nx3 array of (x,y,z) positions rotated in the XY plane. Same math as rotate2d.'''
+    positions = positions_to_array(positions)
+    cos_angle = math.cos(angle_rad)
+    sin_angle = math.sin(angle_rad)
+    rotated = np.empty_like(positions)
+    rotated[:, 0] = positions[:, 0] * cos_angle - positions[:, 1] * sin_angle
+    rotated[:, 1] = positions[:, 0] * sin_angle + positions[:, 1] * cos_angle
+    rotated[:, 2] = positions[:, 2]
+    return rotated
+
+def rotate_and_shift_positions(positions, shift, angle_rad):
+    '''Return Nx3 array of positions rotated and then shifted. Same math as rotate_and_shift.'''
+    rotated = rotate_positions(positions, angle_rad)
+    rotated -= np.array(shift, dtype=np.float64)
+    return rotated
+
+def positions_to_array(positions):
+    '''Return Nx3 array of list of (x,y,z) positions.'''
+    if isinstance(positions, np.ndarray):
+        return positions.astype(np.float64).reshape(-1, 3)
+    return np.fromiter(itertools.chain.from_iterable(positions), dtype=np.float64, count=len(positions) * 3).reshape(-1, 3)
+
+def position_tuples(positions):
+    '''Return list of (x,y,z) tuples of Nx3 position array.'''
+    return zip(positions[:, 0].tolist(), positions[:, 1].tolist(), positions[:, 2].tolist())
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+import copy
+import multiprocessing
+
+# Project imports
+from src.data.field_grouping import PlantGroupSegment
+from src.util.clustering import cluster_global_plant_parts
+
+def detached_item_copy(item):
+    '''Return shallow copy of field item without references to other items or groups so it's cheap to send to another process.'''
+    item_copy = copy.copy(item)
+    # Keep averaged positions since references aren't copied.
+    item_copy._position = item.position
+    item_copy._field_position = item.field_position
+    item_copy._position_summary = None
+    item_copy._field_position_summary = None
+    item_copy._other_items = []
+    item_copy._owner = None
+    if hasattr(item_copy, '_group'):
+        item_copy._group = None
+    return item_copy
+
+def detached_segment_copy(segment):
+    '''Return segment with just copies of start/end codes. Doesn't include group, items or geo images.'''
+    return PlantGroupSegment(detached_item_copy(segment.start_code), detached_item_copy(segment.end_code))
+
+def map_tasks(function, tasks, num_processes):
+    '''Return list of function results for each task. Uses a process pool if more than one process is requested.'''
+    if num_processes <= 1 or len(tasks) <= 1:
+        return map(function, tasks)
+    pool = multiprocessing.Pool(min(num_processes, len(tasks)))
+    try:
+        results = pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def cluster_image_task(task):
+    '''
+    Return possible plants clustered from an image's plant parts.  Task is (global parts, segment, max plant size,
+    max plant part distance, image altitude).
+    '''
+    global_parts, segment, max_plant_size, max_plant_part_distance, image_altitude = task
+    return cluster_global_plant_parts(global_parts, segment, max_plant_size, max_plant_part_distance, image_altitude)
+
+def locate_plants_task(task):
+    '''
+    Return tuple of (actual plants, filters) for segment.  Task is (segment, possible plants, filters) where filters
+    is (normal plant filter, closest plant filter, plant spacing filter).  Filters are copied so returned filters only
+    contain counts from this segment.
+    '''
+    segment, possible_plants, plant_filters = task
+    normal_plant_filter, closest_plant_filter, plant_spacing_filter = [copy.copy(plant_filter) for plant_filter in plant_filters]
+
+    if segment.is_special:
+        selected_plant = closest_plant_filter.find_actual_plant(possible_plants, segment)
+        actual_plants = [selected_plant]
+    else:
+        actual_plants = normal_plant_filter.locate_actual_plants_in_segment(possible_plants, segment)
+        plant_spacing_filter.filter(actual_plants)
+
+    return actual_plants, (normal_plant_filter, closest_plant_filter, plant_spacing_filter)
+
+def add_filter_counts(plant_filters, segment_filters):
+    '''Add counts from filters used on a single segment to the filters used for all segments.'''
+    normal_plant_filter, closest_plant_filter, plant_spacing_filter = plant_filters
+    segment_normal_filter, segment_closest_filter, segment_spacing_filter = segment_filters
+
+    normal_plant_filter.num_successfully_found_plants += segment_normal_filter.num_successfully_found_plants
+    normal_plant_filter.num_created_plants += segment_normal_filter.num_created_plants
+    closest_plant_filter.num_successfully_found_plants += segment_closest_filter.num_successfully_found_plants
+    closest_plant_filter.num_created_because_no_plants += segment_closest_filter.num_created_because_no_plants
+    plant_spacing_filter.num_plants_moved += segment_spacing_filter.num_plants_moved
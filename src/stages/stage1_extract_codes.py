@@ -8,13 +8,13 @@ import csv
 import datetime
 
 # Project imports
-from src.util.image_utils import list_images, verify_geo_images
+from src.util.image_utils import list_images, verify_geo_image_table
 from src.util.stage_io import pickle_results, write_args_to_file
 from src.util.image_writer import ImageWriter
-from src.util.parsing import parse_geo_file
+from src.util.parsing import parse_geo_table
 from src.extraction.code_finder import CodeFinder
 from src.extraction.missed_code_finder import MissedCodeFinder
-from src.processing.item_processing import process_geo_image, merge_items, get_subset_of_geo_images
+from src.processing.item_processing import process_geo_image, merge_items, get_subset_of_file_names
 from exit_reason import ExitReason
     
 def stage1_extract_codes(**args):
@@ -67,7 +67,8 @@ def stage1_extract_codes(**args):
     
     print "\nFound {} images to process".format(len(image_filenames))
     
-    geo_images = parse_geo_file(image_geo_file, provided_resolution, camera_height)
+    # Geo images are only created once they're processed.
+    geo_images = parse_geo_table(image_geo_file, provided_resolution, camera_height)
             
     print "Parsed {} geo images".format(len(geo_images))
     
@@ -76,15 +77,15 @@ def stage1_extract_codes(**args):
         return ExitReason.no_geo_images
     
     # Look for start/stop filenames so user doesn't have to process all images.
-    start_geo_index, stop_geo_index = get_subset_of_geo_images(geo_images, debug_start, debug_stop)
+    start_geo_index, stop_geo_index = get_subset_of_file_names(geo_images.file_names, debug_start, debug_stop)
         
     print "Processing geo images {} through {}".format(start_geo_index, stop_geo_index)
     geo_images = geo_images[start_geo_index : stop_geo_index+1]
         
     print "Sorting images by timestamp."
-    geo_images = sorted(geo_images, key=lambda image: image.image_time)
+    geo_images = geo_images.sorted_by_time()
     
-    geo_images, missing_image_count = verify_geo_images(geo_images, image_filenames)
+    geo_images, missing_image_count = verify_geo_image_table(geo_images, image_filenames)
            
     if missing_image_count > 0:
         print "Warning {} geo images do not exist and will be skipped.".format(missing_image_count)
@@ -128,6 +129,8 @@ def stage1_extract_codes(**args):
     missed_code_filename = "missed_codes_{}.txt".format(postfix_id)
     missed_code_finder.write_out_missed_codes(codes, missed_code_filename, missed_codes_out_directory)
   
+    # Also creates any geo images that weren't processed (if user interrupted) so they're all saved.
+    geo_images = list(geo_images)
     dump_filename = "stage1_output_{}_{}_{}.s1".format(postfix_id, int(geo_images[0].image_time), int(geo_image.image_time))
     print "Serializing {} geo images and {} codes to {}.".format(len(geo_images), len(codes), dump_filename)
     pickle_results(dump_filename, out_directory, geo_images, codes)
@@ -7,7 +7,7 @@ import os
 from src.util.grouping import *
 from src.util.stage_io import unpickle_stage1_output, pickle_results, write_args_to_file
 from src.util.parsing import parse_code_listing_file, parse_code_modifications_file
-from src.processing.item_processing import merge_items, apply_code_modifications, calculate_field_positions_and_range
+from src.processing.item_processing import find_duplicate_items, link_duplicate_items, apply_code_modifications, calculate_field_positions_and_range
 from src.stages.exit_reason import ExitReason
 
 def stage2_group_codes(**args):
@@ -47,8 +47,10 @@ def stage2_group_codes(**args):
         code_modifications = parse_code_modifications_file(code_modifications_filepath)
         geo_images, all_codes = apply_code_modifications(code_modifications, geo_images, all_codes, modifications_out_directory)
 
-    # Merge items so they're unique.  One code references other instances of that same code.
-    merged_codes = merge_items(all_codes, max_distance=500)
+    # Find duplicates so codes are unique.  Duplicates aren't referenced (and averaged in) until field positions are
+    # calculated so rows and the field frame are found from where each code was first seen.
+    unique_codes_and_duplicates = find_duplicate_items(all_codes, max_distance=500)
+    merged_codes = [code for code, duplicates in unique_codes_and_duplicates]
 
     print '{} unique codes.'.format(len(merged_codes))
                 
@@ -102,8 +104,9 @@ def stage2_group_codes(**args):
     
     print "Calculating field positions."
     calculate_field_positions_and_range(rows, merged_codes, all_codes, geo_images)
-    for code in merged_codes:
-        code.refresh_fields()
+    
+    # Now one code references other instances of that same code so its position is the average of all of them.
+    link_duplicate_items(unique_codes_and_duplicates)
     
     print "Calculating projections to nearest row"
     codes_with_projections = calculate_projection_to_nearest_row(group_codes + single_codes, rows)
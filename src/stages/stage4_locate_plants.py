@@ -7,14 +7,15 @@ import copy
 
 # Project imports
 from src.util.stage_io import unpickle_stage3_output, pickle_results, write_args_to_file
-from src.util.stage_io import debug_draw_plants_in_images
+from src.util.stage_io import DebugPlantRenderer
 from src.stages.exit_reason import ExitReason
 from src.processing.item_processing import all_segments_from_rows
-from src.util.clustering import cluster_rectangle_items, cluster_geo_image_items
-from src.util.clustering import corner_rect_center, filter_out_noise, merge_corner_rectangles
-from src.util.plant_localization import RecursiveSplitPlantFilter, ClosestSinglePlantFilter, PlantSpacingFilter
-from src.extraction.item_extraction import extract_global_plants_from_images
-from src.util.image_writer import ImageWriter
+from src.util.clustering import cluster_rectangle_items, ClusterCache
+from src.processing.segment_processing import detached_segment_copy, map_tasks
+from src.processing.segment_processing import cluster_image_task, locate_plants_task, add_filter_counts
+from src.util.clustering import corner_rect_center, filter_out_noise, merge_corner_rectangles, fuse_possible_plants
+from src.util.plant_localization import RecursiveSplitPlantFilter, SpacingDPPlantFilter, ClosestSinglePlantFilter, PlantSpacingFilter
+from src.extraction.item_extraction import map_global_plants_to_images, extract_plant_images
 
 def stage4_locate_plants(**args):
     ''' 
@@ -43,11 +44,21 @@ def stage4_locate_plants(**args):
     spacing_filter_thresh = float(args.pop('spacing_filter_thresh'))
     extract_images = args.pop('extract_images').lower() == 'true'
     debug_marked_image = args.pop('marked_image').lower() == 'true'
+    marked_image_scale = float(args.pop('marked_image_scale'))
+    marked_image_quality = int(args.pop('marked_image_quality'))
+    num_processes = int(args.pop('num_processes'))
+    split_processes = int(args.pop('split_processes'))
+    fuse_distance = float(args.pop('fuse_distance')) / 100.0 # convert to meters
+    localization_engine = args.pop('localization_engine').lower()
     
     if len(args) > 0:
         print "Unexpected arguments provided: {}".format(args)
         return ExitReason.bad_arguments
     
+    if localization_engine not in ['recursive', 'dp']:
+        print "Invalid localization engine {}. Must be 'recursive' or 'dp'.".format(localization_engine)
+        return ExitReason.bad_arguments
+    
     rows = unpickle_stage3_output(input_filepath)
     
     if len(rows) == 0:
@@ -60,19 +71,34 @@ def stage4_locate_plants(**args):
     all_segments = all_segments_from_rows(rows)
 
     # Use different filters for normal vs. single segments
-    normal_plant_filter = RecursiveSplitPlantFilter(start_code_spacing, end_code_spacing, plant_spacing, lateral_penalty, projection_penalty, 
-                                                    closeness_penalty, stick_multiplier, leaf_multiplier, tag_multiplier)
+    if localization_engine == 'dp':
+        normal_plant_filter = SpacingDPPlantFilter(start_code_spacing, end_code_spacing, plant_spacing, lateral_penalty, projection_penalty, 
+                                                   closeness_penalty, stick_multiplier, leaf_multiplier, tag_multiplier)
+    else:
+        normal_plant_filter = RecursiveSplitPlantFilter(start_code_spacing, end_code_spacing, plant_spacing, lateral_penalty, projection_penalty, 
+                                                        closeness_penalty, stick_multiplier, leaf_multiplier, tag_multiplier, split_processes)
     closest_plant_filter = ClosestSinglePlantFilter(single_max_dist)
     
     # Use a spacing filter for detecting and fixing any mis-chosen plants.
     plant_spacing_filter = PlantSpacingFilter(spacing_filter_thresh)
     
+    # Each segment uses copies of these filters and then the counts are added back in.
+    plant_filters = (normal_plant_filter, closest_plant_filter, plant_spacing_filter)
+    
     if extract_images:
-        ImageWriter.level = ImageWriter.NORMAL
         image_out_directory = os.path.join(out_directory, 'images/')
     else:
         image_out_directory = None
     
+    # Possible plants clustered from each image. Reused between segments that need the same plant parts.
+    cluster_cache = ClusterCache(max_plant_size, max_plant_part_distance)
+    
+    # First pass through segments (in order) to find every image that needs to be clustered.  This is done before
+    # any processing so that each image is only clustered once even when segments are processed in parallel.
+    segments_to_process = []
+    cluster_tasks = []
+    cluster_keys = []
+    scheduled_keys = set()
     for seg_num, segment in enumerate(all_segments):
     
         #if segment.start_code.name != 'TBJ':
@@ -94,26 +120,43 @@ def stage4_locate_plants(**args):
                 continue
         except AttributeError:
             pass # This used to not be supported so it's not a big deal if segment is missing property 
+        
+        segments_to_process.append(segment)
             
         # Cluster together leaves, stick parts and tags into possible plants
-        possible_plants = []
         for geo_image in segment.geo_images:
-            if 'possible_plants' in geo_image.items:
-                # Already clustered this image.
-                possible_plants += geo_image.items['possible_plants']
-            else:
-                possible_plants += cluster_geo_image_items(geo_image, segment, max_plant_size, max_plant_part_distance)
+            key = cluster_cache.key(geo_image, segment)
+            if cluster_cache.contains(key) or key in scheduled_keys:
+                continue # Already clustered this image for this type of segment.
+            # Only send plant parts and segment codes in case clustering is done in another process.
+            cluster_tasks.append((cluster_cache.global_parts(geo_image), detached_segment_copy(segment), max_plant_size, 
+                                  max_plant_part_distance, geo_image.position[2]))
+            cluster_keys.append(key)
+            scheduled_keys.add(key)
+    
+    print "\nClustering {} images using {} processes".format(len(cluster_tasks), num_processes)
+    clustered_images = map_tasks(cluster_image_task, cluster_tasks, num_processes)
+    for key, geo_image_possible_plants in zip(cluster_keys, clustered_images):
+        cluster_cache.store(key, geo_image_possible_plants)
+    
+    located_segments = []
+    locate_tasks = []
+    # Image of each plant is extracted (and marked up) after all segments so that each image only needs to be opened once.
+    plant_images = []
+    debug_renderer = DebugPlantRenderer() if debug_marked_image else None
+    for segment in segments_to_process:
+        
+        possible_plants_by_image = [cluster_cache.possible_plants(geo_image, segment) for geo_image in segment.geo_images]
                 
-        if len(possible_plants) == 0:
+        if sum([len(image_plants) for image_plants in possible_plants_by_image]) == 0:
             print "Warning: segment {} has no possible plants.".format(segment.start_code.name)
             continue
         
         # Remove small parts that didn't get clustered.
-        possible_plants = filter_out_noise(possible_plants)
+        possible_plants_by_image = [filter_out_noise(image_plants) for image_plants in possible_plants_by_image]
+        possible_plants = [plant for image_plants in possible_plants_by_image for plant in image_plants]
 
-        print "{} possible plants found between all images".format(len(possible_plants))
-    
-        print "clustered down to {} possible plants".format(len(possible_plants))
+        print "{} possible plants found between all images in segment {}".format(len(possible_plants), segment.start_code.name)
     
         # Find UTM positions of possible plants so that they can be easily compared between different images.
         last_plant = None
@@ -140,17 +183,28 @@ def stage4_locate_plants(**args):
             
             last_plant = plant
             
+        if fuse_distance > 0:
+            # Merge the same plant seen in different images into one possible plant.
+            possible_plants = fuse_possible_plants(possible_plants_by_image, fuse_distance)
+            print "fused down to {} possible plants".format(len(possible_plants))
+            
         if segment.start_code.type == 'RowCode' and segment.end_code.type == 'SingleCode':
             # Special case... don't want to process this segment since there shouldn't be a plant associated with it.
             continue
         
-        if segment.is_special:
-            selected_plant = closest_plant_filter.find_actual_plant(possible_plants, segment)
-            actual_plants = [selected_plant] 
-        else:
-            actual_plants = normal_plant_filter.locate_actual_plants_in_segment(possible_plants, segment)
-            plant_spacing_filter.filter(actual_plants)
-            print "{} actual plants found".format(len(actual_plants))
+        located_segments.append(segment)
+        locate_tasks.append((detached_segment_copy(segment), possible_plants, plant_filters))
+        
+    print "\nLocating plants in {} segments using {} processes".format(len(locate_tasks), num_processes)
+    located_plants = map_tasks(locate_plants_task, locate_tasks, num_processes)
+    
+    # Merge results back in same order segments would have been processed in serially.
+    for segment, task, (actual_plants, segment_filters) in zip(located_segments, locate_tasks, located_plants):
+        
+        add_filter_counts(plant_filters, segment_filters)
+        
+        if not segment.is_special:
+            print "{} actual plants found in segment {}".format(len(actual_plants), segment.start_code.name)
             
         # Now that plant filter has run make sure all created plants have a bounding rectangle so they show up in output images.
         for plant in actual_plants:
@@ -159,15 +213,23 @@ def stage4_locate_plants(**args):
                 po = .12 # plant offset in meters
                 plant.bounding_rect = [(px-po,py-po), (px-po,py+po), (px+po,py-po), (px+po,py+po)] 
         
-        extract_global_plants_from_images(actual_plants, segment.geo_images, image_out_directory)
+        plant_images += map_global_plants_to_images(actual_plants, segment.geo_images)
                 
         for plant in actual_plants:
             plant.row = segment.row_number
             segment.add_item(plant)
         
-        if debug_marked_image:
+        if debug_renderer is not None:
             if len(actual_plants) > 0:
-                debug_draw_plants_in_images(segment.geo_images, possible_plants, actual_plants, out_directory)
+                possible_plants = task[1]
+                debug_renderer.add_segment(segment.geo_images, possible_plants, actual_plants)
+
+    if image_out_directory is not None:
+        print "\nExtracting {} plant images".format(len(plant_images))
+        extract_plant_images(plant_images, image_out_directory)
+        
+    if debug_renderer is not None:
+        debug_renderer.render(out_directory, marked_image_scale, marked_image_quality)
 
     print "\n---------Normal Groups----------"
     print 'Successfully found {} total plants'.format(normal_plant_filter.num_successfully_found_plants)
@@ -207,8 +269,14 @@ if __name__ == '__main__':
     parser.add_argument('-pp', dest='projection_penalty', default=1, help='Higher value penalizes larger values along projected line.')
     parser.add_argument('-cp', dest='closeness_penalty', default=1, help='Higher value penalizes distances from current item.')
     parser.add_argument('-st', dest='spacing_filter_thresh', default=1.5, help='If you take the ratio of distances between 3 consecutive plants and its greater than this value then the center plant will be centered between the outside 2 plants.')
-    parser.add_argument('-ei', dest='extract_images', default='false', help='If true then will extract image of each plant. This can take a while.  Default false.')
+    parser.add_argument('-ei', dest='extract_images', default='false', help='If true then will extract image of each plant.  Default false.')
     parser.add_argument('-mk', dest='marked_image', default='false', help='If true then will output marked up image.  Default false.')
+    parser.add_argument('-le', dest='localization_engine', default='recursive', help="How plants are selected in normal segments. 'recursive' splits segments from both ends. 'dp' finds the lowest penalty plant sequence for the whole segment at once. Default 'recursive'.")
+    parser.add_argument('-ms', dest='marked_image_scale', default=1, help='Scale (e.g. 0.25) to resize marked up images by before writing them out.  Default 1.')
+    parser.add_argument('-mq', dest='marked_image_quality', default=0, help='If greater than 0 then marked up images are written as JPEGs with this quality (1-100).  Default 0 (same format as original image).')
+    parser.add_argument('-sp', dest='split_processes', default=1, help='How many processes to use for splitting up segments with 1000+ possible plants. Only used if -np is 1. Default 1.')
+    parser.add_argument('-fd', dest='fuse_distance', default=0, help='Possible plants from different images closer than this distance (in centimeters) are merged before filtering. Helps most when plants are unevenly spaced. Default 0 (disabled).')
+    parser.add_argument('-np', dest='num_processes', default=1, help='How many processes to use for clustering and locating plants in segments.  Default 1.')
     
     args = vars(parser.parse_args())
     
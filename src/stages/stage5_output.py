@@ -18,41 +18,56 @@ from src.util.parsing import parse_survey_file
 from src.analysis.stage2_output_analysis import warn_about_missing_single_code_lengths
 from src.processing.item_processing import calculate_field_positions_and_range, all_segments_from_rows
 from src.processing.item_processing import position_difference
-from src.processing.export_results import export_group_segments, export_results
-from src.util.numbering import number_serpentine
+from src.processing.export_results import export_all_results
+from src.processing.db_loader import load_results
+from src.util.numbering import number_items, NUMBERING_LAYOUTS
 from src.util.survey import *
 
-if __name__ == '__main__':
-    '''Output results.'''
-
-    parser = argparse.ArgumentParser(description='''Output results.''')
-    parser.add_argument('input_filepath', help='pickled file from stage 4.')
-    parser.add_argument('output_directory', help='where to write output files')
-    parser.add_argument('-s', dest='survey_filepath', default='none', help='File containing hand-surveyed items.')
-    parser.add_argument('-c', dest='convert_coords', default='true', help='If true then will convert all coordinates to match survey file. Default true.')
-    parser.add_argument('-ps', dest='plant_spacing', default=0, help='Expect plant spacing in meters.  If provided then will run spacing checks on single code plants.')
-    parser.add_argument('-ns', dest='field_num_start', default=1, help='First number of first item used for numbering within field.  Default 1.')
-    
-    args = parser.parse_args()
-    
+def stage5_output(**args):
+    ''' 
+    Number items, verify against survey and write results out to files.
+    args should match the names and descriptions of command line parameters,
+    but unlike command line, all arguments must be present.
+    '''
     # convert command line arguments
-    input_filepath = args.input_filepath
-    out_directory = args.output_directory
-    survey_filepath = args.survey_filepath
-    convert_coords = args.convert_coords.lower() == 'true'
-    plant_spacing = float(args.plant_spacing)
-    field_num_start = int(args.field_num_start)
+    input_filepath = args.pop('input_filepath')
+    out_directory = args.pop('output_directory')
+    survey_filepath = args.pop('survey_filepath')
+    convert_coords = args.pop('convert_coords').lower() == 'true'
+    rigid_transform = args.pop('rigid_transform').lower() == 'true'
+    plant_spacing = float(args.pop('plant_spacing'))
+    field_num_start = int(args.pop('field_num_start'))
+    numbering_layout = args.pop('numbering_layout').lower()
+    columnar_output = args.pop('columnar_output').lower() == 'true'
+    db_filepath = args.pop('db_filepath')
+    field_name = args.pop('field_name')
+    field_date = args.pop('field_date')
+    
+    if len(args) > 0:
+        print "Unexpected arguments provided: {}".format(args)
+        return ExitReason.bad_arguments
+    
+    if numbering_layout not in NUMBERING_LAYOUTS:
+        print "Numbering layout {} isn't one of {}".format(numbering_layout, NUMBERING_LAYOUTS)
+        return ExitReason.bad_arguments
+    
+    if db_filepath != 'none' and field_name == 'none':
+        print "Field name must be provided to load results into database."
+        return ExitReason.bad_arguments
+    
+    if field_date == 'none':
+        field_date = time.strftime('%Y-%m-%d')
 
     rows = unpickle_stage4_output(input_filepath)
     
     print 'Loaded {} rows'.format(len(rows))
     
     if len(rows) == 0:
-        sys.exit(ExitReason.no_rows)
+        return ExitReason.no_rows
     
     rows = sorted(rows, key=lambda r: r.number)
     
-    items = number_serpentine(rows, field_num_start)
+    items = number_items(rows, field_num_start, numbering_layout)
     
     print 'Found {} items in rows.'.format(len(items))
     
@@ -96,10 +111,15 @@ if __name__ == '__main__':
     if survey_filepath != 'none':
         if not os.path.exists(survey_filepath):
             print "Survey file doesn't exist {}".format(survey_filepath)
-            sys.exit(ExitReason.bad_arguments)
+            return ExitReason.bad_arguments
         else:
             survey_items = parse_survey_file(survey_filepath)
-            if convert_coords:
+            if convert_coords and rigid_transform:
+                print "Converting coordinates with rigid transform"
+                angle, item_center, survey_center = calculate_rigid_transform(items, survey_items)
+                print "Rotating {} degrees".format(math.degrees(angle))
+                transform_coordinates(items, angle, item_center, survey_center)
+            elif convert_coords:
                 print "Converting coordinates"
                 east_offset, north_offset = calculate_east_north_offsets(items, survey_items)
                 convert_coordinates(items, east_offset, north_offset)
@@ -107,32 +127,29 @@ if __name__ == '__main__':
             # Now that items are in same coordinates run accuracy checks
             run_survey_verification(items, survey_items)
             
-    # Write everything out to CSV file to be imported into database.
-    all_results_filename = time.strftime('results_all-%Y%m%d-%H%M%S.csv')
-    all_results_filepath = os.path.join(out_directory, all_results_filename)
-    all_output_items = [ref for item in items for ref in item.all_refs]
-    export_results(all_output_items, rows, all_results_filepath)
-    print "Exported all results to " + all_results_filepath
-    
-    # Output all averaged results to one file.
-    avg_results_filename = time.strftime("results_averaged-%Y%m%d-%H%M%S.csv")
-    avg_results_filepath = os.path.join(out_directory, avg_results_filename)
+    # Write everything out to CSV files to be imported into database.
+    # All references, averaged results, just codes and group segments each get their own file.
+    all_results_filepath = os.path.join(out_directory, time.strftime('results_all-%Y%m%d-%H%M%S.csv'))
+    avg_results_filepath = os.path.join(out_directory, time.strftime("results_averaged-%Y%m%d-%H%M%S.csv"))
+    just_codes_results_filepath = os.path.join(out_directory, time.strftime("results_just_codes-%Y%m%d-%H%M%S.csv"))
+    segment_results_filepath = os.path.join(out_directory, time.strftime("results_segments-%Y%m%d-%H%M%S.csv"))
+    columns_directory = None
+    if columnar_output:
+        columns_directory = os.path.join(out_directory, time.strftime("results_columns-%Y%m%d-%H%M%S"))
+    all_segments = all_segments_from_rows(rows)
     print 'Output averaged {} items'.format(len(items))
-    export_results(items, rows, avg_results_filepath)
+    export_all_results(items, codes, rows, all_segments, all_results_filepath, avg_results_filepath,
+                       just_codes_results_filepath, segment_results_filepath, columns_directory)
+    print "Exported all results to " + all_results_filepath
     print "Exported averaged results to " + avg_results_filepath
-    
-    # And output just codes to another file.
-    just_codes_results_filename = time.strftime("results_just_codes-%Y%m%d-%H%M%S.csv")
-    just_codes_results_filepath = os.path.join(out_directory, just_codes_results_filename)
-    export_results(codes, rows, just_codes_results_filepath)
     print "Exported just code results to " + just_codes_results_filepath
-
-    # Output group segments to a file.
-    segment_results_filename = time.strftime("results_segments-%Y%m%d-%H%M%S.csv")
-    segment_results_filepath = os.path.join(out_directory, segment_results_filename)
-    all_segments = all_segments_from_rows(rows)
-    export_group_segments(all_segments, segment_results_filepath)
     print "Exported segment results to " + segment_results_filepath
+    if columns_directory is not None:
+        print "Exported columnar results to " + columns_directory
+        
+    if db_filepath != 'none':
+        num_loaded = load_results(db_filepath, field_name, field_date, items, rows, all_segments)
+        print "Loaded {} rows for field {} on {} into database {}".format(num_loaded, field_name, field_date, db_filepath)
 
     if len(plant_spacings) > 0:
         avg_results_filename = time.strftime("plant_spacings-%Y%m%d-%H%M%S.csv")
@@ -141,4 +158,31 @@ if __name__ == '__main__':
             csv_writer = csv.writer(spacingfile)
             for spacing in plant_spacings:
                 csv_writer.writerow([spacing])
-            
+
+    return ExitReason.success
+    
+if __name__ == '__main__':
+    '''Output results.'''
+
+    parser = argparse.ArgumentParser(description='''Output results.''')
+    parser.add_argument('input_filepath', help='pickled file from stage 4.')
+    parser.add_argument('output_directory', help='where to write output files')
+    parser.add_argument('-s', dest='survey_filepath', default='none', help='File containing hand-surveyed items.')
+    parser.add_argument('-c', dest='convert_coords', default='true', help='If true then will convert all coordinates to match survey file. Default true.')
+    parser.add_argument('-rt', dest='rigid_transform', default='false', help='If true then coordinates are converted using best fit rotation and translation instead of just a shift. Default false.')
+    parser.add_argument('-ps', dest='plant_spacing', default=0, help='Expect plant spacing in meters.  If provided then will run spacing checks on single code plants.')
+    parser.add_argument('-ns', dest='field_num_start', default=1, help='First number of first item used for numbering within field.  Default 1.')
+    parser.add_argument('-nl', dest='numbering_layout', default='serpentine', help='How items are numbered. serpentine (even rows numbered backwards), parallel (every row in field direction) or pass (every row in planting direction). Default serpentine.')
+    parser.add_argument('-db', dest='db_filepath', default='none', help='SQLite database file to load items, segments and groups into. Created if it does not exist. Default none.')
+    parser.add_argument('-fn', dest='field_name', default='none', help='Name of field used to identify results in database. Required if database is provided.')
+    parser.add_argument('-fd', dest='field_date', default='none', help='Date (YYYY-MM-DD) used to identify results in database. Results already loaded for the same field and date are replaced. Default today.')
+    parser.add_argument('-co', dest='columnar_output', default='false', help='If true then results are also written as memory-mappable .npy columns with a schema.json in each table directory. Default false.')
+    
+    args = vars(parser.parse_args())
+    
+    exit_code = stage5_output(**args)
+    
+    if exit_code == ExitReason.bad_arguments:
+        print "\nSee --help for argument descriptions."
+    
+    sys.exit(exit_code)
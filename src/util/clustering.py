@@ -108,25 +108,83 @@ def merge_clusters(c1, c2):
     merged_item_center = corner_rect_center(merged_rect)
     return {'rect':merged_rect, 'items':merged_items, 'rect_center':merged_item_center}
  
-def cluster_geo_image_items(geo_image, segment, max_plant_size, max_plant_part_distance):
-    # Merge items into possible plants, while referencing rectangle off global coordinates so we can
-    # compare rectangles between multiple images.
+def global_plant_parts(geo_image):
+    '''Return tuple of (leaves, stick parts, tags) found in geo image with rectangles converted to global coordinates.'''
     leaves = [{'item_type':'leaf', 'rect':rect_to_global(rect, geo_image)} for rect in geo_image.items['leaves']]
     stick_parts = [{'item_type':'stick_part', 'rect':rect_to_global(rect, geo_image)} for rect in geo_image.items['stick_parts']]
     tags = [{'item_type':'tag', 'rect':rect_to_global(rect, geo_image)} for rect in geo_image.items['tags']]
+    return leaves, stick_parts, tags
+
+def cluster_variant(segment):
+    '''Return key for which plant parts are clustered for segment. Special segments only use leaves that aren't close to start code.'''
+    if segment.is_special:
+        return ('special', segment.start_code.name, tuple(segment.start_code.position))
+    return ('normal',)
+
+def cluster_global_plant_parts(global_parts, segment, max_plant_size, max_plant_part_distance, image_altitude):
+    '''Return possible plants clustered from global plant parts (leaves, stick parts, tags) using the parts that segment needs.'''
+    # Copy parts since clustering modifies them and the same parts are used for every variant.
+    leaves, stick_parts, tags = [[dict(part) for part in parts] for parts in global_parts]
     
     if segment.is_special:
         plant_parts = leaves # no blue sticks in single plants
         plant_parts = remove_plant_parts_close_to_code(plant_parts, segment.start_code, 0.04)
     else:
         plant_parts = leaves + stick_parts + tags
-    geo_image_possible_plants = cluster_rectangle_items(plant_parts, max_plant_part_distance, max_plant_size)
+    possible_plants = cluster_rectangle_items(plant_parts, max_plant_part_distance, max_plant_size)
     
-    for plant in geo_image_possible_plants:
-        plant['image_altitude'] = geo_image.position[2]
+    for plant in possible_plants:
+        plant['image_altitude'] = image_altitude
     
-    geo_image.items['possible_plants'] = geo_image_possible_plants
-    return geo_image_possible_plants
+    return possible_plants
+
+def cluster_geo_image_items(geo_image, segment, max_plant_size, max_plant_part_distance):
+    '''
+    Merge items into possible plants, while referencing rectangle off global coordinates so we can
+    compare rectangles between multiple images.
+    '''
+    return cluster_global_plant_parts(global_plant_parts(geo_image), segment, max_plant_size, max_plant_part_distance, geo_image.position[2])
+
+class ClusterCache(object):
+    '''
+    Possible plants clustered from each image.  The result depends on which plant parts the segment uses and on
+    the clustering parameters, so it's stored by (image, variant, parameters).  Global plant parts are stored
+    by image so they're only converted once no matter how many variants are clustered.
+    '''
+    def __init__(self, max_plant_size, max_plant_part_distance):
+        '''Constructor.  Sizes are in meters.'''
+        self.max_plant_size = max_plant_size
+        self.max_plant_part_distance = max_plant_part_distance
+        self._global_parts = {} # image filename -> (leaves, stick parts, tags)
+        self._possible_plants = {} # cache key -> list of possible plants
+    
+    def key(self, geo_image, segment):
+        '''Return key that possible plants are stored under for image when clustered for segment.'''
+        return (geo_image.file_name, cluster_variant(segment), self.max_plant_size, self.max_plant_part_distance)
+    
+    def global_parts(self, geo_image):
+        '''Return (leaves, stick parts, tags) in global coordinates for image.'''
+        try:
+            return self._global_parts[geo_image.file_name]
+        except KeyError:
+            parts = global_plant_parts(geo_image)
+            self._global_parts[geo_image.file_name] = parts
+            return parts
+    
+    def contains(self, key):
+        return key in self._possible_plants
+    
+    def store(self, key, possible_plants):
+        '''Store possible plants that were clustered somewhere else (e.g. another process).'''
+        self._possible_plants[key] = possible_plants
+    
+    def possible_plants(self, geo_image, segment):
+        '''Return possible plants for image clustered for segment. Only clusters the first time.'''
+        key = self.key(geo_image, segment)
+        if key not in self._possible_plants:
+            self._possible_plants[key] = cluster_global_plant_parts(self.global_parts(geo_image), segment, self.max_plant_size,
+                                                                    self.max_plant_part_distance, geo_image.position[2])
+        return self._possible_plants[key]
 
 def cluster_rectangle_items(items, max_spacing, max_size):
     ''''''
@@ -181,6 +239,75 @@ def filter_out_noise(possible_plants):
                 filtered_possible_plants.append(possible_plant)
     return filtered_possible_plants
 
+def fuse_possible_plants(possible_plants_by_image, max_distance):
+    '''
+    Return list of possible plants where plants from different images that are within max distance (in meters) are
+    merged together.  Plants from the same image are never merged.  A merged plant is positioned at the mean of the
+    plants it replaces but only keeps the parts of the one with the most parts, so the same part seen in several images
+    isn't counted more than once.  Possible plants must already have a 'position'.  Uses a grid of max distance sized
+    cells so each plant is only compared to nearby plants.
+    '''
+    grid = {} # cell -> indices of fused plants whose center falls in that cell
+    fused_plants = [] # each has list of member plants, set of image indices and sum of member x/y positions
+    
+    def grid_cell(x, y):
+        return (int(math.floor(x / max_distance)), int(math.floor(y / max_distance)))
+    
+    for image_index, image_plants in enumerate(possible_plants_by_image):
+        for plant in image_plants:
+            x, y = plant['position'][0], plant['position'][1]
+            cell_x, cell_y = grid_cell(x, y)
+            closest_index = None
+            closest_distance = sys.float_info.max
+            for neighbor_cell in itertools.product(range(cell_x-1, cell_x+2), range(cell_y-1, cell_y+2)):
+                for fused_index in grid.get(neighbor_cell, []):
+                    fused = fused_plants[fused_index]
+                    if image_index in fused['images']:
+                        continue
+                    num_members = len(fused['members'])
+                    distance = position_difference((x, y), (fused['sum_x'] / num_members, fused['sum_y'] / num_members))
+                    if distance <= max_distance and distance < closest_distance:
+                        closest_index = fused_index
+                        closest_distance = distance
+                        
+            if closest_index is None:
+                closest_index = len(fused_plants)
+                fused_plants.append({'members': [], 'images': set(), 'sum_x': 0.0, 'sum_y': 0.0})
+                old_cell = None
+            else:
+                fused = fused_plants[closest_index]
+                old_cell = grid_cell(fused['sum_x'] / len(fused['members']), fused['sum_y'] / len(fused['members']))
+                
+            fused = fused_plants[closest_index]
+            fused['members'].append(plant)
+            fused['images'].add(image_index)
+            fused['sum_x'] += x
+            fused['sum_y'] += y
+            
+            # Keep fused plant in the cell that its center is currently in.
+            new_cell = grid_cell(fused['sum_x'] / len(fused['members']), fused['sum_y'] / len(fused['members']))
+            if new_cell != old_cell:
+                if old_cell is not None:
+                    grid[old_cell].remove(closest_index)
+                grid.setdefault(new_cell, []).append(closest_index)
+    
+    possible_plants = []
+    for fused in fused_plants:
+        members = fused['members']
+        if len(members) == 1:
+            plant = members[0]
+        else:
+            # First of the members with the most parts.
+            most_parts_member = max(members, key=lambda member: len(member.get('items', [member])))
+            merged_rect = merge_corner_rectangles([member['rect'] for member in members])
+            plant = {'rect': merged_rect,
+                     'items': most_parts_member.get('items', [most_parts_member]),
+                     'rect_center': corner_rect_center(merged_rect),
+                     'position': tuple(np.mean([member['position'] for member in members], axis=0))}
+        possible_plants.append(plant)
+        
+    return possible_plants
+
 def remove_plant_parts_close_to_code(plant_parts, code, closest_dist):
     '''Return updated plant part list such that none are within 'closest_dist' of code.'''
     filtered_plant_parts = []
@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+import os
+from multiprocessing.pool import ThreadPool
+
+def walk_files(directory):
+    '''Return list of (directory path, file name) of every file in directory and its subdirectories in os.walk order.'''
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        files += [(dirpath, filename) for filename in filenames]
+    return files
+
+def list_files(directory, recursive=True, num_threads=1):
+    '''
+    Return list of (directory path, file name) of every file in directory in the same order as os.walk.
+    If recursive then subdirectories are included and each top level subdirectory (for example one per camera)
+    can be walked in its own thread since most of the time is spent waiting on the file system.
+    '''
+    if not recursive:
+        for (dirpath, dirnames, filenames) in os.walk(directory):
+            return [(dirpath, filename) for filename in filenames] # only walk top level directory
+        return []
+
+    if num_threads <= 1:
+        return walk_files(directory)
+
+    # Same as the first step of os.walk so the results are put together in the same order.
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    is_directory = [os.path.isdir(os.path.join(directory, name)) for name in names]
+    files = [(directory, name) for name, is_dir in zip(names, is_directory) if not is_dir]
+    # os.walk doesn't follow links to directories.
+    subdirectories = [os.path.join(directory, name) for name, is_dir in zip(names, is_directory)
+                      if is_dir and not os.path.islink(os.path.join(directory, name))]
+
+    pool = ThreadPool(num_threads)
+    try:
+        for subdirectory_files in pool.map(walk_files, subdirectories):
+            files += subdirectory_files
+    finally:
+        pool.close()
+        pool.join()
+
+    return files
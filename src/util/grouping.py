@@ -1,22 +1,29 @@
 #! /usr/bin/env python
 
 import sys
-import copy
-from collections import defaultdict, namedtuple
+import bisect
+from collections import defaultdict, namedtuple, OrderedDict
 
 # Project imports
 from src.data.field_item import GroupCode
 from src.data.field_grouping import Row, PlantGroup, PlantGroupSegment
 from src.processing.item_processing import orient_items, lateral_and_projection_distance_2d, position_difference
 
+def index_by_key(items, key):
+    '''Return dictionary of key(item) -> item. If multiple items have the same key then the first one is used.'''
+    index = {}
+    for item in items:
+        index.setdefault(key(item), item)
+    return index
+
 def associate_ids_to_entry_rep(group_codes, grouping_info):
     # Update group codes with entry x rep
+    info_by_id = index_by_key(grouping_info, lambda info: info[0])
     num_matched_ids_to_info = 0
     for group_code in group_codes:
-        matching_info = [info for info in grouping_info if info[0] == group_code.name]
-        if len(matching_info) == 0:
+        matching_info = info_by_id.get(group_code.name)
+        if matching_info is None:
             continue
-        matching_info = matching_info[0]
         group_code.entry = matching_info[1]
         group_code.rep = matching_info[2]
         num_matched_ids_to_info += 1
@@ -32,45 +39,40 @@ def group_row_codes(row_codes):
 
 def group_row_codes_by_pass_name(row_codes):
     # Group row codes in dictionary by row code name (not counting last character for L/R direction).
-    paired_codes = [False] * len(row_codes)
+    # Codes are keyed by row number and side (R or L) so each key should have exactly one start and one end code.
+    # Keys are kept in the order they're first seen so errors and pairs come out in the same order as the codes.
+    codes_by_row_and_side = OrderedDict()
+    for code in row_codes:
+        side = code.name[-1].lower() # right or left (R or L)
+        codes_by_row_and_side.setdefault((code.row, side), []).append(code)
+        
     grouped_codes = []
-    for i, code in enumerate(row_codes):
-        if paired_codes[i]:
-            continue # already paired this code
+    for matching_codes in codes_by_row_and_side.itervalues():
+        code = matching_codes[0]
+        if len(matching_codes) == 1:
+            print "Couldn't find a match for row code {} found in image {}".format(code.name, code.parent_image_filename)
+            continue
+        
+        other_code = matching_codes[1]
         dir = code.name[3:5].lower() # start or end (St or En)
-        side = code.name[-1].lower() # right or left (R or L)
+        other_dir = other_code.name[3:5].lower()
         
-        for j, other_code in enumerate(row_codes):
-            if paired_codes[j]:
-                continue # already paired this code
-            if i == j:
-                continue # don't compare a code with itself
-            other_dir = other_code.name[3:5].lower()
-            other_side = other_code.name[-1].lower()
+        if dir == other_dir:
+            print "Error: Found duplicates pass codes {} and {}".format(code.name, other_code.name)
+            sys.exit(-1)
             
-            if (code.row == other_code.row) and (side == other_side):
-                if paired_codes[i]:
-                    print "Error: Found multiple matches for code {}".format(code.name)
-                    sys.exit(-1)
-                if dir == other_dir:
-                    print "Error: Found duplicates pass codes {} and {}".format(code.name, other_code.name)
-                    sys.exit(-1)
-                    
-                # Make sure first element in group tuple is the start code
-                if dir == 'st' and other_dir == 'en':
-                    grouped_codes.append((code, other_code))
-                elif other_dir == 'st' and dir == 'en':
-                    grouped_codes.append((other_code, code))
-                else:
-                    print "Error: Bad pass code formats, should be one 'st' and one 'en'. Codes: {} and {}".format(code.name, other_code.name)
-                    sys.exit(-1)
-                    
-                # Mark that we've already paired the codes so they don't get re-paired
-                paired_codes[i] = True
-                paired_codes[j] = True
-                
-        if not paired_codes[i]:
-            print "Couldn't find a match for row code {} found in image {}".format(code.name, code.parent_image_filename)
+        # Make sure first element in group tuple is the start code
+        if dir == 'st' and other_dir == 'en':
+            grouped_codes.append((code, other_code))
+        elif other_dir == 'st' and dir == 'en':
+            grouped_codes.append((other_code, code))
+        else:
+            print "Error: Bad pass code formats, should be one 'st' and one 'en'. Codes: {} and {}".format(code.name, other_code.name)
+            sys.exit(-1)
+            
+        if len(matching_codes) > 2:
+            print "Error: Found multiple matches for code {}".format(code.name)
+            sys.exit(-1)
         
     return grouped_codes
 
@@ -282,10 +284,24 @@ def create_rows_and_field_passes_by_row_codes(grouped_row_codes, field_direction
     
     return rows, field_passes
 
-def calculate_projection_to_nearest_row(codes, rows):
+def closest_row_indices(row_xs, x, max_rows):
+    '''
+    Return indices of up to max_rows rows that are closest to x, closest first. Row x positions must be sorted.
+    Rows that are the same distance away stay in sorted order.
+    '''
+    i = bisect.bisect_left(row_xs, x)
+    
+    # Closest rows have to be within max_rows on either side, but if rows share the same x then keep
+    # going on the left side since those come first when sorted.
+    lo = max(0, i - max_rows)
+    while lo > 0 and row_xs[lo - 1] == row_xs[lo]:
+        lo -= 1
+    hi = min(len(row_xs), i + max_rows)
     
-    # Copy rows so we can add temporary fields without modifying original
-    rows = copy.copy(rows)
+    candidates = sorted(range(lo, hi), key=lambda k: abs(row_xs[k] - x))
+    return candidates[:max_rows]
+
+def calculate_projection_to_nearest_row(codes, rows):
     
     CodeWithProjection = namedtuple('CodeWithProjection', 'code projection')
     codes_with_projections = []
@@ -293,47 +309,46 @@ def calculate_projection_to_nearest_row(codes, rows):
     # Order codes and rows from left to right
     codes = sorted(codes, key=lambda c: c.field_position[0])
     rows = sorted(rows, key=lambda r: r.center_field_position[0])
+    row_xs = [row.center_field_position[0] for row in rows]
     
-    for row in rows:
-        row.ordered_items = [row.start_code, row.end_code]
+    # Items in each row ordered by field 'y' (along row) along with the matching 'y' values so they can be bisected.
+    row_items = [[row.start_code, row.end_code] for row in rows]
+    row_item_ys = [[item.field_position[1] for item in items] for items in row_items]
     
     for code in codes:
         
-        rows_with_distance_to_code = [(row, abs(row.center_field_position[0] - code.field_position[0])) for row in rows]
-        sorted_rows_with_distance_to_code = sorted(rows_with_distance_to_code, key=lambda r: r[1])
-        closest_rows_to_code = [row[0] for row in sorted_rows_with_distance_to_code[:4]]
+        code_y = code.field_position[1]
         
         min_distance = sys.float_info.max
-        closest_row = None
-        closest_after_in_closest_row = None
-        for row in closest_rows_to_code:
+        closest_row_index = None
+        closest_after_index = None
+        for row_index in closest_row_indices(row_xs, code.field_position[0], 4):
             
-            closest_beneath = None
-            closest_after = None
-            for item in row.ordered_items:
-                if code.field_position[1] > item.field_position[1]:
-                    closest_beneath = item
-                else:
-                    closest_after = item
-                    break
+            # First item that isn't beneath code.
+            after_index = bisect.bisect_left(row_item_ys[row_index], code_y)
 
-            if closest_beneath is None or closest_after is None:
+            if after_index == 0 or after_index == len(row_items[row_index]):
                 continue # not in this row for sure
+            
+            closest_beneath = row_items[row_index][after_index - 1]
+            closest_after = row_items[row_index][after_index]
 
             distance_to_code, _ = lateral_and_projection_distance_2d(code.field_position, closest_beneath.field_position, closest_after.field_position)
             distance_to_code = abs(distance_to_code)
             
             if distance_to_code < min_distance:
                 min_distance = distance_to_code
-                closest_after_in_closest_row = closest_after
-                closest_row = row
+                closest_after_index = after_index
+                closest_row_index = row_index
                 
-        if closest_row is not None and min_distance < 3: # TODO remove hard-coded value
+        if closest_row_index is not None and min_distance < 3: # TODO remove hard-coded value
             
-            _, row_projection = lateral_and_projection_distance_2d(code.field_position, row.start_code.field_position, row.end_code.field_position)
+            closest_row = rows[closest_row_index]
             
-            closest_item_idx = closest_row.ordered_items.index(closest_after_in_closest_row)
-            closest_row.ordered_items.insert(closest_item_idx, code)
+            _, row_projection = lateral_and_projection_distance_2d(code.field_position, closest_row.start_code.field_position, closest_row.end_code.field_position)
+            
+            row_items[closest_row_index].insert(closest_after_index, code)
+            row_item_ys[closest_row_index].insert(closest_after_index, code_y)
             
             code.row = closest_row.number
             codes_with_projections.append(CodeWithProjection(code, row_projection))
@@ -345,10 +360,14 @@ def calculate_projection_to_nearest_row(codes, rows):
 
 def create_segments(codes_with_projections, rows):
     
+    codes_by_row = defaultdict(list)
+    for code in codes_with_projections:
+        codes_by_row[code.code.row].append(code)
+    
     group_segments = [] 
     special_segments = [] # segments that start with a SingleCode
     for row in rows:
-        codes_in_row = [code for code in codes_with_projections if code.code.row == row.number]
+        codes_in_row = codes_by_row.get(row.number, [])
         if len(codes_in_row) == 0:
             print "No codes in row {}. Creating pseudo group code at start.".format(row.number)
             pseudo_code1 = GroupCode(name='PS{}'.format(row.number), position=row.start_code.position, 
@@ -459,14 +478,15 @@ def handle_single_segments(single_segments, groups):
 
 def apply_code_listings(code_listings, groups, alternate_ids_included):
     
+    listings_by_id = index_by_key(code_listings, lambda listing: listing.id)
+    
     for group in groups:
         
-        matched_listings = [listing for listing in code_listings if group.start_code.name == listing.id]
+        matched_listing = listings_by_id.get(group.start_code.name)
         
-        if len(matched_listings) == 0:
+        if matched_listing is None:
             continue # no match
         
-        matched_listing = matched_listings[0]
         group.expected_num_plants = matched_listing.max_plants
         if alternate_ids_included:
             group.start_code.alternate_id = matched_listing.alternate_id
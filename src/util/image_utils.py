@@ -43,24 +43,40 @@ def make_filename_unique(directory, fname_no_ext):
 
     return fname_no_ext
 
+def find_image_extensions(file_names, image_filenames):
+    '''
+    Return list of the extension (without the dot) of the actual image matching each file name (that doesn't have an extension),
+    or None if there isn't a matching image.  If more than one image has the same name then the first one is used.
+    '''
+    extensions_by_name = {}
+    for fname in image_filenames:
+        name, extension = os.path.splitext(fname)
+        extensions_by_name.setdefault(name, extension[1:])
+    return [extensions_by_name.get(file_name) for file_name in file_names]
+
 def verify_geo_images(geo_images, image_filenames):
     '''Verify each geo image exists in specified image file names. Return # missing images.'''
     missing_image_count = 0
     matching_geo_images = []
-    image_filenames_no_ext = [os.path.splitext(fname)[0] for fname in image_filenames]
-    for geo_image in geo_images:
-        try:
-            # Make sure actual image exists and use it's file extension.
-            index = image_filenames_no_ext.index(geo_image.file_name)
-            extension = os.path.splitext(image_filenames[index])[1][1:]
-            geo_image.file_name = "{0}.{1}".format(geo_image.file_name, extension)
-            matching_geo_images.append(geo_image)
-        except ValueError:
+    extensions = find_image_extensions([geo_image.file_name for geo_image in geo_images], image_filenames)
+    for geo_image, extension in zip(geo_images, extensions):
+        if extension is None:
             # Geo image doesn't have corresponding actual image
             missing_image_count += 1
+            continue
+        # Make sure actual image exists and use it's file extension.
+        geo_image.file_name = "{0}.{1}".format(geo_image.file_name, extension)
+        matching_geo_images.append(geo_image)
             
     return matching_geo_images, missing_image_count
 
+def verify_geo_image_table(geo_table, image_filenames):
+    '''Same as verify_geo_images, but for a GeoImageTable so geo images don't have to be created. Return (matching table, # missing images).'''
+    extensions = find_image_extensions(geo_table.file_names, image_filenames)
+    matching_indices = [k for k, extension in enumerate(extensions) if extension is not None]
+    matching_file_names = ["{0}.{1}".format(geo_table.file_names[k], extensions[k]) for k in matching_indices]
+    return geo_table.subset(matching_indices, matching_file_names), len(extensions) - len(matching_indices)
+
 def index_containing_substring(the_list, substring):
     for i, s in enumerate(the_list):
         if substring in s:
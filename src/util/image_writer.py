@@ -1,6 +1,8 @@
 #! /usr/bin/env python
 
 import os
+import threading
+import Queue
 import cv2
 
 class ImageWriter(object):
@@ -39,12 +41,19 @@ class ImageWriter(object):
     @staticmethod
     def make_filename_unique(directory, fname):
         
-        fname_no_ext, ext = os.path.splitext(fname)
-        original_fname = fname_no_ext
         dir_contents = os.listdir(directory)
         dir_fnames = [os.path.splitext(c)[0] for c in dir_contents]
         
-        while fname_no_ext in dir_fnames:
+        return ImageWriter.unique_filename(fname, dir_fnames)
+    
+    @staticmethod
+    def unique_filename(fname, existing_fnames):
+        '''Return file name with a number appended (or incremented) so it isn't in existing file names (without extensions).'''
+        
+        fname_no_ext, ext = os.path.splitext(fname)
+        original_fname = fname_no_ext
+        
+        while fname_no_ext in existing_fnames:
             
             try:
                 v = fname_no_ext.split('_')
@@ -54,4 +63,56 @@ class ImageWriter(object):
             except ValueError:
                 fname_no_ext = '{}_{}'.format(original_fname, 1)
     
-        return fname_no_ext + ext
\ No newline at end of file
+        return fname_no_ext + ext
+    
+class BackgroundImageWriter(object):
+    '''
+    Write images from a background thread so encoding and disk access overlap with processing.  File paths are
+    reserved before images are queued so they're unique even though nothing has been written yet.
+    '''
+    
+    def __init__(self, max_queued_images=32):
+        # Limit queue size so images waiting to be written don't use up too much memory.
+        self.queue = Queue.Queue(max_queued_images)
+        self.reserved_fnames = {} # directory -> set of file names (without extension) already used.
+        self.num_failed = 0
+        self.thread = threading.Thread(target=self._write_queued_images)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def reserve_filepath(self, directory, fname):
+        '''Return unique file path in directory for file name. Directory is created if it doesn't exist.'''
+        if directory not in self.reserved_fnames:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self.reserved_fnames[directory] = set([os.path.splitext(c)[0] for c in os.listdir(directory)])
+        existing_fnames = self.reserved_fnames[directory]
+        unique_fname = ImageWriter.unique_filename(fname, existing_fnames)
+        existing_fnames.add(os.path.splitext(unique_fname)[0])
+        return os.path.join(directory, unique_fname)
+        
+    def write(self, filepath, image, params=None):
+        '''Queue image to be written to file path (that should have been reserved). Params are passed to imwrite.'''
+        self.queue.put((filepath, image, params))
+        
+    def close(self):
+        '''Wait for all queued images to be written. Return number of images that couldn't be written.'''
+        self.queue.put(None)
+        self.thread.join()
+        return self.num_failed
+        
+    def _write_queued_images(self):
+        while True:
+            queued = self.queue.get()
+            if queued is None:
+                break
+            filepath, image, params = queued
+            try:
+                if params is None:
+                    written = cv2.imwrite(filepath, image)
+                else:
+                    written = cv2.imwrite(filepath, image, params)
+                if not written:
+                    self.num_failed += 1
+            except cv2.error:
+                self.num_failed += 1
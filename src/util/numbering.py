@@ -11,45 +11,80 @@ import numpy as np
 from src.util.image_utils import rotated_to_regular_rect, rectangle_corners
 from src.extraction.item_extraction import calculate_pixel_position, calculate_position_pixel
 
-def number_serpentine(rows, field_num_start=1):
-    '''Return list of all items in rows ordered (and numbered) in a serpentine pattern.'''
+# Ways items can be ordered within the field.
+#  serpentine - rows are numbered in field direction, but every even row is numbered backwards so numbers snake across the field.
+#  parallel - every row is numbered in field direction.
+#  pass - every row is numbered in the direction it was planted.
+NUMBERING_LAYOUTS = ['serpentine', 'parallel', 'pass']
+
+def ordered_row_items(row, layout):
+    '''Return list of items (codes and plants) in row in the order they should be numbered for the layout.'''
+    row_items = []
+    for i, segment in enumerate(row.segments):
+        row_items.append(segment.start_code)
+        row_items += segment.items
+        if i == len(row.segments) - 1:
+            row_items.append(segment.end_code) # since on last segment it won't show up in next segment
+            
+    # Get everything going in the 'up' direction
+    if row.direction == 'back':
+        row_items.reverse()
     
+    if layout == 'serpentine':
+        # Reverse items in even row numbers for serpentine ordering
+        if row.number % 2 == 0:
+            row_items.reverse()
+    elif layout == 'pass':
+        # Back to the direction the row was planted.
+        if row.direction == 'back':
+            row_items.reverse()
+    elif layout != 'parallel':
+        raise ValueError('Unknown numbering layout {}'.format(layout))
+        
+    return row_items
+
+def number_items(rows, field_num_start=1, layout='serpentine'):
+    '''
+    Return list of all items in rows ordered (and numbered) using the specified layout.
+    Every number is calculated at once and then assigned to the items.
+    '''
     rows = sorted(rows, key=lambda r: r.number)
     
-    current_field_item_num = field_num_start
-    current_field_plant_num = field_num_start
     ordered_items = []
+    row_lengths = []
     for row in rows:
-        row_items = []
-        for i, segment in enumerate(row.segments):
-            row_items.append(segment.start_code)
-            row_items += segment.items
-            if i == len(row.segments) - 1:
-                row_items.append(segment.end_code) # since on last segment it won't show up in next segment
-                
-        # Get everything going in the 'up' direction
-        if row.direction == 'back':
-            row_items.reverse()
+        row_items = ordered_row_items(row, layout)
+        ordered_items += row_items
+        row_lengths.append(len(row_items))
         
-        # Reverse items in even row numbers for serpentine ordering    
-        if row.number % 2 == 0:
-            row_items.reverse()
-            
-        item_num_in_row = 1
-        plant_num_in_row = 1
-        for item in row_items:
-            
-            item.number_within_field = current_field_item_num
-            item.number_within_row = item_num_in_row
-            current_field_item_num += 1
-            item_num_in_row += 1
-            
-            if 'plant' in item.type.lower():
-                item.plant_num_in_field = current_field_plant_num
-                item.plant_num_in_row = plant_num_in_row
-                current_field_plant_num += 1
-                plant_num_in_row += 1
-
-            ordered_items.append(item)
+    if len(ordered_items) == 0:
+        return ordered_items
+    
+    row_lengths = np.array(row_lengths, dtype=np.int64)
+    row_starts = np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+    is_plant = np.array(['plant' in item.type.lower() for item in ordered_items], dtype=bool)
+    
+    item_indices = np.arange(len(ordered_items))
+    field_nums = item_indices + field_num_start
+    row_nums = item_indices - row_starts + 1
+    
+    # Number of plants up to and including each item, and number of plants before each row.
+    plant_counts = np.cumsum(is_plant)
+    plants_before_row = plant_counts[row_starts] - is_plant[row_starts]
+    plant_field_nums = plant_counts - 1 + field_num_start
+    plant_row_nums = plant_counts - plants_before_row
+    
+    for item, field_num, row_num in zip(ordered_items, field_nums.tolist(), row_nums.tolist()):
+        item.number_within_field = field_num
+        item.number_within_row = row_num
+        
+    plant_indices = np.flatnonzero(is_plant)
+    for index, plant_field_num, plant_row_num in zip(plant_indices.tolist(), plant_field_nums[plant_indices].tolist(), plant_row_nums[plant_indices].tolist()):
+        ordered_items[index].plant_num_in_field = plant_field_num
+        ordered_items[index].plant_num_in_row = plant_row_num
             
     return ordered_items
+
+def number_serpentine(rows, field_num_start=1):
+    '''Return list of all items in rows ordered (and numbered) in a serpentine pattern.'''
+    return number_items(rows, field_num_start, 'serpentine')
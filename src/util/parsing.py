@@ -1,58 +1,125 @@
 #! /usr/bin/env python
 
 import os
-import math
 import utm
 from collections import namedtuple
 
+# non-default import
+import numpy as np
+
 # Project imports
-from src.data.geo_image import GeoImage
+from src.data.geo_image import GeoImageTable
+from src.util.utm_conversion import from_latlon_arrays
     
-def parse_geo_file(image_geo_file, provided_resolution, camera_height):
-    '''Parse geo file and return list of GeoImage instances.'''
-    images = []
+# Lookup tables of which characters are whitespace (same as str.split()) and which separate fields.
+WHITESPACE_CHARACTERS = np.zeros(256, dtype=bool)
+WHITESPACE_CHARACTERS[[ord(c) for c in ' \t\n\r\x0b\x0c']] = True
+SEPARATOR_CHARACTERS = WHITESPACE_CHARACTERS.copy()
+SEPARATOR_CHARACTERS[ord(',')] = True
+
+def parse_geo_table(image_geo_file, provided_resolution, camera_height):
+    '''
+    Parse geo file and return GeoImageTable of every image with a valid position and heading.  The numeric columns of every
+    line are converted together from the characters of the whole file and latitude/longitude are converted to UTM together.
+    '''
     with open(image_geo_file, 'r') as geofile:
-        lines = geofile.readlines()
-        for line in lines:
-            if line.isspace():
-                continue
-            fields = [field.strip() for field in line.split(',')]
-            if len(fields) == 0:
-                continue
+        text = geofile.read()
+    if not text.endswith('\n'):
+        text += '\n'
+    chars = np.frombuffer(text, dtype=np.uint8)
+    
+    def count_between(positions, starts, ends):
+        '''Return how many of the sorted positions are in each range [start, end).'''
+        return np.searchsorted(positions, ends) - np.searchsorted(positions, starts)
+    
+    line_ends = np.flatnonzero(chars == ord('\n'))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    
+    # Skip lines that are only whitespace.
+    whitespace_positions = np.flatnonzero(WHITESPACE_CHARACTERS[chars])
+    used_lines = np.flatnonzero(count_between(whitespace_positions, line_starts, line_ends + 1) != line_ends + 1 - line_starts)
+    line_nums = used_lines + 1
+    line_starts = line_starts[used_lines]
+    line_ends = line_ends[used_lines]
+    
+    def line_text(k):
+        return text[line_starts[k]:line_ends[k]+1]
+    
+    comma_positions = np.flatnonzero(chars == ord(','))
+    num_commas = count_between(comma_positions, line_starts, line_ends)
+    short_lines = np.flatnonzero(num_commas < 7)
+    if len(short_lines) > 0:
+        print 'Bad line: {}'.format(line_text(short_lines[0]))
+        raise ValueError('Expected at least 8 fields on line {}'.format(line_nums[short_lines[0]]))
+    
+    # Time, lat, lon, alt, roll, pitch, yaw are before the 7th comma and the file name is after it.
+    first_commas = np.searchsorted(comma_positions, line_starts)
+    numbers_ends = comma_positions[first_commas + 6]
+    name_ends = line_ends.copy()
+    has_more_fields = num_commas > 7
+    name_ends[has_more_fields] = comma_positions[first_commas[has_more_fields] + 7]
+    
+    # Blank out separators and everything after the numbers (file names and other fields) so each line is just 7 space separated numbers.
+    numbers = chars.copy()
+    numbers[SEPARATOR_CHARACTERS[chars]] = ord(' ')
+    lengths = line_ends - numbers_ends
+    numbers[np.arange(lengths.sum()) + np.repeat(numbers_ends - np.cumsum(lengths) + lengths, lengths)] = ord(' ')
+    
+    # Every line must have exactly 7 numbers or numpy could pair values with the wrong lines.
+    is_space = numbers == ord(' ')
+    number_starts = ~is_space
+    number_starts[1:] &= is_space[:-1]
+    num_numbers = count_between(np.flatnonzero(number_starts), line_starts, numbers_ends)
+    values = np.fromstring(numbers.tostring(), dtype=np.float64, sep=' ')
+    
+    if np.any(num_numbers != 7) or values.size != 7 * len(line_nums):
+        # Some field isn't a single number.  Convert each line like float() so it either still works or the bad line is reported.
+        values = []
+        for k in range(len(line_nums)):
             try:
-                image_time = float(fields[0])
-                lat = float(fields[1])
-                lon = float(fields[2])
-                alt = float(fields[3])
-                roll = float(fields[4])
-                pitch = float(fields[5])
-                yaw = float(fields[6])
-                image_name = fields[7]
-                # Make sure filename doesn't have extension, we'll add it from image that we're processing.
-                image_name = os.path.splitext(image_name)[0]
-                
-                # Make sure position is valid.
-                if math.isnan(lat) or math.isnan(lon):
-                    print 'Image {} doesnt have valid position so it wont be used.'.format(image_name)
-                    continue
-                
-                # Roll and pitch are optional, but every image we use should have a yaw. If not then skip it.
-                if math.isnan(yaw):
-                    print 'Image {} doesnt have yaw (heading) so it wont be used.'.format(image_name)
-                    continue
-                
-                # Convert WGS84 to UTM.
-                easting, northing, zone_num, zone_letter = utm.from_latlon(lat, lon)
-                
-            except (IndexError, ValueError) as e:
-                print 'Bad line: {}'.format(line) 
+                values.append([float(field) for field in line_text(k).split(',')[:7]])
+            except ValueError:
+                print 'Bad line: {}'.format(line_text(k))
                 raise
-                 
-            geo_image = GeoImage(file_name=image_name, image_time=image_time, position=(easting, northing, alt), zone=str(zone_num)+zone_letter,
-                                 roll_degrees=roll, pitch_degrees=pitch, heading_degrees=yaw, resolution=provided_resolution, cam_height=camera_height)
-            images.append(geo_image)
-            
-    return images
+    values = np.array(values, dtype=np.float64).reshape(-1, 7)
+
+    # Make sure filename doesn't have extension, we'll add it from image that we're processing.
+    image_names = [os.path.splitext(text[start+1:end].strip())[0] for start, end in zip(numbers_ends.tolist(), name_ends.tolist())]
+
+    # Make sure position is valid.
+    no_position = np.isnan(values[:, 1]) | np.isnan(values[:, 2])
+    # Roll and pitch are optional, but every image we use should have a yaw. If not then skip it.
+    no_yaw = np.isnan(values[:, 6])
+    for k in np.flatnonzero(no_position | no_yaw):
+        if no_position[k]:
+            print 'Image {} doesnt have valid position so it wont be used.'.format(image_names[k])
+        else:
+            print 'Image {} doesnt have yaw (heading) so it wont be used.'.format(image_names[k])
+
+    valid_indices = np.flatnonzero(~no_position & ~no_yaw)
+    values = values[valid_indices]
+    image_names = [image_names[k] for k in valid_indices]
+
+    # Convert WGS84 to UTM.
+    try:
+        eastings, northings, zone_numbers, zone_letters = from_latlon_arrays(values[:, 1], values[:, 2])
+    except utm.OutOfRangeError:
+        for k, (lat, lon) in enumerate(values[:, 1:3].tolist()):
+            try:
+                utm.from_latlon(lat, lon)
+            except utm.OutOfRangeError:
+                print 'Bad line: {}'.format(line_text(valid_indices[k]))
+                raise
+        raise
+
+    zones = [str(zone_num) + zone_letter for zone_num, zone_letter in zip(zone_numbers.tolist(), zone_letters.tolist())]
+
+    return GeoImageTable(image_names, values[:, 0], eastings, northings, values[:, 3], zones, values[:, 4], values[:, 5], values[:, 6],
+                         resolution=provided_resolution, cam_height=camera_height)
+
+def parse_geo_file(image_geo_file, provided_resolution, camera_height):
+    '''Parse geo file and return list of GeoImage instances.'''
+    return list(parse_geo_table(image_geo_file, provided_resolution, camera_height))
 
 def parse_code_listing_file(group_filename):
     '''
@@ -2,7 +2,7 @@
 
 import sys
 import math
-import copy
+import multiprocessing
 
 # OpenCV imports
 import cv2
@@ -10,7 +10,7 @@ import numpy as np
 
 # Project imports
 from src.data.field_item import Plant, CreatedPlant
-from src.processing.item_processing import lateral_and_projection_distance_2d, projection_to_position_2d
+from src.processing.item_processing import lateral_and_projection_distance_2d, lateral_and_projection_distances_2d, projection_to_position_2d
 from src.processing.item_processing import position_difference
 from src.util.clustering import corner_rectangle_size
 
@@ -19,8 +19,12 @@ class SegmentPart:
     def __init__(self, start, end):
         self.start = start
         self.end = end
-        self.possible_plants = None
+        self.candidates = None # indices into candidate store of possible plants in part.
+        self.projections = None # projections of candidates along part.
         self.expected_projections = None
+        self.forward_plant = None # plant selected going from start to end.
+        self.reverse_plant = None # plant selected going from end to start.
+        self.sub_parts = None # parts this part was split into. Empty if it couldn't be split.
     
     @property
     def length(self):
@@ -28,10 +32,34 @@ class SegmentPart:
         dy = self.start.position[1] - self.end.position[1]
         return math.sqrt(dx*dx + dy*dy) 
         
+class PartEnd:
+    '''Start or end (code or plant) of segment part with just what's needed to process the part in another process.'''
+    
+    def __init__(self, item):
+        self.type = item.type
+        self.position = item.position
+        self.zone = item.zone
+        
+class CandidateStore:
+    '''Possible plants for a segment stored in arrays so they can be processed in bulk.  Original dictionaries are kept for building plants.'''
+    
+    def __init__(self, possible_plants, confidence_function):
+        self.possible_plants = possible_plants
+        self.values = np.zeros(len(possible_plants), dtype=[('x', np.float64), ('y', np.float64), ('confidence', np.float64)])
+        for k, plant in enumerate(possible_plants):
+            self.values[k] = (plant['position'][0], plant['position'][1], confidence_function(plant))
+        # Make each field contiguous for faster math.
+        self.xs = np.ascontiguousarray(self.values['x'])
+        self.ys = np.ascontiguousarray(self.values['y'])
+        self.confidences = np.ascontiguousarray(self.values['confidence'])
+        
+    def __len__(self):
+        return len(self.possible_plants)
+        
 class RecursiveSplitPlantFilter:
     
     def __init__(self, start_code_spacing, end_code_spacing, plant_spacing, lateral_ps=1, projection_ps=1,
-                 closeness_ps=1, stick_multiplier=2, leaf_multiplier=1.5, tag_multiplier=4):
+                 closeness_ps=1, stick_multiplier=2, leaf_multiplier=1.5, tag_multiplier=4, num_processes=1, parallel_min_candidates=1000):
         '''Spacing distances (in centimeters) are expected values'''
         self.expected_start_code_spacing = start_code_spacing
         self.expected_end_code_spacing = end_code_spacing
@@ -54,13 +82,24 @@ class RecursiveSplitPlantFilter:
         self.leaf_multiplier = max(1, leaf_multiplier)
         self.tag_multiplier = max(1, tag_multiplier)
         
+        # Segments with at least this many candidates are split up using multiple processes.
+        self.num_processes = num_processes
+        self.parallel_min_candidates = parallel_min_candidates
+        
+        # Candidates of segment currently being processed.
+        self.store = None
+        
     def locate_actual_plants_in_segment(self, possible_plants, whole_segment):
     
+        self.store = CandidateStore(possible_plants, self.calculate_plant_part_confidence)
+    
         whole_part = SegmentPart(whole_segment.start_code, whole_segment.end_code)
-        whole_part.possible_plants = possible_plants
+        whole_part.candidates = np.arange(len(self.store))
     
         sub_parts = self.split_into_subparts(whole_part)
         
+        self.store = None
+        
         actual_plants = []
         for part in sub_parts:
             # Add start of segment part.  Don't add the end since it should be the start of the next part,
@@ -78,26 +117,83 @@ class RecursiveSplitPlantFilter:
              
         return actual_plants
     
-    def split_into_subparts(self, segment_part):
+    def split_into_subparts(self, whole_part):
+        '''
+        Return list of parts that couldn't be split up any more ordered from start to end of whole part.  Each part
+        only depends on its own candidates so parts are processed from a work queue one wave at a time, and waves
+        of very long segments can be processed in parallel.
+        '''
+        pool = self.create_pool()
+        try:
+            wave = [whole_part]
+            while len(wave) > 0:
+                if pool is not None and len(wave) > 1:
+                    detached_parts = []
+                    for part in wave:
+                        detached_part = SegmentPart(PartEnd(part.start), PartEnd(part.end))
+                        detached_part.candidates = part.candidates
+                        detached_parts.append(detached_part)
+                    results = pool.map(process_part_in_worker, detached_parts)
+                else:
+                    results = [self.process_part(part) for part in wave]
+                
+                next_wave = []
+                for part, (forward_plant, reverse_plant, selected_plants, split_candidates) in zip(wave, results):
+                    part.forward_plant = forward_plant
+                    part.reverse_plant = reverse_plant
+                    part_ends = [part.start] + selected_plants + [part.end]
+                    part.sub_parts = []
+                    for k, candidates in enumerate(split_candidates):
+                        sub_part = SegmentPart(start=part_ends[k], end=part_ends[k+1])
+                        sub_part.candidates = candidates
+                        part.sub_parts.append(sub_part)
+                    next_wave += part.sub_parts
+                wave = next_wave
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        
+        # Walk parts in order to collect the ones that weren't split.
+        all_segment_parts = []
+        parts_to_walk = [whole_part]
+        while len(parts_to_walk) > 0:
+            part = parts_to_walk.pop()
+            if len(part.sub_parts) == 0:
+                all_segment_parts.append(part)
+            else:
+                parts_to_walk.extend(reversed(part.sub_parts))
+        
+        return all_segment_parts
+    
+    def create_pool(self):
+        '''Return process pool for current segment or None if it should be processed serially.'''
+        if self.num_processes <= 1 or len(self.store) < self.parallel_min_candidates:
+            return None
+        if multiprocessing.current_process().daemon:
+            return None # can't create child processes (e.g. already processing segments in parallel)
+        return multiprocessing.Pool(self.num_processes, initializer=set_worker_filter, initargs=(self,))
     
+    def process_part(self, segment_part):
+        '''
+        Return (forward plant, reverse plant, selected plants, split candidates) for part where split candidates are
+        the candidates that fall between the selected plants. Selected plants are empty if part can't be split up.
+        '''
         reverse_segment_part = SegmentPart(segment_part.end, segment_part.start)
-        reverse_segment_part.possible_plants = copy.copy(segment_part.possible_plants)
+        reverse_segment_part.candidates = segment_part.candidates
     
-        # Need to process reverse first so when splitting segments the possible plants will have correct 'forward' projections.
         reverse_plant = self.process_segment_part(reverse_segment_part)
         forward_plant = self.process_segment_part(segment_part)
         
-        split_segment_parts = self.split_segment_into_parts(segment_part, forward_plant, reverse_plant)
-  
-        all_segment_parts = []
-        if len(split_segment_parts) == 0:
-            # Can't split segment part up into smaller parts.
-            all_segment_parts.append(segment_part)
-        else:
-            for split_part in split_segment_parts:
-                all_segment_parts += self.split_into_subparts(split_part)
+        selected_plants = self.select_split_plants(segment_part, forward_plant, reverse_plant)
+        if len(selected_plants) == 0:
+            return forward_plant, reverse_plant, [], []
         
-        return all_segment_parts
+        # Split up candidates (which are sorted by forward projection) between selected plants.
+        split_candidates = self.split_candidates_by_projections(segment_part.candidates, segment_part.projections,
+                                                                [plant.projection for plant in selected_plants])
+        
+        return forward_plant, reverse_plant, selected_plants, split_candidates
     
     def process_segment_part(self, segment_part):
         
@@ -108,21 +204,25 @@ class RecursiveSplitPlantFilter:
             return None
         
         # Remove any plants that don't fall within the valid range of the segment part.
-        segment_part.possible_plants = self.filter_plants_by_segment_part(segment_part)
+        segment_part.candidates, laterals, projections = self.filter_plants_by_segment_part(segment_part)
 
-        if len(segment_part.possible_plants) == 0:
+        if len(segment_part.candidates) == 0:
             # No plants to select from so just create a plant where one is most likely to be.
             selected_plant = self.create_closest_plant(segment_part)
         else:
             # Figure out which possible plant is most likely to be an actual plant.
-            selected_plant = self.find_most_likely_plant(segment_part)
+            selected_plant = self.find_most_likely_plant(segment_part, laterals, projections)
             if selected_plant is None:
                 # None of the possible plants worked out so fall back on closest expected plant.
                 selected_plant = self.create_closest_plant(segment_part)
                 
+        # Keep projections (sorted same as candidates) around for splitting part up.
+        segment_part.projections = projections
+                
         return selected_plant
     
-    def split_segment_into_parts(self, segment_part, forward_plant, reverse_plant):
+    def select_split_plants(self, segment_part, forward_plant, reverse_plant):
+        '''Return list of plants (forward, reverse or both) that part should be split on. Empty if it can't be split.'''
         
         if not forward_plant or not reverse_plant:
             return [] # Can't split up any more. 
@@ -159,25 +259,7 @@ class RecursiveSplitPlantFilter:
             else:
                 assert(False)
         
-        if len(selected_plants) == 0:
-            return []
-        elif len(selected_plants) == 1:
-            selected_plant = selected_plants[0]
-            first_subpart = SegmentPart(start=segment_part.start, end=selected_plant)
-            second_subpart = SegmentPart(start=selected_plant, end=segment_part.end)
-            before_plants, after_plants = self.split_possible_plants_by_projections(segment_part.possible_plants, [selected_plant.projection])
-            first_subpart.possible_plants = before_plants
-            second_subpart.possible_plants = after_plants
-            return [first_subpart, second_subpart]
-        elif len(selected_plants) == 2:
-            first_subpart = SegmentPart(start=segment_part.start, end=selected_plants[0])
-            second_subpart = SegmentPart(start=selected_plants[0], end=selected_plants[1])
-            third_subpart = SegmentPart(start=selected_plants[1], end=segment_part.end)
-            first_subpart.possible_plants, second_subpart.possible_plants, third_subpart.possible_plants = \
-                self.split_possible_plants_by_projections(segment_part.possible_plants, [selected_plants[0].projection, selected_plants[1].projection])
-            return [first_subpart, second_subpart, third_subpart]
-        else:
-            assert(False)
+        return selected_plants
     
     def create_closest_plant(self, segment_part):
         closest_expected_projection = segment_part.expected_projections[0]
@@ -188,80 +270,64 @@ class RecursiveSplitPlantFilter:
         new_plant.projection = closest_expected_projection
         return new_plant
     
-    def find_most_likely_plant(self, segment_part):
+    def find_most_likely_plant(self, segment_part, laterals, projections):
         
-        for plant in segment_part.possible_plants:
-            
-            lateral_penalty = self.calculate_lateral_penalty(plant['lateral'])
+        lateral_penalties = self.calculate_lateral_penalties(laterals)
+    
+        projection_penalties = self.calculate_projection_penalties(segment_part.expected_projections, projections)
         
-            projection_penalty = self.calculate_projection_penalty(segment_part.expected_projections, plant['projection'])
-            
-            if segment_part.start.type == 'RowCode':
-                # Don't weight as heavily since row codes are hand placed.
-                projection_penalty /= 3
+        if segment_part.start.type == 'RowCode':
+            # Don't weight as heavily since row codes are hand placed.
+            projection_penalties /= 3
+    
+        closeness_penalties = self.calculate_closeness_penalties(projections)
         
-            closeness_penalty = self.calculate_closeness_penalty(plant['projection'])
-            
-            confidence_boost = self.calculate_plant_part_confidence(plant)
-            
-            plant['penalty'] = ((lateral_penalty * self.lateral_penalty_scale +
-                                projection_penalty * self.lateral_penalty_scale +
-                                closeness_penalty * self.closeness_penalty_scale) /
-                                confidence_boost)
-            
-        valid_plants = [p for p in segment_part.possible_plants if not math.isnan(p['penalty'])]
+        confidence_boosts = self.store.confidences[segment_part.candidates]
+        
+        penalties = ((lateral_penalties * self.lateral_penalty_scale +
+                      projection_penalties * self.lateral_penalty_scale +
+                      closeness_penalties * self.closeness_penalty_scale) /
+                      confidence_boosts)
             
-        if len(valid_plants) == 0:
+        valid = ~np.isnan(penalties)
+        if not np.any(valid):
             return None # none of the possible plants worked out
         
-        best_plant = sorted(valid_plants, key=lambda p: p['penalty'])[0]
+        # First of the lowest penalties to match a stable sort.
+        best_index = np.flatnonzero(valid)[np.argmin(penalties[valid])]
+        best_plant = self.store.possible_plants[segment_part.candidates[best_index]]
         
         # convert to an actual plant object
         selected_plant = Plant('plant', position=best_plant['position'], zone=segment_part.start.zone)
         
         # this global rect will be converted to a rotated image rect later
         selected_plant.bounding_rect = best_plant['rect']
-        selected_plant.projection = best_plant['projection']
-        selected_plant.penalty = best_plant['penalty']
+        selected_plant.projection = float(projections[best_index])
+        selected_plant.penalty = float(penalties[best_index])
 
         return selected_plant
             
-    def split_possible_plants_by_projections(self, possible_plants, projections):
-
-        if len(projections) == 0:
-            return possible_plants
-
-        split_plants = [[] for i in range(len(projections)+1)]
-        
-        for plant in possible_plants:
-            plant_grouped = False
-            for i, projection in enumerate(projections):
-                if plant['projection'] < projection:
-                    split_plants[i].append(plant)
-                    plant_grouped = True
-                    break
-            if not plant_grouped:
-                # Plant came after all projections.
-                split_plants[-1].append(plant)
-
-        return split_plants
-
-    def split_possible_plants_between_projections(self, possible_plants, smaller_projection, larger_projection):
-        '''Return plants in possible_plants that fall between smaller and larger projections'''
-            
-        return [p for p in possible_plants if p['projection'] > smaller_projection and p['projection'] < larger_projection]
+    def split_candidates_by_projections(self, candidates, candidate_projections, projections):
+        '''
+        Return list of candidate index arrays split so each one falls before the next projection.
+        Candidate projections must be sorted and projections must be increasing.
+        '''
+        split_indices = np.searchsorted(candidate_projections, projections, side='left')
+        return np.split(candidates, split_indices)
             
     def filter_plants_by_segment_part(self, segment_part):
+        '''Return (candidates, lateral distances, projections) ordered by projection that fall within valid range of segment part.'''
         
-        possible_plants = segment_part.possible_plants
+        candidates = segment_part.candidates
         
-        for plant in possible_plants:
-            lateral_distance, projection_distance = lateral_and_projection_distance_2d(plant['position'], segment_part.start.position, segment_part.end.position)
-            plant['lateral'] = lateral_distance
-            plant['projection'] = projection_distance
+        laterals, projections = lateral_and_projection_distances_2d(self.store.xs[candidates], self.store.ys[candidates],
+                                                                    segment_part.start.position, segment_part.end.position)
         
-        # Order from start to end code
-        possible_plants = sorted(possible_plants, key=lambda p: p['projection'])
+        # Order from start to end code. Stable so ties stay in same order.
+        order = np.argsort(projections, kind='mergesort')
+        candidates = candidates[order]
+        laterals = laterals[order]
+        projections = projections[order]
         
         # Throw out any that are too close to or behind start/end code
         if segment_part.start.type == 'GroupCode':
@@ -278,9 +344,12 @@ class RecursiveSplitPlantFilter:
         else:
             closest_at_end = segment_part.length - self.closest_plant_spacing
     
-        filtered_plants = [p for p in possible_plants if p['projection'] >= closest_at_start and p['projection'] <= closest_at_end]
+        first = np.searchsorted(projections, closest_at_start, side='left')
+        last = np.searchsorted(projections, closest_at_end, side='right')
+        if last < first:
+            last = first
     
-        return filtered_plants
+        return candidates[first:last], laterals[first:last], projections[first:last]
     
     def calculate_expected_positions(self, segment_part):
     
@@ -309,9 +378,9 @@ class RecursiveSplitPlantFilter:
     
         return expected_distances
 
-    def calculate_lateral_penalty(self, lateral_error):
+    def calculate_lateral_penalties(self, lateral_errors):
         
-        lateral_error = abs(lateral_error)
+        lateral_errors = np.abs(lateral_errors)
         
         # lateral errors (in meters) for two linear pieces
         x1 = 0.07 
@@ -319,19 +388,24 @@ class RecursiveSplitPlantFilter:
         # penalty values for two linear pieces
         y1 = 0.1 
         y2 = 1.0
-        if lateral_error < x1:
-            y = (y1 / x1) * lateral_error
-        elif lateral_error <= x2:
-            y = ((y2-y1) / (x2-x1)) * (lateral_error - x1) + y1
-        else:
-            y = float('NaN')
+        
+        y = np.full(len(lateral_errors), np.nan)
+        first_piece = lateral_errors < x1
+        second_piece = ~first_piece & (lateral_errors <= x2)
+        y[first_piece] = (y1 / x1) * lateral_errors[first_piece]
+        y[second_piece] = ((y2-y1) / (x2-x1)) * (lateral_errors[second_piece] - x1) + y1
             
         return y
             
-    def calculate_projection_penalty(self, expected_projections, projection):
+    def calculate_projection_penalties(self, expected_projections, projections):
         
-        # Find error (in meters) to closest expected projection
-        smallest_error = min([abs(projection - expected) for expected in expected_projections])
+        # Find error (in meters) to closest expected projection.  Expected projections are increasing so 
+        # the closest is either the one before or after each projection.
+        expected_projections = np.array(expected_projections, dtype=np.float64)
+        after = np.searchsorted(expected_projections, projections)
+        before = np.maximum(after - 1, 0)
+        after = np.minimum(after, len(expected_projections) - 1)
+        smallest_errors = np.minimum(np.abs(projections - expected_projections[before]), np.abs(projections - expected_projections[after]))
         
         # projection errors (in meters) for two linear pieces
         x1 = self.expected_plant_spacing / 4.0
@@ -339,23 +413,20 @@ class RecursiveSplitPlantFilter:
         # penalty values for two linear pieces
         y1 = 0.1
         y2 = 1.0
-        if smallest_error < x1:
-            y = (y1 / x1) * smallest_error
-        elif smallest_error <= x2:
-            y = ((y2-y1) / (x2-x1)) * (smallest_error - x1) + y1
-        else:
-            y = 1.0
+        
+        y = np.ones(len(smallest_errors))
+        first_piece = smallest_errors < x1
+        second_piece = ~first_piece & (smallest_errors <= x2)
+        y[first_piece] = (y1 / x1) * smallest_errors[first_piece]
+        y[second_piece] = ((y2-y1) / (x2-x1)) * (smallest_errors[second_piece] - x1) + y1
             
         return y
     
-    def calculate_closeness_penalty(self, projection):
+    def calculate_closeness_penalties(self, projections):
         
-        if projection < (2.5 * self.expected_plant_spacing):
-            y = 0.0
-        elif projection < (3.5 * self.expected_plant_spacing):
-            y = 1.0
-        else:
-            y = float('NaN')
+        y = np.full(len(projections), np.nan)
+        y[projections < (3.5 * self.expected_plant_spacing)] = 1.0
+        y[projections < (2.5 * self.expected_plant_spacing)] = 0.0
             
         return y
     
@@ -375,6 +446,199 @@ class RecursiveSplitPlantFilter:
         plant_part_confidence = blue_stick_multiplier * leaf_multiplier * tag_multiplier
             
         return plant_part_confidence
+
+class SpacingDPPlantFilter(RecursiveSplitPlantFilter):
+    '''
+    Select the plant sequence with the lowest total penalty for an entire segment in one dynamic programming pass.
+    Each expected plant position is a slot that's filled either by a possible plant within half a plant spacing or
+    by a created plant.  Uses the same lateral/projection penalties as the recursive filter, and the closeness
+    penalty becomes the constraint that consecutive plants can't be closer than the closest plant spacing.
+    '''
+
+    def __init__(self, start_code_spacing, end_code_spacing, plant_spacing, lateral_ps=1, projection_ps=1,
+                 closeness_ps=1, stick_multiplier=2, leaf_multiplier=1.5, tag_multiplier=4, spacing_tolerance=0.2):
+        '''Spacing distances (in centimeters) are expected values'''
+        RecursiveSplitPlantFilter.__init__(self, start_code_spacing, end_code_spacing, plant_spacing, lateral_ps, projection_ps,
+                                           closeness_ps, stick_multiplier, leaf_multiplier, tag_multiplier)
+
+        # Created plants cost as much as the worst possible plant so that possible plants are always used when they fit.
+        self.created_penalty = self.lateral_penalty_scale + self.projection_penalty_scale + self.closeness_penalty_scale
+
+        # How far (as a fraction of plant spacing) actual spacing is allowed to be from expected, and step size to search it.
+        self.spacing_tolerance = spacing_tolerance
+        self.spacing_step = 0.025
+
+    def spacings_to_try(self):
+        '''Return list of plant spacings starting with expected spacing and then moving outwards.'''
+        spacings = [self.expected_plant_spacing]
+        num_steps = int(round(self.spacing_tolerance / self.spacing_step))
+        for k in range(1, num_steps + 1):
+            spacings.append(self.expected_plant_spacing * (1 - k * self.spacing_step))
+            spacings.append(self.expected_plant_spacing * (1 + k * self.spacing_step))
+        return spacings
+
+    def calculate_slot_projections(self, whole_part, plant_spacing):
+        '''Return expected plant projections along segment (between two codes) when plants are plant spacing apart.'''
+        start_distance = self.expected_start_code_spacing
+        end_distance = whole_part.length - self.closest_group_code_spacing
+
+        expected_distances = []
+        current_distance = start_distance
+        while current_distance <= end_distance:
+            expected_distances.append(current_distance)
+            current_distance += plant_spacing
+
+        return expected_distances
+
+    def locate_actual_plants_in_segment(self, possible_plants, whole_segment):
+
+        self.store = CandidateStore(possible_plants, self.calculate_plant_part_confidence)
+
+        whole_part = SegmentPart(whole_segment.start_code, whole_segment.end_code)
+        whole_part.candidates = np.arange(len(self.store))
+
+        # Candidates sorted by projection with any that are too far off the segment line thrown out.
+        candidates, laterals, projections = self.filter_plants_by_segment_part(whole_part)
+        lateral_penalties = self.calculate_lateral_penalties(laterals)
+        valid = ~np.isnan(lateral_penalties)
+        candidates = candidates[valid]
+        projections = projections[valid]
+        lateral_penalties = lateral_penalties[valid]
+        confidences = self.store.confidences[candidates]
+
+        # Actual spacing is rarely exactly what's expected so try spacings close to it and keep the one that finds
+        # the most plants, and then the one where they fit the best.  Ties go to the spacing closest to expected.
+        best = None
+        for spacing in self.spacings_to_try():
+            expected_projections = self.calculate_slot_projections(whole_part, spacing)
+            if len(expected_projections) == 0:
+                continue
+            slot_choices = self.find_best_slot_choices(expected_projections, spacing, projections, lateral_penalties,
+                                                       confidences, whole_part.start.type)
+            found_penalties = [penalty for choice, penalty in slot_choices if choice is not None]
+            score = (-len(found_penalties), sum(found_penalties))
+            if best is None or score < best[0]:
+                best = (score, expected_projections, slot_choices)
+
+        if best is None:
+            self.store = None
+            return [] # segment too short to contain any plants
+
+        _, expected_projections, slot_choices = best
+
+        actual_plants = []
+        offset = 0 # how far the last found plant was from where it was expected, used to line up created plants.
+        for expected_projection, (choice, penalty) in zip(expected_projections, slot_choices):
+            if choice is None:
+                actual_plants.append(self.create_plant_at_projection(expected_projection + offset, whole_part))
+                self.num_created_plants += 1
+            else:
+                best_plant = self.store.possible_plants[candidates[choice]]
+                plant = Plant('plant', position=best_plant['position'], zone=whole_part.start.zone)
+                # this global rect will be converted to a rotated image rect later
+                plant.bounding_rect = best_plant['rect']
+                plant.projection = float(projections[choice])
+                plant.penalty = float(penalty)
+                offset = plant.projection - expected_projection
+                actual_plants.append(plant)
+                self.num_successfully_found_plants += 1
+
+        self.store = None
+
+        return actual_plants
+
+    def find_best_slot_choices(self, expected_projections, plant_spacing, projections, lateral_penalties, confidences, start_type):
+        '''
+        Return list of (candidate index or None if created, penalty) for each expected projection (slot) that gives the
+        lowest total penalty.  Slots are plant spacing apart and projections must be sorted.  Each slot is processed once using prefix minimums of the
+        previous slot, so this runs in O(candidates x slots) at worst and closer to O(candidates) when plants are sparse.
+        '''
+        half_spacing = plant_spacing / 2.0
+
+        # For each slot keep arrays of state positions, state candidates (-1 for created), state costs, total costs
+        # and the index of the best previous state.  The first state of every slot is the created plant.
+        slots = []
+        previous = None
+        for j, expected_projection in enumerate(expected_projections):
+            first = np.searchsorted(projections, expected_projection - half_spacing, side='left')
+            last = np.searchsorted(projections, expected_projection + half_spacing, side='right')
+            slot_candidates = np.arange(first, last)
+
+            projection_penalties = self.calculate_projection_penalties([expected_projection], projections[first:last])
+            if j == 0 and start_type == 'RowCode':
+                # Don't weight as heavily since row codes are hand placed.
+                projection_penalties /= 3
+            candidate_costs = ((lateral_penalties[first:last] * self.lateral_penalty_scale +
+                                projection_penalties * self.projection_penalty_scale) /
+                                confidences[first:last])
+
+            positions = np.concatenate(([expected_projection], projections[first:last]))
+            costs = np.concatenate(([self.created_penalty], candidate_costs))
+
+            if previous is None:
+                totals = costs
+                best_previous = np.full(len(costs), -1, dtype=np.int64)
+            else:
+                totals, best_previous = self.add_best_previous_totals(previous, positions, costs)
+
+            previous = (positions, totals)
+            slots.append((np.concatenate(([-1], slot_candidates)), costs, totals, best_previous))
+
+        # Walk back from the best final state.
+        slot_choices = []
+        state = int(np.argmin(slots[-1][2]))
+        for slot_candidates, costs, totals, best_previous in reversed(slots):
+            candidate = int(slot_candidates[state])
+            slot_choices.append((None if candidate < 0 else candidate, costs[state]))
+            state = int(best_previous[state])
+        slot_choices.reverse()
+
+        return slot_choices
+
+    def add_best_previous_totals(self, previous, positions, costs):
+        '''
+        Return (total costs, best previous state indices) for slot states at positions given previous slot (positions, totals).
+        Previous states must be at least the closest plant spacing behind a state to come before it.
+        '''
+        previous_positions, previous_totals = previous
+
+        # Stable so created plant (first state) wins ties with a candidate at the same position.
+        order = np.argsort(previous_positions, kind='mergesort')
+        sorted_positions = previous_positions[order]
+        sorted_totals = previous_totals[order]
+
+        # Prefix minimum of totals (and first index it occurs at) in order of position.
+        prefix_min = np.minimum.accumulate(sorted_totals)
+        improved = np.ones(len(sorted_totals), dtype=bool)
+        improved[1:] = sorted_totals[1:] < prefix_min[:-1]
+        prefix_argmin = np.maximum.accumulate(np.where(improved, np.arange(len(sorted_totals)), 0))
+
+        num_allowed = np.searchsorted(sorted_positions, positions - self.closest_plant_spacing, side='right')
+        feasible = num_allowed > 0
+        last_allowed = np.maximum(num_allowed - 1, 0)
+
+        totals = np.where(feasible, costs + prefix_min[last_allowed], np.inf)
+        best_previous = np.where(feasible, order[prefix_argmin[last_allowed]], -1)
+
+        return totals, best_previous
+
+    def create_plant_at_projection(self, projection, segment_part):
+        position = projection_to_position_2d(projection, segment_part.start.position, segment_part.end.position)
+        # Add on z value
+        position = position + (segment_part.start.position[2],)
+        new_plant = CreatedPlant(name='plant', position=position, zone=segment_part.start.zone)
+        new_plant.projection = projection
+        return new_plant
+
+# Filter used by pool processes.  Set once when process starts so candidate store isn't sent with every part.
+worker_filter = None
+
+def set_worker_filter(plant_filter):
+    global worker_filter
+    worker_filter = plant_filter
+    
+def process_part_in_worker(segment_part):
+    return worker_filter.process_part(segment_part)
     
 class ClosestSinglePlantFilter:
     
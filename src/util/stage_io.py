@@ -5,16 +5,18 @@ import sys
 import pickle
 import csv
 import datetime
-import copy
-from collections import namedtuple
+from random import randint
+from collections import OrderedDict, defaultdict
 
 # OpenCV imports
 import cv2
+import numpy as np
 
 # Project imports
 from src.util.image_utils import make_filename_unique
 from src.util.image_utils import postfix_filename, draw_rect
-from src.util.clustering import rect_to_image
+from src.util.image_writer import BackgroundImageWriter
+from src.extraction.item_extraction import calculate_position_pixels_in_images
 
 def pickle_results(filename, out_directory, *args):
     
@@ -64,73 +66,110 @@ def unpickle_stage4_output(input_filepath):
         rows = pickle.load(stage4_file)
     return rows
 
-def debug_draw_plants_in_images(geo_images, possible_plants, actual_plants, out_directory):
+class DebugPlantRenderer(object):
+    '''
+    Collect possible and actual plants to mark on each image as segments are processed and then draw everything
+    at the end so each image is only read and written once.
+    '''
     
-    # Write images out to subdirectory to keep separated from pickled results.
-    image_out_directory = os.path.join(out_directory, 'images/')
-    if not os.path.exists(image_out_directory):
-        os.makedirs(image_out_directory)
+    def __init__(self):
+        self.geo_images = OrderedDict() # file name -> geo image in order they're first added
+        self.drawings = defaultdict(list) # file name -> list of (rotated image rect, color, thickness) in drawing order
         
-    print "Writing out debug images"
+    def add_segment(self, geo_images, possible_plants, actual_plants):
+        '''Add possible plants (and their parts) and actual plants to draw on the segment geo images.'''
+        for geo_image in geo_images:
+            self.geo_images.setdefault(geo_image.file_name, geo_image)
+        self.add_possible_plants(geo_images, possible_plants)
+        self.add_actual_plants(geo_images, actual_plants)
         
-    # Limit the max number of images to keep from overfilling memory.
-    set_num = 0
-    set_increment = 20
-    while set_num < len(geo_images):
-        debug_geo_images = copy.copy(geo_images[set_num : set_num + set_increment])
-        debug_draw_plants_in_images_subset(debug_geo_images, possible_plants, actual_plants, image_out_directory)
-        set_num += set_increment
-        sys.stdout.write('.')
-
-def debug_draw_plants_in_images_subset(debug_geo_images, possible_plants, actual_plants, image_out_directory):
-    
-    debug_images = []
-    DebugImage = namedtuple('DebugImage', 'image existed')
-    for geo_image in debug_geo_images:
-        if hasattr(geo_image, 'debug_filepath'):
-            path = geo_image.debug_filepath
-            already_existed = True
-        else:
-            path = geo_image.file_path
-            already_existed = False
-        img = cv2.imread(path, cv2.CV_LOAD_IMAGE_COLOR)
-        if img is None:
-            print "Could not open image {}".format(path)
-            continue
-        debug_images.append(DebugImage(img, already_existed))
-    for item in possible_plants:
-        from random import randint
-        item_color = (randint(50, 255), randint(50, 100), randint(50, 255))
-        for k, geo_image in enumerate(debug_geo_images):
-            for ext_item in [item] + item.get('items',[]):
-                image_rect = rect_to_image(ext_item['rect'], geo_image)
-                center, size, theta = image_rect
-                x, y = center
+    def add_possible_plants(self, geo_images, possible_plants):
+        
+        # Each possible plant and its parts get the same random color.
+        global_rects = []
+        colors = []
+        for item in possible_plants:
+            item_color = (randint(50, 255), randint(50, 100), randint(50, 255))
+            for ext_item in [item] + item.get('items', []):
+                global_rects.append(ext_item['rect'])
+                colors.append(item_color)
+                
+        if len(global_rects) == 0 or len(geo_images) == 0:
+            return
+        
+        # Transform all rectangle corners into all images at once.
+        corners = [corner for rect in global_rects for corner in rect]
+        corner_starts = np.cumsum([0] + [len(rect) for rect in global_rects[:-1]])
+        pixel_xs, pixel_ys = calculate_position_pixels_in_images([c[0] for c in corners], [c[1] for c in corners], geo_images)
+        pixel_xs = pixel_xs.astype(np.int64)
+        pixel_ys = pixel_ys.astype(np.int64)
+        
+        # Center of rotated rectangle is between the smallest and largest corners so skip ones that can't be in image.
+        widths = np.array([[geo_image.width] for geo_image in geo_images])
+        heights = np.array([[geo_image.height] for geo_image in geo_images])
+        possibly_in_image = ((np.maximum.reduceat(pixel_xs, corner_starts, axis=1) >= 0) &
+                             (np.minimum.reduceat(pixel_xs, corner_starts, axis=1) < widths) &
+                             (np.maximum.reduceat(pixel_ys, corner_starts, axis=1) >= 0) &
+                             (np.minimum.reduceat(pixel_ys, corner_starts, axis=1) < heights))
+        
+        for image_index, geo_image in enumerate(geo_images):
+            drawings = self.drawings[geo_image.file_name]
+            for rect_index in np.flatnonzero(possibly_in_image[image_index]):
+                first_corner = corner_starts[rect_index]
+                last_corner = first_corner + len(global_rects[rect_index])
+                image_rect = cv2.minAreaRect(np.column_stack((pixel_xs[image_index, first_corner:last_corner],
+                                                              pixel_ys[image_index, first_corner:last_corner])))
+                x, y = image_rect[0]
                 if x >= 0 and x < geo_image.width and y >= 0 and y < geo_image.height:
-                    draw_rect(debug_images[k].image, image_rect, item_color, thickness=2)
+                    drawings.append((image_rect, colors[rect_index], 2))
+                    
+    def add_actual_plants(self, geo_images, actual_plants):
+        
+        segment_filenames = set([geo_image.file_name for geo_image in geo_images])
+        for plant in actual_plants:
+            for ref in plant.all_refs:
+                if ref.parent_image_filename not in segment_filenames:
+                    continue
+                if ref.type == 'CreatedPlant':
+                    self.drawings[ref.parent_image_filename].append((ref.bounding_rect, (255, 255, 255), 6))
+                else:
+                    self.drawings[ref.parent_image_filename].append((ref.bounding_rect, (0, 255, 0), 5))
+                    
+    def render(self, out_directory, scale=1.0, jpeg_quality=0):
+        '''
+        Draw marks on every added image and write to images sub-directory.  Images are resized by scale and if jpeg quality
+        is greater than zero then they're written as JPEGs with that quality instead of the original format.
+        '''
+        # Write images out to subdirectory to keep separated from pickled results.
+        image_out_directory = os.path.join(out_directory, 'images/')
+        if not os.path.exists(image_out_directory):
+            os.makedirs(image_out_directory)
             
-    for plant in actual_plants:
-        for ref in plant.all_refs:
-            if not ref.parent_image_filename:
-                continue
-            geo_image_filenames = [geo_image.file_name for geo_image in debug_geo_images]
-            try:
-                debug_img_index = geo_image_filenames.index(ref.parent_image_filename)
-            except ValueError:
+        print "Writing out {} debug images".format(len(self.geo_images))
+        
+        write_params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)] if jpeg_quality > 0 else None
+        
+        image_writer = BackgroundImageWriter()
+        for file_name, geo_image in self.geo_images.iteritems():
+            img = cv2.imread(geo_image.file_path, cv2.CV_LOAD_IMAGE_COLOR)
+            if img is None:
+                print "Could not open image {}".format(geo_image.file_path)
                 continue
-            debug_img = debug_images[debug_img_index].image
-            if ref.type == 'CreatedPlant':
-                draw_rect(debug_img, ref.bounding_rect, (255, 255, 255), thickness=6)
-            else:
-                draw_rect(debug_img, ref.bounding_rect, (0, 255, 0), thickness=5)
             
-    debug_filepaths = [os.path.join(image_out_directory, postfix_filename(geo_image.file_name, 'marked')) for geo_image in debug_geo_images]
-    for k, (debug_image, filepath) in enumerate(zip(debug_images, debug_filepaths)):
-        if not debug_image.existed:
-            output_debug_image = debug_image.image
-            # KLM - don't make image smaller or bounding rect coordinates won't be right next time try to draw on image.
-            #output_debug_image = cv2.resize(debug_image.image, (0,0), fx=0.25, fy=0.25)
-        else:
-            output_debug_image = debug_image.image
-        cv2.imwrite(filepath, output_debug_image)
-        debug_geo_images[k].debug_filepath = filepath
\ No newline at end of file
+            for image_rect, color, thickness in self.drawings[file_name]:
+                draw_rect(img, image_rect, color, thickness=thickness)
+                
+            if scale != 1.0:
+                img = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                
+            debug_filename = postfix_filename(file_name, 'marked')
+            if write_params is not None:
+                debug_filename = os.path.splitext(debug_filename)[0] + '.jpg'
+            filepath = os.path.join(image_out_directory, debug_filename)
+            
+            image_writer.write(filepath, img, write_params)
+            geo_image.debug_filepath = filepath
+            
+        num_failed = image_writer.close()
+        if num_failed > 0:
+            print "Warning: failed to write {} debug images.".format(num_failed)
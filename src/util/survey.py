@@ -1,65 +1,163 @@
 #! /usr/bin/env python
 
+import math
+from collections import namedtuple
+
 # non-default import
 import numpy as np
 
+# Error between surveyed position and found position of every matched item. Errors are survey - item (in meters).
+SurveyErrorReport = namedtuple('SurveyErrorReport', 'names east_errors north_errors distance_errors unmatched_names')
+
+# Percentiles of absolute errors included in survey verification results.
+ERROR_PERCENTILES = [50, 90, 95, 99]
+
+def index_items_by_name(items):
+    '''Return dictionary of lowercase item name -> item.  If multiple items have the same name then the first one is used.'''
+    index = {}
+    for item in items:
+        index.setdefault(item.name.lower(), item)
+    return index
+
+def find_survey_matches(items, survey_items):
+    '''Return list of (survey item, matching item) for every survey item. Matching item is None if no name matches (ignoring case).'''
+    items_by_name = index_items_by_name(items)
+    return [(survey_item, items_by_name.get(survey_item.name.lower())) for survey_item in survey_items]
+
+def usable_matches(survey_matches):
+    '''Return list of (survey item, matching item) that have a match and aren't single codes.'''
+    # TODO Use plant for single code
+    return [(survey_item, item) for survey_item, item in survey_matches if item is not None and not item.name.startswith('K')]
+
+def match_survey_items(items, survey_items):
+    '''
+    Return (list of (survey item, matching item), list of survey items without a match).
+    Single codes are matched but not returned since their position isn't surveyed the same way.
+    '''
+    survey_matches = find_survey_matches(items, survey_items)
+    unmatched = [survey_item for survey_item, item in survey_matches if item is None]
+    return usable_matches(survey_matches), unmatched
+
+def matched_positions(matches):
+    '''Return (survey positions, item positions) as Nx2 arrays of east/north for list of (survey item, item) matches.'''
+    survey_positions = np.array([survey_item.position[:2] for survey_item, _ in matches], dtype=np.float64).reshape(-1, 2)
+    item_positions = np.array([(item.position[0], item.position[1]) for _, item in matches], dtype=np.float64).reshape(-1, 2)
+    return survey_positions, item_positions
+
 def calculate_east_north_offsets(items, survey_items):
-    
-    east_offsets = []
-    north_offsets = []
-    for survey_item in survey_items:
-        
-        try:
-            matching_item = [item for item in items if item.name.lower() == survey_item.name][0]
-        except IndexError:
-            continue
-        
-        if matching_item.name.startswith('K'):
-            continue # dont use single codes
-        
-        east_offsets.append(survey_item.position[0] - matching_item.position[0])
-        north_offsets.append(survey_item.position[1] - matching_item.position[1])
-        
-    return np.mean(east_offsets), np.mean(north_offsets)
+
+    matches, _ = match_survey_items(items, survey_items)
+    survey_positions, item_positions = matched_positions(matches)
+    offsets = survey_positions - item_positions
+
+    return np.mean(offsets[:, 0]), np.mean(offsets[:, 1])
+
+def calculate_rigid_transform(items, survey_items):
+    '''
+    Return (angle, item center, survey center) of best fit (least squares) rotation and translation from item positions to
+    surveyed positions.  Positions are rotated by angle (radians, CCW) about the item center and then moved to survey center.
+    '''
+    matches, _ = match_survey_items(items, survey_items)
+    survey_positions, item_positions = matched_positions(matches)
+
+    item_center = item_positions.mean(axis=0)
+    survey_center = survey_positions.mean(axis=0)
+
+    # Cross covariance of centered positions gives the rotation that best lines them up.
+    item_deltas = item_positions - item_center
+    survey_deltas = survey_positions - survey_center
+    covariance = np.dot(item_deltas.T, survey_deltas)
+    angle = math.atan2(covariance[0, 1] - covariance[1, 0], covariance[0, 0] + covariance[1, 1])
+
+    return angle, tuple(item_center.tolist()), tuple(survey_center.tolist())
+
+def calculate_survey_errors(items, survey_items, survey_matches=None):
+    '''Return SurveyErrorReport of items that match survey items.'''
+    if survey_matches is None:
+        survey_matches = find_survey_matches(items, survey_items)
+    matches = usable_matches(survey_matches)
+    unmatched = [survey_item for survey_item, item in survey_matches if item is None]
+    survey_positions, item_positions = matched_positions(matches)
+    errors = survey_positions - item_positions
+
+    return SurveyErrorReport(names=[item.name for _, item in matches],
+                             east_errors=errors[:, 0],
+                             north_errors=errors[:, 1],
+                             distance_errors=np.sqrt(np.sum(errors * errors, axis=1)),
+                             unmatched_names=[survey_item.name for survey_item in unmatched])
+
+def summarize_survey_errors(report):
+    '''Return dictionary of statistics (mean, min, max and percentiles) for each type of error in report.'''
+    summary = {}
+    for error_name in ['east_errors', 'north_errors', 'distance_errors']:
+        errors = getattr(report, error_name)
+        abs_errors = np.abs(errors)
+        stats = {'mean': np.mean(errors), 'abs_mean': np.mean(abs_errors), 'min': np.min(abs_errors), 'max': np.max(abs_errors)}
+        for percentile, value in zip(ERROR_PERCENTILES, np.percentile(abs_errors, ERROR_PERCENTILES)):
+            stats['p{}'.format(percentile)] = value
+        summary[error_name] = stats
+    return summary
 
 def run_survey_verification(items, survey_items):
-    
-    east_errors = []
-    north_errors = []
-    for survey_item in survey_items:
-        
-        try:
-            matching_item = [item for item in items if item.name.lower() == survey_item.name][0]
-        except IndexError:
+    '''Print how far off items are from their surveyed positions and return SurveyErrorReport.'''
+    survey_matches = find_survey_matches(items, survey_items)
+    report = calculate_survey_errors(items, survey_items, survey_matches)
+
+    # Print in same order as survey file.
+    errors = iter(zip(report.names, report.east_errors.tolist(), report.north_errors.tolist()))
+    for survey_item, item in survey_matches:
+        if item is None:
             print "No match for {}".format(survey_item)
-            continue
-        
-        if matching_item.name.startswith('K'):
-            # TODO Use plant for single code
-            continue
-        
-        east_error = survey_item.position[0] - matching_item.position[0]
-        north_error = survey_item.position[1] - matching_item.position[1]
-        
-        print "{} off by ({}, {})".format(matching_item.name, east_error, north_error)
-        
-        east_errors.append(east_error)
-        north_errors.append(north_error)
-        
-    avg_easting = np.mean(east_errors)
-    avg_northing = np.mean(north_errors)
-    
-    abs_easting = [abs(error) for error in east_errors]
-    abs_northing = [abs(error) for error in north_errors]
-        
+        elif not item.name.startswith('K'):
+            print "{} off by ({}, {})".format(*next(errors))
+
     print "\n\n-----Survey Verification Results-----"
-    print "Average error East: {:3f}  North: {:3f}".format(avg_easting, avg_northing)
-    print "|Average| error East: {:3f}  North: {:3f}".format(np.mean(abs_easting), np.mean(abs_northing))
-    print "Min error East: {:3f}  North: {:3f}".format(min(abs_easting), min(abs_northing))
-    print "Max error East: {:3f}  North: {:3f}".format(max(abs_easting), max(abs_northing))
-    
+    if len(report.names) == 0:
+        print "No surveyed items matched."
+        return report
+
+    summary = summarize_survey_errors(report)
+    east = summary['east_errors']
+    north = summary['north_errors']
+    distance = summary['distance_errors']
+    print "Average error East: {:3f}  North: {:3f}".format(east['mean'], north['mean'])
+    print "|Average| error East: {:3f}  North: {:3f}".format(east['abs_mean'], north['abs_mean'])
+    print "Min error East: {:3f}  North: {:3f}".format(east['min'], north['min'])
+    print "Max error East: {:3f}  North: {:3f}".format(east['max'], north['max'])
+    for percentile in ERROR_PERCENTILES:
+        key = 'p{}'.format(percentile)
+        print "{}th percentile error East: {:3f}  North: {:3f}  Distance: {:3f}".format(percentile, east[key], north[key], distance[key])
+
+    return report
+
 def convert_coordinates(items, east_offset, north_offset):
-    
-    for item in items:
-        new_position = (item.position[0] + east_offset, item.position[1] + north_offset, item.position[2])
-        item.position = new_position
+
+    for ref in all_nested_refs(items):
+        position = ref.measured_position
+        ref.position = (position[0] + east_offset, position[1] + north_offset, position[2])
+
+def transform_coordinates(items, angle, item_center, survey_center):
+    '''Rotate items (and their references) by angle about item center and then move them to survey center.'''
+    cos_angle = math.cos(angle)
+    sin_angle = math.sin(angle)
+    for ref in all_nested_refs(items):
+        position = ref.measured_position
+        dx = position[0] - item_center[0]
+        dy = position[1] - item_center[1]
+        ref.position = (survey_center[0] + cos_angle * dx - sin_angle * dy,
+                        survey_center[1] + sin_angle * dx + cos_angle * dy,
+                        position[2])
+
+def all_nested_refs(items):
+    '''Return list of items and every reference (including references of references) of each one.  Each one is only listed once.'''
+    refs = []
+    visited_ids = set()
+    items_to_visit = list(reversed(items))
+    while len(items_to_visit) > 0:
+        item = items_to_visit.pop()
+        if id(item) in visited_ids:
+            continue
+        visited_ids.add(id(item))
+        refs.append(item)
+        items_to_visit.extend(reversed(item.other_items))
+    return refs
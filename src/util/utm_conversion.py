@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+
+import math
+
+# non-default import
+import numpy as np
+import utm
+
+# Same ellipsoid constants and series coefficients used by utm.to_latlon so results match.
+K0 = 0.9996
+
+E = 0.00669438
+E2 = E * E
+E3 = E2 * E
+E_P2 = E / (1.0 - E)
+
+SQRT_E = math.sqrt(1 - E)
+_E = (1 - SQRT_E) / (1 + SQRT_E)
+_E2 = _E * _E
+_E3 = _E2 * _E
+_E4 = _E3 * _E
+_E5 = _E4 * _E
+
+M1 = (1 - E / 4 - 3 * E2 / 64 - 5 * E3 / 256)
+M2 = (3 * E / 8 + 3 * E2 / 32 + 45 * E3 / 1024)
+M3 = (15 * E2 / 256 + 45 * E3 / 1024)
+M4 = (35 * E3 / 3072)
+
+P2 = (3. / 2 * _E - 27. / 32 * _E3 + 269. / 512 * _E5)
+P3 = (21. / 16 * _E2 - 55. / 32 * _E4)
+P4 = (151. / 96 * _E3 - 417. / 128 * _E5)
+P5 = (1097. / 512 * _E4)
+
+R = 6378137
+
+ZONE_LETTERS = "CDEFGHJKLMNPQRSTUVWXX"
+
+def parse_zone(zone):
+    '''Return (zone number, zone letter) of zone string such as 14S. Raise ValueError if zone isn't valid.'''
+    return int(zone[:-1]), zone[-1]
+
+def to_latlon_arrays(eastings, northings, zone_number, zone_letter):
+    '''
+    Return (latitudes, longitudes) arrays in degrees of easting/northing arrays that are all in the same UTM zone.
+    Same math as utm.to_latlon, but for every position at once.  Raise utm.OutOfRangeError if any value is out of range.
+    '''
+    eastings = np.asarray(eastings, dtype=np.float64)
+    northings = np.asarray(northings, dtype=np.float64)
+
+    if not np.all((eastings >= 100000) & (eastings < 1000000)):
+        raise utm.OutOfRangeError('easting out of range (must be between 100.000 m and 999.999 m)')
+    if not np.all((northings >= 0) & (northings <= 10000000)):
+        raise utm.OutOfRangeError('northing out of range (must be between 0 m and 10.000.000 m)')
+    if not 1 <= zone_number <= 60:
+        raise utm.OutOfRangeError('zone number out of range (must be between 1 and 60)')
+
+    zone_letter = zone_letter.upper()
+    if not 'C' <= zone_letter <= 'X' or zone_letter in ['I', 'O']:
+        raise utm.OutOfRangeError('zone letter out of range (must be between C and X)')
+    northern = (zone_letter >= 'N')
+
+    x = eastings - 500000
+    y = northings
+    if not northern:
+        y = y - 10000000
+
+    m = y / K0
+    mu = m / (R * M1)
+
+    p_rad = (mu +
+             P2 * np.sin(2 * mu) +
+             P3 * np.sin(4 * mu) +
+             P4 * np.sin(6 * mu) +
+             P5 * np.sin(8 * mu))
+
+    p_sin = np.sin(p_rad)
+    p_sin2 = p_sin * p_sin
+
+    p_cos = np.cos(p_rad)
+
+    p_tan = p_sin / p_cos
+    p_tan2 = p_tan * p_tan
+    p_tan4 = p_tan2 * p_tan2
+
+    ep_sin = 1 - E * p_sin2
+    ep_sin_sqrt = np.sqrt(1 - E * p_sin2)
+
+    n = R / ep_sin_sqrt
+    r = (1 - E) / ep_sin
+
+    c = _E * p_cos**2
+    c2 = c * c
+
+    d = x / (n * K0)
+    d2 = d * d
+    d3 = d2 * d
+    d4 = d3 * d
+    d5 = d4 * d
+    d6 = d5 * d
+
+    latitudes = (p_rad - (p_tan / r) *
+                 (d2 / 2 -
+                  d4 / 24 * (5 + 3 * p_tan2 + 10 * c - 4 * c2 - 9 * E_P2)) +
+                  d6 / 720 * (61 + 90 * p_tan2 + 298 * c + 45 * p_tan4 - 252 * E_P2 - 3 * c2))
+
+    longitudes = (d -
+                  d3 / 6 * (1 + 2 * p_tan2 + c) +
+                  d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 + 24 * p_tan4)) / p_cos
+
+    central_longitude = (zone_number - 1) * 6 - 180 + 3
+
+    return np.degrees(latitudes), np.degrees(longitudes) + central_longitude
+
+def latlon_to_zone_numbers(latitudes, longitudes):
+    '''Return array of UTM zone numbers of latitude/longitude arrays. Same as utm.latlon_to_zone_number including Norway/Svalbard zones.'''
+    zone_numbers = ((longitudes + 180) / 6).astype(np.int64) + 1
+
+    zone_numbers[(latitudes >= 56) & (latitudes < 64) & (longitudes >= 3) & (longitudes < 12)] = 32
+
+    svalbard = (latitudes >= 72) & (latitudes <= 84) & (longitudes >= 0)
+    for max_longitude, zone_number in reversed([(9, 31), (21, 33), (33, 35), (42, 37)]):
+        zone_numbers[svalbard & (longitudes <= max_longitude)] = zone_number
+
+    return zone_numbers
+
+def from_latlon_arrays(latitudes, longitudes):
+    '''
+    Return (eastings, northings, zone numbers, zone letters) arrays of latitude/longitude arrays in degrees.  Each position uses
+    its own zone.  Same math as utm.from_latlon, but for every position at once.  Raise utm.OutOfRangeError if any value is out of range.
+    '''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    if not np.all((latitudes >= -80.0) & (latitudes <= 84.0)):
+        raise utm.OutOfRangeError('latitude out of range (must be between 80 deg S and 84 deg N)')
+    if not np.all((longitudes >= -180.0) & (longitudes <= 180.0)):
+        raise utm.OutOfRangeError('longitude out of range (must be between 180 deg W and 180 deg E)')
+
+    lat_rad = np.radians(latitudes)
+    lat_sin = np.sin(lat_rad)
+    lat_cos = np.cos(lat_rad)
+
+    lat_tan = lat_sin / lat_cos
+    lat_tan2 = lat_tan * lat_tan
+    lat_tan4 = lat_tan2 * lat_tan2
+
+    zone_numbers = latlon_to_zone_numbers(latitudes, longitudes)
+    zone_letters = np.array(list(ZONE_LETTERS))[(latitudes + 80).astype(np.int64) >> 3]
+
+    lon_rad = np.radians(longitudes)
+    central_lon = (zone_numbers - 1) * 6 - 180 + 3
+    central_lon_rad = np.radians(central_lon.astype(np.float64))
+
+    n = R / np.sqrt(1 - E * lat_sin**2)
+    c = E_P2 * lat_cos**2
+
+    a = lat_cos * (lon_rad - central_lon_rad)
+    a2 = a * a
+    a3 = a2 * a
+    a4 = a3 * a
+    a5 = a4 * a
+    a6 = a5 * a
+
+    m = R * (M1 * lat_rad -
+             M2 * np.sin(2 * lat_rad) +
+             M3 * np.sin(4 * lat_rad) -
+             M4 * np.sin(6 * lat_rad))
+
+    eastings = K0 * n * (a +
+                         a3 / 6 * (1 - lat_tan2 + c) +
+                         a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * E_P2)) + 500000
+
+    northings = K0 * (m + n * lat_tan * (a2 / 2 +
+                                         a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) +
+                                         a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * E_P2)))
+
+    northings[latitudes < 0] += 10000000
+
+    return eastings, northings, zone_numbers, zone_letters
+
+def positions_to_latlon(positions, zones):
+    '''
+    Return (latitudes, longitudes) arrays of list of (easting, northing, ...) positions with matching list of zone strings.
+    Positions are converted with one call for each different zone.
+    '''
+    latitudes = np.zeros(len(positions))
+    longitudes = np.zeros(len(positions))
+    if len(positions) == 0:
+        return latitudes, longitudes
+
+    eastings = np.array([position[0] for position in positions], dtype=np.float64)
+    northings = np.array([position[1] for position in positions], dtype=np.float64)
+
+    zone_indices = {}
+    for k, zone in enumerate(zones):
+        zone_indices.setdefault(zone, []).append(k)
+
+    for zone, indices in zone_indices.iteritems():
+        zone_number, zone_letter = parse_zone(zone)
+        indices = np.array(indices)
+        latitudes[indices], longitudes[indices] = to_latlon_arrays(eastings[indices], northings[indices], zone_number, zone_letter)
+
+    return latitudes, longitudes